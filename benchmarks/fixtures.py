@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Offline fixtures: a regional extract of the CHW database and coverages that runs
+# the pipeline and the benchmarks on a laptop without the production PostGIS and
+# GeoServer.
+#
+#   extract  copies the features of every table the DB class reads that lie within
+#            the bbox (plus a margin for the distance lookups) from the configured
+#            database to a disposable local PostGIS database, cuts the DEM and
+#            landuse coverages for the bbox to GeoTIFF files, picks a fixed set of
+#            transects and writes a configuration.txt that points to both
+#   serve    serves the GeoTIFF files with the WCS stand-in (benchmarks/wcs_standin.py)
+#   run      serves the coverages and runs the replay and knn benchmarks against
+#            the fixtures, with CHW_CONFIG pointing to their configuration.txt
+#
+# The target database needs PostGIS: the queries of db_utils use PostGIS functions
+# that SpatiaLite does not have, e.g.
+#   docker run -d -p 5433:5432 -e POSTGRES_PASSWORD=chw postgis/postgis
+#   createdb -h localhost -p 5433 -U postgres chw_fixture
+#
+# Usage:
+#   python -m benchmarks.fixtures extract --bbox 4.0 52.0 5.5 53.5 \
+#       --target "host=localhost port=5433 user=postgres password=chw dbname=chw_fixture"
+#   python -m benchmarks.fixtures run [--concurrency 2] [--compare baseline.json]
+
+import argparse
+import configparser
+import json
+import math
+import os
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+
+import psycopg2
+from psycopg2 import sql
+from rasterio.warp import transform_bounds
+
+from benchmarks.wcs_standin import layer_file, serve
+from processes.utils import read_config
+from processes.vector_utils import canonical_transect
+from processes.wcs_utils import WCS
+
+DEFAULT_PATH = Path(__file__).resolve().parent / "fixture"
+DEFAULT_WCS_PORT = 8765
+
+# every table the DB class reads
+FIXTURE_TABLES = (
+    "chw.data_version",
+    "chw.decision_wheel",
+    "coast.barriers_sandspits",
+    "coast.estuaries",
+    "coast.excludedregions",
+    "coast.osm_beach",
+    "coast.osm_landpolygon",
+    "coast.osm_segment500m",
+    "coast.sediment",
+    "coast.shorelinechange",
+    "coast.usgs_islands",
+    "gar.gar",
+    "geollayout.fluvisols",
+    "geollayout.glim",
+    "management.hazards",
+    "management.managementoptions",
+    "management.measures",
+    "ocean.diva_points_with_cyclone_risk",
+    "ocean.tidal_range",
+    "ocean.wave_exposure",
+    "vegetation.corals",
+    "vegetation.mangroves",
+    "vegetation.saltmarshes",
+)
+
+# degrees around the bbox: the widest lookups search 1.5 degrees (wave exposure,
+# tidal range) and 100 km (closest coasts)
+DEFAULT_MARGIN = 1.5
+
+
+def table_definition(source, table):
+    """Columns, geometry columns with their srid, and primary key of a table"""
+    schema, name = table.split(".")
+    with source.cursor() as cursor:
+        cursor.execute(
+            """SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+               FROM pg_attribute a
+               WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+               ORDER BY a.attnum""",
+            (table,),
+        )
+        columns = cursor.fetchall()
+        cursor.execute(
+            """SELECT f_geometry_column, srid FROM geometry_columns
+               WHERE f_table_schema = %s AND f_table_name = %s""",
+            (schema, name),
+        )
+        geometries = cursor.fetchall()
+        cursor.execute(
+            """SELECT a.attname
+               FROM pg_index i
+               JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+               WHERE i.indrelid = %s::regclass AND i.indisprimary""",
+            (table,),
+        )
+        primary_key = [row[0] for row in cursor.fetchall()]
+    return columns, geometries, primary_key
+
+
+def extract_table(source, target, table, bbox, margin):
+    """Copies the rows of table that intersect the bbox plus margin (all rows of
+    tables without geometry) to the same table in target
+
+    Returns:
+        number of rows copied
+    """
+    schema, name = table.split(".")
+    identifier = sql.Identifier(schema, name)
+    columns, geometries, primary_key = table_definition(source, table)
+
+    definition = sql.SQL(", ").join(
+        sql.SQL("{} {}").format(sql.Identifier(column), sql.SQL(column_type))
+        for column, column_type in columns
+    )
+    if primary_key:
+        definition = sql.SQL("{}, PRIMARY KEY ({})").format(
+            definition, sql.SQL(", ").join(map(sql.Identifier, primary_key))
+        )
+    with target.cursor() as cursor:
+        cursor.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema)))
+        cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(identifier))
+        cursor.execute(sql.SQL("CREATE TABLE {} ({})").format(identifier, definition))
+
+    query = sql.SQL("SELECT * FROM {}").format(identifier)
+    if geometries:
+        west, south, east, north = bbox
+        envelope = sql.SQL(
+            "ST_Expand(ST_MakeEnvelope({}, {}, {}, {}, 4326), {})"
+        ).format(*map(sql.Literal, (west, south, east, north, margin)))
+        query = sql.SQL("{} WHERE {}").format(
+            query,
+            sql.SQL(" OR ").join(
+                sql.SQL("ST_Intersects({}, ST_Transform({}, {}))").format(
+                    sql.Identifier(column), envelope, sql.Literal(srid)
+                )
+                for column, srid in geometries
+            ),
+        )
+
+    with tempfile.TemporaryFile(mode="w+") as buffer:
+        with source.cursor() as cursor:
+            cursor.copy_expert(
+                sql.SQL("COPY ({}) TO STDOUT").format(query).as_string(source), buffer
+            )
+        buffer.seek(0)
+        with target.cursor() as cursor:
+            cursor.copy_expert(
+                sql.SQL("COPY {} FROM STDIN").format(identifier).as_string(target), buffer
+            )
+            for column, _ in geometries:
+                cursor.execute(
+                    sql.SQL("CREATE INDEX ON {} USING gist ({})").format(
+                        identifier, sql.Identifier(column)
+                    )
+                )
+            cursor.execute(sql.SQL("ANALYZE {}").format(identifier))
+            cursor.execute(sql.SQL("SELECT count(*) FROM {}").format(identifier))
+            return cursor.fetchone()[0]
+
+
+def extract_tables(source, target, bbox, margin=DEFAULT_MARGIN, tables=FIXTURE_TABLES):
+    with target.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS postgis")
+    for table in tables:
+        rows = extract_table(source, target, table, bbox, margin)
+        target.commit()
+        print(f"{table:<40} {rows:>9} rows")
+
+
+def extract_coverage(wcs, bbox, path, margin=0.05):
+    """Cuts the bbox plus margin (degrees) from a coverage at its native grid,
+    so the fixture samples the same pixels as the coverage itself"""
+    west, south, east, north = bbox
+    left, bottom, right, top = transform_bounds(
+        "EPSG:4326", wcs.crs, west - margin, south - margin, east + margin, north + margin
+    )
+    px0 = max(int(math.floor((left - wcs.lx) / wcs.resx)), 0)
+    py0 = max(int(math.floor((bottom - wcs.ly) / wcs.resy)), 0)
+    px1 = min(int(math.ceil((right - wcs.lx) / wcs.resx)), wcs.cx)
+    py1 = min(int(math.ceil((top - wcs.ly) / wcs.resy)), wcs.cy)
+    wcs.bbox = (
+        wcs.lx + px0 * wcs.resx,
+        wcs.ly + py0 * wcs.resy,
+        wcs.lx + px1 * wcs.resx,
+        wcs.ly + py1 * wcs.resy,
+    )
+    wcs.width = px1 - px0
+    wcs.height = py1 - py0
+    if wcs.username and wcs.password:
+        wcs.getw_with_auth(str(path))
+    else:
+        wcs.getw(str(path))
+
+
+def extract_transects(target, bbox, path, number):
+    """Canonical transects of number coastline segments in the bbox, evenly spread
+    over the segments ordered by gid, as JSONL for benchmarks/replay.py"""
+    with target.cursor() as cursor:
+        cursor.execute(
+            """SELECT gid, ST_AsText(geom) FROM coast.osm_segment500m
+               WHERE ST_Intersects(geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))
+               ORDER BY gid""",
+            tuple(bbox),
+        )
+        segments = cursor.fetchall()
+    step = max(len(segments) / number, 1) if number else 1
+    picked = [segments[int(i * step)] for i in range(min(number, len(segments)))]
+    with open(path, "w", encoding="utf-8") as f:
+        for gid, segment_wkt in picked:
+            _, transect = canonical_transect(segment_wkt)
+            f.write(json.dumps({"transect": transect, "coastline_id": gid}) + "\n")
+    return len(picked)
+
+
+def write_config(path, target_dsn, wcs_url, layers):
+    """configuration.txt of the fixtures. DB() connects without a port, so a
+    non-default port is passed to the benchmarks as PGPORT (see run)."""
+    dsn = psycopg2.extensions.parse_dsn(target_dsn)
+    cf = configparser.RawConfigParser()
+    cf["PostGIS"] = {
+        "host": dsn.get("host", "localhost"),
+        "user": dsn.get("user", ""),
+        "pass": dsn.get("password", ""),
+        "db": dsn.get("dbname", ""),
+        "port": dsn.get("port", "5432"),
+    }
+    cf["GeoServer"] = {
+        "ows_url": wcs_url,
+        "dem": layers["dem"],
+        "landuse": layers["landuse"],
+        "dem_test": layers["dem_test"],
+        "username": "",
+        "password": "",
+    }
+    with open(path, "w") as f:
+        cf.write(f)
+
+
+def extract(args):
+    (
+        host,
+        user,
+        password,
+        db,
+        port,
+        ows_url,
+        dem,
+        landuse,
+        dem_test,
+        username,
+        geoserver_password,
+    ) = read_config()
+    path = Path(args.path)
+    (path / "coverages").mkdir(parents=True, exist_ok=True)
+    layers = {"dem": dem, "landuse": landuse, "dem_test": dem_test}
+
+    for layer in sorted(set(layers.values())):
+        print(f"Cutting coverage {layer}")
+        wcs = WCS(ows_url, layer, username, geoserver_password)
+        extract_coverage(wcs, args.bbox, layer_file(path / "coverages", layer))
+
+    source = psycopg2.connect(host=host, user=user, password=password, dbname=db, port=port)
+    target = psycopg2.connect(args.target)
+    try:
+        # one snapshot of the source for all tables
+        source.set_session(readonly=True, isolation_level="REPEATABLE READ")
+        extract_tables(source, target, args.bbox, args.margin)
+        number = extract_transects(target, args.bbox, path / "transects.jsonl", args.transects)
+        print(f"Picked {number} transects")
+    finally:
+        source.close()
+        target.close()
+
+    write_config(
+        path / "configuration.txt",
+        args.target,
+        f"http://127.0.0.1:{args.port}/wcs",
+        layers,
+    )
+    with open(path / "fixture.json", "w") as f:
+        json.dump({"bbox": args.bbox, "margin": args.margin, "tables": FIXTURE_TABLES}, f)
+    print(f"Fixtures written to {path}")
+
+
+def fixture_environment(path) -> dict:
+    """Environment of the benchmark processes: the fixture configuration and its
+    database port"""
+    cf = configparser.RawConfigParser()
+    cf.read(Path(path) / "configuration.txt")
+    env = dict(os.environ, CHW_CONFIG=str(Path(path) / "configuration.txt"))
+    env["PGPORT"] = cf.get("PostGIS", "port", fallback="5432")
+    return env
+
+
+def wcs_port(path) -> int:
+    cf = configparser.RawConfigParser()
+    cf.read(Path(path) / "configuration.txt")
+    url = cf.get("GeoServer", "ows_url")
+    return int(url.rsplit(":", 1)[1].split("/")[0])
+
+
+def run(args):
+    path = Path(args.path)
+    server = serve(path / "coverages", port=wcs_port(path), background=True)
+    env = fixture_environment(path)
+    try:
+        replay = [
+            sys.executable, "-m", "benchmarks.replay",
+            "--jsonl", str(path / "transects.jsonl"),
+            "--concurrency", str(args.concurrency),
+            "--save", args.save or str(path / "last_run.json"),
+        ]
+        if args.compare:
+            replay += ["--compare", args.compare]
+        status = subprocess.run(replay, env=env).returncode
+        if not args.skip_knn:
+            knn = [sys.executable, "-m", "benchmarks.knn", "--points", "100", "--seed", "0.5"]
+            status = subprocess.run(knn, env=env).returncode or status
+    finally:
+        server.shutdown()
+    sys.exit(status)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline fixtures of the CHW data")
+    parser.add_argument("--path", default=str(DEFAULT_PATH), help="folder of the fixtures")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    extract_parser = commands.add_parser("extract", help="extract the fixtures")
+    extract_parser.add_argument(
+        "--bbox", type=float, nargs=4, required=True, metavar=("WEST", "SOUTH", "EAST", "NORTH")
+    )
+    extract_parser.add_argument("--target", required=True, help="libpq dsn of the local database")
+    extract_parser.add_argument("--margin", type=float, default=DEFAULT_MARGIN)
+    extract_parser.add_argument("--transects", type=int, default=50)
+    extract_parser.add_argument("--port", type=int, default=DEFAULT_WCS_PORT, help="WCS stand-in port")
+
+    commands.add_parser("serve", help="serve the coverages")
+
+    run_parser = commands.add_parser("run", help="run the benchmarks on the fixtures")
+    run_parser.add_argument("--concurrency", type=int, default=1)
+    run_parser.add_argument("--save", help="results file, by default <path>/last_run.json")
+    run_parser.add_argument("--compare", help="baseline JSON file to compare with")
+    run_parser.add_argument("--skip-knn", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "extract":
+        extract(args)
+    elif args.command == "serve":
+        print(f"Serving {args.path}/coverages on port {wcs_port(args.path)}")
+        serve(Path(args.path) / "coverages", port=wcs_port(args.path))
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Compares the knn and dwithin modes of the nearest-value lookups (see nearest_sql
+# in processes/db_utils.py) on random points of the coastline: the results must be
+# identical, the timings show the gain of the KNN ordering.
+#
+# Usage: python -m benchmarks.knn [--points 200] [--seed 0.5]
+
+import argparse
+import statistics
+import time
+
+from processes.db_utils import DB, nearest_sql, wkb_param
+from processes.utils import read_config
+
+W = "ST_GeomFromWKB($1, $2)"
+W_3857 = "ST_Transform(ST_GeomFromWKB($1, $2), 3857)"
+
+# name -> (columns, table, geometry column, target, distance, where)
+LOOKUPS = {
+    "wave_exposure": ("ts_exposure", "ocean.wave_exposure", "geom", W, 1.5, None),
+    "tidal_range": ("exposure", "ocean.tidal_range", "geom", W, 1.5, None),
+    "shoreline_change": ("change", "coast.shorelinechange", "geom", W, 1, None),
+    "sediment_changerate": ("changerate", "coast.sediment", "geom", W, 1, None),
+    "cyclone_risk": ("bcyclone", "ocean.diva_points_with_cyclone_risk", "geom", W, 1, None),
+    "gar": ("tot_val, tot_pob", "gar.gar", "wkb_geometry", W, 1, None),
+    "glim": ("xx", "geollayout.glim", "shape", W_3857, 25000, "xx NOT IN ('wb', 'nd')"),
+}
+MODES = ("dwithin", "knn")
+
+
+def sample_points(bench_db, points, seed=None):
+    """Random points on the coastline segments, as wkt. A seed (-1 to 1) picks
+    the same points every run."""
+    with bench_db.connection:
+        cursor = bench_db.connection.cursor()
+        if seed is not None:
+            cursor.execute("SELECT setseed(%s)", (seed,))
+        cursor.execute(
+            """SELECT ST_AsText(ST_PointOnSurface(geom)) FROM coast.osm_segment500m
+               ORDER BY random() LIMIT %s""",
+            (points,),
+        )
+        rows = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+    return rows
+
+
+def run(bench_db, name, mode, wkt):
+    columns, table, geom, target, dist, where = LOOKUPS[name]
+    query = nearest_sql(columns, table, geom, target, dist, where, mode=mode)
+    start = time.perf_counter()
+    with bench_db.connection:
+        cursor = bench_db.execute(
+            f"bench_{name}_{mode}", query, ("bytea", "integer"), (wkb_param(wkt), 4326)
+        )
+        row = cursor.fetchone()
+        cursor.close()
+    return row, (time.perf_counter() - start) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the knn and dwithin modes")
+    parser.add_argument("--points", type=int, default=200, help="number of points")
+    parser.add_argument("--seed", type=float, help="seed of the sample, -1 to 1")
+    args = parser.parse_args(argv)
+
+    host, user, password, db, _, _, _, _, _, _, _ = read_config()
+    with DB(user, password, host, db) as bench_db:
+        points = sample_points(bench_db, args.points, args.seed)
+        print(f"{'lookup':<20} {'mode':<8} {'median ms':>10} {'p95 ms':>10} {'mismatches':>11}")
+        for name in LOOKUPS:
+            timings = {mode: [] for mode in MODES}
+            mismatches = 0
+            # the first execution of each mode prepares the statement, warm up once
+            for mode in MODES:
+                run(bench_db, name, mode, points[0])
+            for wkt in points:
+                results = {}
+                for mode in MODES:
+                    results[mode], elapsed = run(bench_db, name, mode, wkt)
+                    timings[mode].append(elapsed)
+                if results["dwithin"] != results["knn"]:
+                    mismatches += 1
+            for mode in MODES:
+                values = sorted(timings[mode])
+                p95 = values[int(0.95 * (len(values) - 1))]
+                print(
+                    f"{name:<20} {mode:<8} {statistics.median(values):>10.2f} "
+                    f"{p95:>10.2f} {mismatches if mode == 'knn' else '':>11}"
+                )
+
+
+if __name__ == "__main__":
+    main()
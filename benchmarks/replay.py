@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Replays recorded transects against the CHW classification and reports the
+# latency percentiles, the throughput and the time per stage (see
+# processes/metrics_utils.py). The transects come from PyWPS logs (the
+# "---Input transect---" and "trnsect - " lines) or from a JSONL file with one
+# {"transect": wkt or geojson, "coastline_id": ..., "notification": ...} per line.
+# The run is stored as a JSON baseline; --compare reports the changes against an
+# earlier baseline and fails when the latency or throughput regressed.
+#
+# Usage:
+#   python -m benchmarks.replay --log logs/pywps.log --extract benchmarks/transects.jsonl
+#   python -m benchmarks.replay --jsonl benchmarks/transects.jsonl --concurrency 4 \
+#       --save benchmarks/baseline.json
+#   python -m benchmarks.replay --jsonl benchmarks/transects.jsonl \
+#       --url http://localhost:5000/wps --compare benchmarks/baseline.json
+#
+# Disable the [ResultCache] of the service, or a replay measures cache hits.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import re
+import statistics
+import sys
+import time
+from urllib.request import Request, urlopen
+from xml.sax.saxutils import escape
+
+import geojson
+from shapely import wkt as shapely_wkt
+from shapely.geometry import shape
+
+from processes.metrics_utils import collect
+
+WKT_LINE = re.compile(r"---Input transect---: (LINESTRING ?\([^)]*\))")
+FEATURE_LINE = re.compile(r"trnsect - (\{.*\})\s*$")
+
+EXECUTE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<wps:Execute service="WPS" version="1.0.0" xmlns:wps="http://www.opengis.net/wps/1.0.0"
+             xmlns:ows="http://www.opengis.net/ows/1.1">
+  <ows:Identifier>{identifier}</ows:Identifier>
+  <wps:DataInputs>
+    <wps:Input>
+      <ows:Identifier>transect</ows:Identifier>
+      <wps:Data><wps:ComplexData mimeType="application/json">{transect}</wps:ComplexData></wps:Data>
+    </wps:Input>
+    <wps:Input>
+      <ows:Identifier>debug</ows:Identifier>
+      <wps:Data><wps:LiteralData>true</wps:LiteralData></wps:Data>
+    </wps:Input>
+  </wps:DataInputs>
+  <wps:ResponseForm>
+    <wps:RawDataOutput mimeType="application/json">
+      <ows:Identifier>output_json</ows:Identifier>
+    </wps:RawDataOutput>
+  </wps:ResponseForm>
+</wps:Execute>"""
+
+# relative change of a baseline value that counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+
+def read_log(path) -> list:
+    """Transects of the PyWPS log. A handler that logs the whole feature is
+    followed by the wkt line of the same transect, which is skipped."""
+    transects = []
+    last_feature = None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = FEATURE_LINE.search(line)
+            if match:
+                try:
+                    feature = json.loads(match.group(1))
+                except ValueError:
+                    continue
+                last_feature = shape(feature["geometry"])
+                transects.append(
+                    {
+                        "transect": last_feature.wkt,
+                        "coastline_id": feature["properties"].get("coastline_id"),
+                        "notification": feature["properties"].get("notification"),
+                    }
+                )
+                continue
+            match = WKT_LINE.search(line)
+            if match:
+                line_string = shapely_wkt.loads(match.group(1))
+                if last_feature is not None and line_string.equals_exact(last_feature, 1e-6):
+                    last_feature = None
+                    continue
+                transects.append({"transect": line_string.wkt})
+    return transects
+
+
+def read_jsonl(path) -> list:
+    """Transects of a JSONL file; the transect is a wkt or a geojson geometry/feature"""
+    transects = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record.get("type") == "Feature":
+                record = dict(record["properties"], transect=record["geometry"])
+            transect = record["transect"]
+            if isinstance(transect, dict):
+                geometry = transect.get("geometry", transect)
+                record["transect"] = shape(geometry).wkt
+            transects.append(record)
+    return transects
+
+
+def resolve_coastline_ids(transects):
+    """Looks up the coastline id of transects without one. The transects start on
+    the coast, see create_transect_in_coast."""
+    missing = [record for record in transects if record.get("coastline_id") is None]
+    if not missing:
+        return
+    from processes.db_utils import DB
+    from processes.utils import read_config
+
+    host, user, password, db, _, _, _, _, _, _, _ = read_config()
+    with DB(user, password, host, db) as bench_db:
+        for record in missing:
+            start = shapely_wkt.loads(record["transect"]).coords[0]
+            _, record["coastline_id"] = bench_db.closest_point_of_coastline(
+                f"POINT ({start[0]} {start[1]})"
+            )
+
+
+def to_feature(record) -> geojson.Feature:
+    return geojson.Feature(
+        geometry=shapely_wkt.loads(record["transect"]),
+        properties={
+            "coastline_id": record["coastline_id"],
+            "notification": record.get("notification"),
+        },
+    )
+
+
+def run_direct(record, testing=False) -> dict:
+    """Classifies the transect in this process"""
+    from processes.chw_utils import classify_transect
+
+    with collect() as metrics:
+        start = time.perf_counter()
+        try:
+            classify_transect(to_feature(record), testing=testing)
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        elapsed = (time.perf_counter() - start) * 1000
+    return {"ms": elapsed, "error": error, "stages": metrics.as_dict()["stages"]}
+
+
+def run_wps(record, url, identifier="chw_risk_classification", timeout=300) -> dict:
+    """Sends the transect as an Execute request to the WPS endpoint; the stage
+    timings come from the Metrics section of the debug output"""
+    body = EXECUTE_TEMPLATE.format(
+        identifier=identifier, transect=escape(json.dumps(to_feature(record)))
+    )
+    request = Request(
+        url, data=body.encode(), headers={"Content-Type": "text/xml"}, method="POST"
+    )
+    start = time.perf_counter()
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            output = json.loads(response.read())
+        error = None
+    except Exception as e:
+        output = None
+        error = f"{type(e).__name__}: {e}"
+    elapsed = (time.perf_counter() - start) * 1000
+
+    stages = {}
+    if isinstance(output, dict):
+        error = output.get("errMsg", error)
+        stages = output.get("metrics", {}).get("stages", {})
+    elif isinstance(output, list):
+        for section in output:
+            if section.get("title") == "Metrics":
+                stages = section["info"]["stages"]
+    return {"ms": elapsed, "error": error, "stages": stages}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))] if values else None
+
+
+def summarize(results, wall_s) -> dict:
+    latencies = [result["ms"] for result in results if result["error"] is None]
+    stage_names = sorted({name for result in results for name in result["stages"]})
+    stages = {}
+    for name in stage_names:
+        totals = [
+            result["stages"][name]["total_ms"] if name in result["stages"] else 0.0
+            for result in results
+        ]
+        calls = sum(result["stages"].get(name, {}).get("count", 0) for result in results)
+        stages[name] = {
+            "calls": round(calls / len(results), 2),
+            "mean_ms": round(statistics.mean(totals), 3),
+            "p95_ms": round(percentile(totals, 0.95), 3),
+        }
+    errors = {}
+    for result in results:
+        if result["error"] is not None:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    return {
+        "requests": len(results),
+        "errors": sum(errors.values()),
+        "error_messages": errors,
+        "throughput_rps": round(len(results) / wall_s, 3),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "mean": statistics.mean(latencies) if latencies else None,
+        },
+        "stages": stages,
+    }
+
+
+def print_summary(summary):
+    latency = summary["latency_ms"]
+    print(
+        f"{summary['requests']} requests, {summary['errors']} errors, "
+        f"{summary['throughput_rps']:.2f} requests/s"
+    )
+    if latency["p50"] is not None:
+        print(
+            f"latency ms: p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+            f"p99 {latency['p99']:.1f}  mean {latency['mean']:.1f}"
+        )
+    for message, n in sorted(summary["error_messages"].items(), key=lambda item: -item[1]):
+        print(f"  {n:>5} x {message[:100]}")
+    if summary["stages"]:
+        print(f"\n{'stage':<32} {'calls':>6} {'mean ms':>10} {'p95 ms':>10}")
+        by_time = sorted(summary["stages"].items(), key=lambda item: -item[1]["mean_ms"])
+        for name, stage in by_time:
+            print(
+                f"{name:<32} {stage['calls']:>6} {stage['mean_ms']:>10.1f} "
+                f"{stage['p95_ms']:>10.1f}"
+            )
+
+
+def compare(summary, baseline, tolerance) -> list:
+    """Prints the changes against the baseline and returns the regressions"""
+    checks = [
+        (f"latency {q}", summary["latency_ms"][q], baseline["latency_ms"][q], False)
+        for q in ("p50", "p95", "p99")
+    ]
+    checks.append(
+        ("throughput", summary["throughput_rps"], baseline["throughput_rps"], True)
+    )
+    for name, stage in summary["stages"].items():
+        if name in baseline["stages"]:
+            checks.append(
+                (f"stage {name}", stage["mean_ms"], baseline["stages"][name]["mean_ms"], False)
+            )
+
+    regressions = []
+    print(f"\n{'compared to ' + baseline['created']:<44} {'now':>10} {'baseline':>10} {'change':>8}")
+    for name, value, reference, higher_is_better in checks:
+        if value is None or not reference:
+            continue
+        change = (value - reference) / reference
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        # stages are reported only, whole requests decide the outcome
+        if regressed and not name.startswith("stage "):
+            regressions.append(name)
+        print(
+            f"{name:<44} {value:>10.1f} {reference:>10.1f} {change:>+8.0%}"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays recorded transects")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--log", help="PyWPS log with the transects")
+    source.add_argument("--jsonl", help="JSONL file with the transects")
+    parser.add_argument("--extract", help="only write the transects to this JSONL file")
+    parser.add_argument("--url", help="WPS endpoint, by default CHW runs in this process")
+    parser.add_argument("--identifier", default="chw_risk_classification")
+    parser.add_argument("--testing", action="store_true", help="use the test DEM (in process)")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, help="replay the first LIMIT transects")
+    parser.add_argument("--unique", action="store_true", help="skip repeated transects")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured requests first")
+    parser.add_argument("--save", help="store the results as a baseline JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    transects = read_log(args.log) if args.log else read_jsonl(args.jsonl)
+    if args.unique:
+        seen = set()
+        transects = [
+            record
+            for record in transects
+            if not (record["transect"] in seen or seen.add(record["transect"]))
+        ]
+    if args.limit:
+        transects = transects[: args.limit]
+    if not transects:
+        sys.exit("No transects found")
+    resolve_coastline_ids(transects)
+
+    if args.extract:
+        with open(args.extract, "w", encoding="utf-8") as f:
+            for record in transects:
+                f.write(json.dumps(record) + "\n")
+        print(f"Wrote {len(transects)} transects to {args.extract}")
+        return
+
+    if args.url:
+        def replay(record):
+            return run_wps(record, args.url, args.identifier)
+    else:
+        def replay(record):
+            return run_direct(record, testing=args.testing)
+
+    # prepares the statements, fills the capabilities and catalogue caches
+    for record in transects[: args.warmup]:
+        replay(record)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(replay, transects))
+    wall_s = time.perf_counter() - start
+
+    summary = summarize(results, wall_s)
+    summary.update(
+        created=datetime.datetime.now().isoformat(timespec="seconds"),
+        target=args.url or "in process",
+        concurrency=args.concurrency,
+        source=args.log or args.jsonl,
+    )
+    print_summary(summary)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(summary, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f"Regressed: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
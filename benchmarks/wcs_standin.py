@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Local stand-in for the GeoServer WCS 1.0.0 endpoint, backed by GeoTIFF files.
+# Every <name>.tif in the folder is a coverage; ":" of a layer name is stored as
+# "__" (chw__merit.tif serves chw:merit), like the tile cache does. It answers the
+# GetCapabilities, DescribeCoverage and GetCoverage requests that owslib and
+# processes/wcs_utils.py send, nothing more.
+#
+# Usage: python -m benchmarks.wcs_standin benchmarks/fixture/coverages [--port 8765]
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+import threading
+from urllib.parse import parse_qsl, urlparse
+from xml.sax.saxutils import escape
+
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+
+LOGGER = logging.getLogger("PYWPS")
+
+CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<wcs:WCS_Capabilities version="1.0.0" xmlns:wcs="http://www.opengis.net/wcs"
+    xmlns:gml="http://www.opengis.net/gml" xmlns:xlink="http://www.w3.org/1999/xlink">
+  <wcs:Service>
+    <wcs:name>WCS</wcs:name>
+    <wcs:label>CHW fixture coverages</wcs:label>
+    <wcs:responsibleParty><wcs:organisationName>fixture</wcs:organisationName></wcs:responsibleParty>
+    <wcs:fees>NONE</wcs:fees>
+    <wcs:accessConstraints>NONE</wcs:accessConstraints>
+  </wcs:Service>
+  <wcs:Capability>
+    <wcs:Request>
+{operations}
+    </wcs:Request>
+  </wcs:Capability>
+  <wcs:ContentMetadata>
+{offerings}
+  </wcs:ContentMetadata>
+</wcs:WCS_Capabilities>"""
+
+OPERATION = """      <wcs:{name}><wcs:DCPType><wcs:HTTP><wcs:Get>
+        <wcs:OnlineResource xlink:href="{url}"/>
+      </wcs:Get></wcs:HTTP></wcs:DCPType></wcs:{name}>"""
+
+OFFERING = """    <wcs:CoverageOfferingBrief>
+      <wcs:name>{name}</wcs:name>
+      <wcs:label>{name}</wcs:label>
+      <wcs:lonLatEnvelope srsName="urn:ogc:def:crs:OGC:1.3:CRS84">
+        <gml:pos>{west} {south}</gml:pos>
+        <gml:pos>{east} {north}</gml:pos>
+      </wcs:lonLatEnvelope>
+    </wcs:CoverageOfferingBrief>"""
+
+DESCRIBE_COVERAGE = """<?xml version="1.0" encoding="UTF-8"?>
+<wcs:CoverageDescription version="1.0.0" xmlns:wcs="http://www.opengis.net/wcs"
+    xmlns:gml="http://www.opengis.net/gml">
+  <wcs:CoverageOffering>
+    <wcs:name>{name}</wcs:name>
+    <wcs:label>{name}</wcs:label>
+    <wcs:domainSet>
+      <wcs:spatialDomain>
+        <gml:Envelope srsName="{crs}">
+          <gml:pos>{left} {bottom}</gml:pos>
+          <gml:pos>{right} {top}</gml:pos>
+        </gml:Envelope>
+        <gml:RectifiedGrid dimension="2" srsName="{crs}">
+          <gml:limits>
+            <gml:GridEnvelope>
+              <gml:low>0 0</gml:low>
+              <gml:high>{width} {height}</gml:high>
+            </gml:GridEnvelope>
+          </gml:limits>
+          <gml:axisName>x</gml:axisName>
+          <gml:axisName>y</gml:axisName>
+          <gml:origin><gml:pos>{left} {top}</gml:pos></gml:origin>
+          <gml:offsetVector>{resx} 0.0</gml:offsetVector>
+          <gml:offsetVector>0.0 {resy}</gml:offsetVector>
+        </gml:RectifiedGrid>
+      </wcs:spatialDomain>
+    </wcs:domainSet>
+    <wcs:supportedCRSs>
+      <wcs:requestResponseCRSs>{crs}</wcs:requestResponseCRSs>
+      <wcs:nativeCRSs>{crs}</wcs:nativeCRSs>
+    </wcs:supportedCRSs>
+    <wcs:supportedFormats nativeFormat="GeoTIFF">
+      <wcs:formats>GeoTIFF</wcs:formats>
+    </wcs:supportedFormats>
+  </wcs:CoverageOffering>
+</wcs:CoverageDescription>"""
+
+EXCEPTION = """<?xml version="1.0" encoding="UTF-8"?>
+<ServiceExceptionReport version="1.2.0">
+  <ServiceException>{message}</ServiceException>
+</ServiceExceptionReport>"""
+
+
+def layer_file(folder, layer) -> Path:
+    return Path(folder) / (layer.replace(":", "__") + ".tif")
+
+
+def layer_name(path) -> str:
+    return Path(path).stem.replace("__", ":")
+
+
+class CoverageFolder:
+    """The GeoTIFF coverages of a folder"""
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+
+    def layers(self) -> list:
+        return sorted(layer_name(path) for path in self.folder.glob("*.tif"))
+
+    def capabilities(self, url) -> str:
+        operations = "\n".join(
+            OPERATION.format(name=name, url=escape(url))
+            for name in ("GetCapabilities", "DescribeCoverage", "GetCoverage")
+        )
+        offerings = []
+        for layer in self.layers():
+            with rasterio.open(layer_file(self.folder, layer)) as src:
+                west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+            offerings.append(
+                OFFERING.format(
+                    name=escape(layer), west=west, south=south, east=east, north=north
+                )
+            )
+        return CAPABILITIES.format(operations=operations, offerings="\n".join(offerings))
+
+    def describe_coverage(self, layer) -> str:
+        """The grid limits are the size of the GeoTIFF, wcs_utils.WCS derives the
+        resolution of the coverage from them"""
+        with rasterio.open(layer_file(self.folder, layer)) as src:
+            left, bottom, right, top = src.bounds
+            return DESCRIBE_COVERAGE.format(
+                name=escape(layer),
+                crs=src.crs.to_string(),
+                left=left,
+                bottom=bottom,
+                right=right,
+                top=top,
+                width=src.width,
+                height=src.height,
+                resx=src.transform.a,
+                resy=src.transform.e,
+            )
+
+    def get_coverage(self, layer, bbox, width, height) -> bytes:
+        """The bbox of the coverage resampled to width x height (nearest), as
+        GeoTIFF. Outside the GeoTIFF the pixels are nodata."""
+        with rasterio.open(layer_file(self.folder, layer)) as src:
+            window = src.window(*bbox)
+            data = src.read(
+                window=window,
+                out_shape=(src.count, height, width),
+                resampling=Resampling.nearest,
+                boundless=True,
+                fill_value=src.nodata if src.nodata is not None else 0,
+            )
+            profile = {
+                "driver": "GTiff",
+                "width": width,
+                "height": height,
+                "count": src.count,
+                "dtype": data.dtype,
+                "crs": src.crs,
+                "transform": from_bounds(*bbox, width, height),
+                "nodata": src.nodata,
+            }
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dst:
+                dst.write(data)
+            return memfile.read()
+
+
+class WCSHandler(BaseHTTPRequestHandler):
+    coverages = None  # CoverageFolder, set by serve
+
+    def _send(self, body, content_type, status=200):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key.lower(): value for key, value in parse_qsl(url.query)}
+        request = params.get("request", "").lower()
+        try:
+            if request == "getcapabilities":
+                base_url = f"http://{self.headers['Host']}{url.path}"
+                self._send(self.coverages.capabilities(base_url), "text/xml")
+            elif request == "describecoverage":
+                self._send(self.coverages.describe_coverage(params["coverage"]), "text/xml")
+            elif request == "getcoverage":
+                bbox = tuple(float(value) for value in params["bbox"].split(","))
+                data = self.coverages.get_coverage(
+                    params["coverage"], bbox, int(params["width"]), int(params["height"])
+                )
+                self._send(data, "image/tiff")
+            else:
+                raise ValueError(f"Unsupported request: {request}")
+        except Exception as e:
+            self._send(EXCEPTION.format(message=escape(f"{e}")), "application/vnd.ogc.se_xml", 400)
+
+    def log_message(self, format, *args):
+        LOGGER.debug("WCS stand-in: " + format % args)
+
+
+def serve(folder, host="127.0.0.1", port=8765, background=False):
+    """Serves the coverages of folder on http://host:port/wcs
+
+    Args:
+        background: serve from a daemon thread and return the server
+    Returns:
+        ThreadingHTTPServer
+    """
+    handler = type("FolderWCSHandler", (WCSHandler,), {"coverages": CoverageFolder(folder)})
+    server = ThreadingHTTPServer((host, port), handler)
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    else:
+        server.serve_forever()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serves GeoTIFF files as WCS 1.0.0")
+    parser.add_argument("folder", help="folder with the <layer>.tif coverages")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(argv)
+    print(f"Serving {args.folder} on http://{args.host}:{args.port}/wcs")
+    serve(args.folder, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Batch classification of many transects, e.g. a whole stretch of coastline.
+# Instead of a pipeline per transect, the transects are grouped by location and
+# every group shares its data: one set-based probe query per probe group
+# (DB.probe_transects_columns), one DEM coverage for the bbox of the group, one
+# landuse coverage when a transect needs it, and one vectorized slope calculation
+# (calc_slopes_batch). The classification itself runs per transect on these facts.
+
+from functools import partial
+import logging
+import threading
+
+import geojson
+import numpy as np
+from shapely import wkt as shapely_wkt
+
+from .chw_utils import (
+    PROBE_GROUPS,
+    TRANSECT_EXTENSIONS,
+    classify_transect,
+    dem_layer,
+    dem_test_layer,
+    geoserver_password,
+    landuse_layer,
+    merge_probe,
+    owsurl,
+    raster_settings,
+    username,
+)
+from .db_utils import DB
+from .raster_utils import (
+    calc_slopes_batch,
+    close_raster,
+    cut_wcs,
+    get_elevation_profiles,
+    read_raster_values_in_bbox,
+)
+from .utils import read_config, read_section_config, run_tasks
+from .vector_utils import (
+    change_coords,
+    extend_transect,
+    geojson_to_wkt,
+    get_bounds,
+    perpendicular_transect,
+    points_along_line,
+    wkt_geometry,
+)
+
+LOGGER = logging.getLogger("PYWPS")
+
+host, user, password, db, _, _, _, _, _, _, _ = read_config()
+
+# Defaults for the optional [Batch] section of configuration.txt
+BATCH_DEFAULTS = {
+    # transects per request
+    "max_transects": 1000,
+    # maximum width and height in degrees of the bbox of a group, so of the
+    # coverages fetched for it
+    "group_size": 0.5,
+    "max_workers": 6,
+}
+batch_settings = read_section_config("Batch", BATCH_DEFAULTS)
+
+NO_ELEVATION = "There are no elevation data in the area, please try another location"
+
+
+def transects_along_coastline(line_wkt, spacing, dist=500) -> list:
+    """Transects every spacing meters along a drawn coastline. Every point is
+    snapped to the closest coastline segment and the transect is perpendicular to
+    the segment there, pointing inland (see perpendicular_transect).
+
+    Returns:
+        list of geojson Features; points without a coastline nearby, or whose
+        point in the sea lies on land, have no geometry and an errMsg property
+    """
+    points = points_along_line(line_wkt, spacing)
+    if len(points) > batch_settings["max_transects"]:
+        raise ValueError(
+            f"{len(points)} transects, at most {batch_settings['max_transects']} are "
+            "allowed, increase the spacing"
+        )
+    features = []
+    previous = None
+    with DB(user, password, host, db) as batch_db:
+        for point in points:
+            try:
+                coast_point, coastline_id = batch_db.closest_point_of_coastline(point)
+            except IndexError:
+                features.append(
+                    geojson.Feature(
+                        geometry=wkt_geometry(point),
+                        properties={"errMsg": "There is no coastline close to this point"},
+                    )
+                )
+                continue
+            segment = batch_db.get_coastline_segment(coastline_id)
+            line = shapely_wkt.loads(segment)
+            if line.geom_type == "MultiLineString":
+                line = max(line.geoms, key=lambda part: part.length)
+            fraction = line.project(shapely_wkt.loads(coast_point), normalized=True)
+            point_on_sea, transect = perpendicular_transect(line.wkt, fraction, dist)
+            # close points snap to the same spot of the coastline
+            if transect == previous:
+                continue
+            previous = transect
+            proceed, notification = batch_db.find_special_areas(point_on_sea)
+            properties = {"coastline_id": coastline_id, "notification": notification}
+            if proceed is False:
+                properties["errMsg"] = notification
+            features.append(
+                geojson.Feature(geometry=wkt_geometry(transect), properties=properties)
+            )
+    return features
+
+
+def complete_transects(features):
+    """Adds the missing coastline_id (of the start point, which lies on the coast)
+    and notification properties of drawn transects"""
+    with DB(user, password, host, db) as batch_db:
+        for feature in features:
+            properties = feature.setdefault("properties", {})
+            properties.setdefault("notification", None)
+            if properties.get("coastline_id") is None:
+                x, y = shapely_wkt.loads(geojson_to_wkt(feature)).coords[0][:2]
+                _, properties["coastline_id"] = batch_db.closest_point_of_coastline(
+                    f"POINT ({x} {y})"
+                )
+
+
+def group_transects(features, group_size) -> list:
+    """Groups consecutive transects while the bbox of the group stays within
+    group_size degrees, so a stretch of coastline shares its coverages
+
+    Returns:
+        list of (bbox, indices of the features)
+    """
+    groups = []
+    bbox, indices = None, []
+    for i, feature in enumerate(features):
+        xmin, ymin, xmax, ymax = get_bounds(feature)
+        if bbox is not None:
+            merged = (
+                min(bbox[0], xmin),
+                min(bbox[1], ymin),
+                max(bbox[2], xmax),
+                max(bbox[3], ymax),
+            )
+            if merged[2] - merged[0] <= group_size and merged[3] - merged[1] <= group_size:
+                bbox = merged
+                indices.append(i)
+                continue
+            groups.append((bbox, indices))
+        bbox, indices = (xmin, ymin, xmax, ymax), [i]
+    if indices:
+        groups.append((bbox, indices))
+    return groups
+
+
+def probe_group(columns, transects):
+    """One group of the probe for all transects, over its own pooled connection"""
+    with DB(user, password, host, db) as probe_db:
+        return probe_db.probe_transects_columns(columns, transects)
+
+
+class MergedLanduse:
+    """Landuse coverage of the bbox of a group, fetched when the first transect
+    needs it; transects read their window of it"""
+
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self._raster = None
+        self._lock = threading.Lock()
+
+    def __call__(self, bbox):
+        with self._lock:
+            if self._raster is None:
+                self._raster = cut_wcs(
+                    *self.bbox,
+                    landuse_layer,
+                    owsurl,
+                    None,
+                    username=username,
+                    password=geoserver_password,
+                )
+        return read_raster_values_in_bbox(self._raster, *bbox)
+
+    def close(self):
+        with self._lock:
+            if self._raster is not None:
+                close_raster(self._raster)
+                self._raster = None
+
+
+def collect_group(features, bbox, testing=False) -> list:
+    """Collects the facts of a group of transects, see CHW
+
+    Returns:
+        per transect a dict of facts, or the error message of the transect
+    """
+    wkts = [geojson_to_wkt(feature) for feature in features]
+    extended = [extend_transect(transect, TRANSECT_EXTENSIONS) for transect in wkts]
+    probe_transects = [
+        (
+            transect,
+            lines["100m"],
+            lines["200m"],
+            lines["6km"],
+            lines["10km"],
+            lines["100km"],
+            None,
+        )
+        for transect, lines in zip(wkts, extended)
+    ]
+
+    def elevation_profiles():
+        try:
+            dem = cut_wcs(
+                *bbox,
+                dem_test_layer if testing else dem_layer,
+                owsurl,
+                None,
+                username=username,
+                password=geoserver_password,
+            )
+            lines = [change_coords(transect) for transect in wkts]
+            bboxes = [get_bounds(transect) for transect in wkts]
+            try:
+                return get_elevation_profiles(
+                    dem, lines, bboxes, resampling=raster_settings["resampling"]
+                )
+            finally:
+                close_raster(dem)
+        except Exception:
+            raise Exception(NO_ELEVATION)
+
+    tasks = {"elevation": (elevation_profiles, [])}
+    for i, columns in enumerate(PROBE_GROUPS):
+        tasks[f"probe_{i}"] = (partial(probe_group, columns, probe_transects), [])
+    facts = run_tasks(tasks, max_workers=batch_settings["max_workers"])
+
+    profiles = facts["elevation"]
+    lengths = [len(elevations) for elevations, _ in profiles]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(int)
+    mean_slopes, max_slopes, _ = calc_slopes_batch(
+        np.concatenate([elevations for elevations, _ in profiles]),
+        np.concatenate([segments for _, segments in profiles]),
+        offsets,
+    )
+
+    collected = []
+    for k, (elevations, segments) in enumerate(profiles):
+        if np.isnan(mean_slopes[k]):
+            collected.append(NO_ELEVATION)
+            continue
+        probe = merge_probe(
+            **{f"probe_{i}": facts[f"probe_{i}"][k] for i in range(len(PROBE_GROUPS))}
+        )
+        collected.append(
+            {
+                "extended": extended[k],
+                "elevation": (
+                    None,
+                    elevations,
+                    segments,
+                    round(float(mean_slopes[k]), 1),
+                    float(max_slopes[k]),
+                ),
+                "probe": probe,
+            }
+        )
+    return collected
+
+
+def classify_batch(features, testing=False, on_result=None):
+    """Classifies many transects, sharing the data of the transects close to
+    each other
+
+    Args:
+        features: geojson Features of the transects, see complete_transects.
+            Features with an errMsg property are passed on as they are.
+        testing: use the DEM layer for testing
+        on_result: callback(index, feature) called for every transect as soon as
+            it is classified, with the output or errMsg in its properties
+    Returns:
+        list of the classified features, in the order of features
+    """
+    results = [None] * len(features)
+
+    def done(i, output=None, error=None):
+        feature = features[i]
+        properties = dict(feature.get("properties") or {})
+        if error is not None:
+            properties["errMsg"] = error
+        else:
+            properties["output"] = output
+        results[i] = geojson.Feature(geometry=feature["geometry"], properties=properties)
+        if on_result is not None:
+            on_result(i, results[i])
+
+    todo = []
+    for i, feature in enumerate(features):
+        if "errMsg" in (feature.get("properties") or {}):
+            done(i, error=feature["properties"]["errMsg"])
+        else:
+            todo.append(i)
+
+    for bbox, indices in group_transects(
+        [features[i] for i in todo], batch_settings["group_size"]
+    ):
+        group = [todo[j] for j in indices]
+        try:
+            collected = collect_group([features[i] for i in group], bbox, testing)
+        except Exception as e:
+            LOGGER.exception("Collecting the data of a group of transects failed")
+            for i in group:
+                done(i, error=f"{e}")
+            continue
+        landuse = MergedLanduse(bbox)
+        try:
+            for i, facts in zip(group, collected):
+                if isinstance(facts, str):
+                    done(i, error=facts)
+                    continue
+                try:
+                    done(
+                        i,
+                        output=classify_transect(
+                            features[i], testing=testing, facts=facts, landuse=landuse
+                        ),
+                    )
+                except Exception as e:
+                    done(i, error=f"{e}")
+        finally:
+            landuse.close()
+    return results
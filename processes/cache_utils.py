@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Cache of the classification results of chw_risk_classification.
+# The key is the transect rounded to a fixed precision, the coastline id, the DEM
+# layer and the data version of the database, so a result is never served after
+# the data layers have changed. Backends: an in-process LRU or a SQLite file that
+# is shared by all processes of the service.
+
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from shapely import wkt as shapely_wkt
+from shapely.ops import transform
+
+from .metrics_utils import count, register_gauges
+from .utils import read_section_config
+
+LOGGER = logging.getLogger("PYWPS")
+
+service_path = Path(__file__).resolve().parent
+
+# Defaults for the optional [ResultCache] section of configuration.txt
+RESULT_CACHE_DEFAULTS = {
+    "enabled": False,
+    # memory or sqlite
+    "backend": "memory",
+    # empty means processes/cache/results.sqlite3 (sqlite backend only)
+    "path": "",
+    "max_entries": 10000,
+    # seconds a result stays valid
+    "ttl": 86400.0,
+    # decimals of the transect coordinates in the key
+    "precision": 6,
+    # manual stamp, change it to drop all cached results
+    "data_version": "",
+    # seconds the data version of the database is reused, 0 checks every request
+    "version_check_interval": 0.0,
+}
+
+
+def normalize_wkt(wkt, precision=6) -> str:
+    """Rounds the coordinates of a geometry, so nearby clicks give the same key
+
+    Args:
+        wkt: geometry as wkt
+        precision: number of decimals
+    Returns:
+        wkt
+    """
+    geom = shapely_wkt.loads(wkt)
+
+    def round_coords(x, y, z=None):
+        # + 0.0 turns -0.0 into 0.0
+        return np.round(x, precision) + 0.0, np.round(y, precision) + 0.0
+
+    return transform(round_coords, geom).wkt
+
+
+class MemoryBackend:
+    """In-process LRU of results"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """Results in a SQLite file, shared by the processes of the service.
+    Every call opens its own connection, so it is safe across threads and forks."""
+
+    def __init__(self, path, max_entries=10000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                """CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL)"""
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(str(self.path), timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                row = connection.execute(
+                    "SELECT value, expires FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row[1] < now:
+                    connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                    return None
+                connection.execute(
+                    "UPDATE results SET accessed = ? WHERE key = ?", (now, key)
+                )
+                return row[0]
+        finally:
+            connection.close()
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                    (key, value, now + ttl, now),
+                )
+                connection.execute("DELETE FROM results WHERE expires < ?", (now,))
+                connection.execute(
+                    """DELETE FROM results WHERE key IN (
+                        SELECT key FROM results ORDER BY accessed DESC
+                        LIMIT -1 OFFSET ?)""",
+                    (self.max_entries,),
+                )
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM results")
+        finally:
+            connection.close()
+
+    def __len__(self):
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT count(*) FROM results").fetchone()[0]
+        finally:
+            connection.close()
+
+
+class ResultCache:
+    """Classification results keyed by transect, coastline, DEM layer and data version"""
+
+    def __init__(
+        self,
+        backend,
+        ttl=86400.0,
+        precision=6,
+        data_version="",
+        version_check_interval=0.0,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.precision = precision
+        self.stamp = data_version
+        self.version_check_interval = version_check_interval
+        self._version = None
+        self._version_checked = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def data_version(self, db) -> str:
+        """Data version of the database combined with the configured stamp
+
+        Args:
+            db: DB to query when the version has to be checked
+        Returns:
+            str
+        """
+        with self._lock:
+            if (
+                self._version is not None
+                and time.monotonic() - self._version_checked < self.version_check_interval
+            ):
+                return self._version
+        version = f"{self.stamp}:{db.get_data_version()}"
+        with self._lock:
+            self._version = version
+            self._version_checked = time.monotonic()
+        return version
+
+    def key(self, transect_wkt, coastline_id, dem_layer, data_version, extra=None) -> str:
+        """Cache key of a classification
+
+        Args:
+            transect_wkt: the input transect as wkt
+            coastline_id: id of the coastline, None if not given
+            dem_layer: DEM coverage the slopes are computed from
+            data_version: see data_version
+            extra: other json serializable inputs the result depends on
+        Returns:
+            sha256 hex digest
+        """
+        parts = [
+            normalize_wkt(transect_wkt, self.precision),
+            coastline_id,
+            dem_layer,
+            data_version,
+            extra,
+        ]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached result (as json string), None on a miss"""
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            # a broken cache must not break the classification
+            LOGGER.exception("Reading the result cache failed")
+            count("result_cache.errors")
+            value = None
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        count("result_cache.misses" if value is None else "result_cache.hits")
+        return value
+
+    def set(self, key, value):
+        """Stores a result (as json string)"""
+        try:
+            self.backend.set(key, value, self.ttl)
+        except Exception:
+            LOGGER.exception("Writing the result cache failed")
+            count("result_cache.errors")
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.backend),
+                "data_version": self._version,
+            }
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """Returns the process-wide result cache, or None if it is not enabled
+    in the [ResultCache] section of configuration.txt"""
+    global _result_cache
+    with _result_cache_lock:
+        if _result_cache is None:
+            settings = read_section_config("ResultCache", RESULT_CACHE_DEFAULTS)
+            if not settings["enabled"]:
+                _result_cache = False
+            else:
+                if settings["backend"] == "sqlite":
+                    backend = SQLiteBackend(
+                        settings["path"] or service_path / "cache" / "results.sqlite3",
+                        max_entries=settings["max_entries"],
+                    )
+                elif settings["backend"] == "memory":
+                    backend = MemoryBackend(max_entries=settings["max_entries"])
+                else:
+                    raise ValueError(
+                        f"Unknown result cache backend: {settings['backend']}"
+                    )
+                _result_cache = ResultCache(
+                    backend,
+                    ttl=settings["ttl"],
+                    precision=settings["precision"],
+                    data_version=settings["data_version"],
+                    version_check_interval=settings["version_check_interval"],
+                )
+                register_gauges(
+                    "result_cache", lambda: {"results": _result_cache.stats()}
+                )
+    return _result_cache or None
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# In-memory catalogues of the small, static CHW tables, loaded once per process.
+# DecisionWheel resolves the classes of chw.decision_wheel with a dict lookup on the
+# expanded 6-tuple of the levels, MeasuresCatalogue maps a CHW code to the
+# management measures per hazard. A catalogue is reloaded when the content of its
+# tables changes, checked at most every check_interval seconds, or right away
+# after invalidate_catalogues.
+#
+# python -m processes.catalogue_utils compares the in-memory lookups with the SQL.
+
+from itertools import product
+import logging
+import threading
+import time
+from types import MappingProxyType
+
+from .db_utils import DB
+from .utils import read_config, read_section_config
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Defaults for the optional [Catalogue] section of configuration.txt
+CATALOGUE_DEFAULTS = {
+    # seconds between the checks for changed tables, 0 checks on every request
+    "check_interval": 300.0,
+}
+
+
+class DecisionWheel:
+    """Immutable index of chw.decision_wheel keyed by (geological_layout,
+    wave_exposure, tidal_range, flora_fauna, sediment_balance, storm_climate)"""
+
+    tables = ("chw.decision_wheel",)
+
+    def __init__(self, rows, version=None):
+        index = {}
+        for (
+            code,
+            geological_layout,
+            wave_exposure,
+            tidal_range,
+            flora_fauna,
+            sediment_balance,
+            storm_climate,
+            *hazards,
+        ) in rows:
+            keys = product(
+                [geological_layout],
+                wave_exposure or (),
+                tidal_range or (),
+                flora_fauna or (),
+                sediment_balance or (),
+                storm_climate or (),
+            )
+            # like DB.get_classes, the first matching row wins
+            for key in keys:
+                classes = index.setdefault(key, (code, *hazards))
+                if classes != (code, *hazards):
+                    LOGGER.warning(
+                        f"chw.decision_wheel classifies {key} as both {classes[0]} "
+                        f"and {code}, {classes[0]} is used"
+                    )
+        self._index = MappingProxyType(index)
+        self.version = version
+
+    @classmethod
+    def load(cls, db, version=None):
+        return cls(db.load_decision_wheel(), version)
+
+    def get_classes(
+        self,
+        geological_layout,
+        wave_exposure,
+        tidal_range,
+        flora_fauna,
+        sediment_balance,
+        storm_climate,
+    ):
+        """Same as DB.get_classes, without a round-trip
+
+        Returns:
+            code, ecosystem_disruption, gradual_inundation, salt_water_intrusion,
+            erosion, flooding or None if no class matches
+        """
+        return self._index.get(
+            (
+                geological_layout,
+                wave_exposure,
+                tidal_range,
+                flora_fauna,
+                sediment_balance,
+                storm_climate,
+            )
+        )
+
+    def __len__(self):
+        return len(self._index)
+
+
+class MeasuresCatalogue:
+    """Immutable map of CHW code -> hazard -> measures of the management tables"""
+
+    tables = (
+        "management.managementoptions",
+        "management.hazards",
+        "management.measures",
+    )
+
+    def __init__(self, rows, version=None):
+        catalogue = {}
+        for code, hazard, measure in rows:
+            catalogue.setdefault(code, {}).setdefault(hazard, []).append(measure)
+        self._catalogue = MappingProxyType(
+            {
+                code: MappingProxyType(
+                    {hazard: tuple(measures) for hazard, measures in hazards.items()}
+                )
+                for code, hazards in catalogue.items()
+            }
+        )
+        self.version = version
+
+    @classmethod
+    def load(cls, db, version=None):
+        return cls(db.load_measures(), version)
+
+    def get_measures(self, code):
+        """Same as DB.get_measures, without a round-trip
+
+        Returns:
+            read-only dict hazard -> tuple of measures, empty for an unknown code
+        """
+        return self._catalogue.get(code, MappingProxyType({}))
+
+    def __len__(self):
+        return len(self._catalogue)
+
+
+class Catalogue:
+    """Process-wide instance of a catalogue class, loaded on first use and
+    reloaded when the version of its tables changes"""
+
+    def __init__(self, catalogue_class, check_interval=300.0):
+        self.catalogue_class = catalogue_class
+        self.check_interval = check_interval
+        self._current = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, db):
+        """Returns the current catalogue
+
+        Args:
+            db: DB to check the version and to load the tables with, when needed
+        """
+        with self._lock:
+            current = self._current
+            if current is not None:
+                if time.monotonic() - self._checked < self.check_interval:
+                    return current
+                # the other requests keep the current catalogue during the check
+                self._checked = time.monotonic()
+        # the version query and the reload run without the lock, only the swap
+        # is done under it
+        try:
+            version = db.get_tables_version(self.catalogue_class.tables)
+            if current is None or current.version != version:
+                LOGGER.info(
+                    f"Loading {self.catalogue_class.__name__}, version {version}"
+                )
+                loaded = self.catalogue_class.load(db, version)
+            else:
+                loaded = current
+        except Exception:
+            with self._lock:
+                self._checked = 0.0
+            raise
+        with self._lock:
+            # unless another request swapped in a catalogue meanwhile
+            if self._current is current:
+                self._current = loaded
+                self._checked = time.monotonic()
+            return self._current
+
+    def invalidate(self):
+        """Forces a version check on the next get"""
+        with self._lock:
+            self._checked = 0.0
+
+
+_catalogues = {}
+_catalogue_lock = threading.Lock()
+
+
+def _get_catalogue(catalogue_class, db):
+    with _catalogue_lock:
+        catalogue = _catalogues.get(catalogue_class)
+        if catalogue is None:
+            settings = read_section_config("Catalogue", CATALOGUE_DEFAULTS)
+            catalogue = Catalogue(catalogue_class, settings["check_interval"])
+            _catalogues[catalogue_class] = catalogue
+    return catalogue.get(db)
+
+
+def get_decision_wheel(db) -> DecisionWheel:
+    """Returns the process-wide decision wheel, see Catalogue.get"""
+    return _get_catalogue(DecisionWheel, db)
+
+
+def get_measures_catalogue(db) -> MeasuresCatalogue:
+    """Returns the process-wide measures catalogue, see Catalogue.get"""
+    return _get_catalogue(MeasuresCatalogue, db)
+
+
+def invalidate_catalogues():
+    """Checks the versions of all catalogues on their next use"""
+    with _catalogue_lock:
+        catalogues = list(_catalogues.values())
+    for catalogue in catalogues:
+        catalogue.invalidate()
+
+
+def verify_decision_wheel(db) -> list:
+    """Compares the in-memory decision wheel with DB.get_classes for every
+    combination of the level values found in chw.decision_wheel
+
+    Returns:
+        list of (levels, in-memory classes, database classes) that differ
+    """
+    rows = db.load_decision_wheel()
+    wheel = DecisionWheel(rows)
+    values = [{row[1] for row in rows}]
+    for column in range(2, 7):
+        values.append({value for row in rows for value in (row[column] or ())})
+    mismatches = []
+    for levels in product(*values):
+        expected = db.get_classes(*levels)
+        expected = tuple(expected) if expected is not None else None
+        found = wheel.get_classes(*levels)
+        if found != expected:
+            mismatches.append((levels, found, expected))
+    return mismatches
+
+
+def verify_measures_catalogue(db) -> list:
+    """Compares the in-memory measures catalogue with DB.get_measures for every
+    CHW code of management.managementoptions
+
+    Returns:
+        list of (code, in-memory measures, database measures) that differ
+    """
+    rows = db.load_measures()
+    catalogue = MeasuresCatalogue(rows)
+    mismatches = []
+    for code in sorted({row[0] for row in rows}):
+        # array_agg has no defined order, so the measures are compared as sets
+        expected = {hazard: sorted(measures) for hazard, measures in db.get_measures(code)}
+        found = {
+            hazard: sorted(measures)
+            for hazard, measures in catalogue.get_measures(code).items()
+        }
+        if found != expected:
+            mismatches.append((code, found, expected))
+    return mismatches
+
+
+if __name__ == "__main__":
+    host, user, password, db, _, _, _, _, _, _, _ = read_config()
+    with DB(user, password, host, db) as verify_db:
+        checks = {
+            "decision wheel": verify_decision_wheel(verify_db),
+            "measures": verify_measures_catalogue(verify_db),
+        }
+    for name, mismatches in checks.items():
+        for key, found, expected in mismatches:
+            print(f"{key}: in memory {found}, database {expected}")
+        print(f"{name}: {len(mismatches)} mismatches")
+    raise SystemExit(1 if any(checks.values()) else 0)
@@ -37,19 +37,28 @@
 # Extra info: https://www.coastalhazardwheel.org/
 
 import logging
+from functools import partial
 from pathlib import Path
+from .catalogue_utils import get_decision_wheel, get_measures_catalogue
+from .chw_utils import PROBE_GROUPS, TransectFacts, merge_probe
 from .db_utils import DB
+from .metrics_utils import span, timed
 
 from .raster_utils import (
-    calc_slope,
+    RASTER_DEFAULTS,
+    close_raster,
     cut_wcs,
-    get_elevation_profile,
-    calc_median_elevation,
     calc_slope_200m_inland,
     read_raster_values,
 )
-from .utils import create_temp_dir, read_config, translate_hazard_danger
-from .vector_utils import change_coords, geojson_to_wkt, get_bounds
+from .utils import (
+    create_temp_dir,
+    read_config,
+    read_section_config,
+    run_tasks,
+    translate_hazard_danger,
+)
+from .vector_utils import change_coords, extend_transect, geojson_to_wkt, get_bounds
 import numpy as np
 
 service_path = Path(__file__).resolve().parent
@@ -66,9 +75,25 @@ service_path = Path(__file__).resolve().parent
     username,
     geoserver_password,
 ) = read_config()
+raster_settings = read_section_config("Raster", RASTER_DEFAULTS)
+EXECUTOR_DEFAULTS = {"max_workers": 6}
+executor_settings = read_section_config("Executor", EXECUTOR_DEFAULTS)
 
 LOGGER = logging.getLogger("PYWPS")
 
+# Extensions of the input transect, name -> (distance in m, direction).
+# 180 extends the transect inland, -180 extends it in the sea.
+TRANSECT_EXTENSIONS = {
+    "5km": (5000, 180),
+    "4km": (4000, -180),
+    "4km_inland": (4000, 180),
+    "6km": (6000, -180),
+    "10km": (10000, -180),
+    "100km": (100000, -180),
+    "200m": (200, -180),
+    "100m": (100, -180),
+}
+
 # various variables declared used in several functions (GHN 26-06-2023)
 #define flat hard rock/soft rock/sediment plain cut-off value for slope, used in function check_geology_type
 #cov = cut off value 
@@ -83,7 +108,7 @@ cov_slope_veg = 59
 cov_elev_ci = 14
 
 
-class CHW:
+class CHW(TransectFacts):
     def __init__(self, transect, testing=False):
         LOGGER.info(f"---cut-off value slope flat hard rock/soft rock/sediment plain---: {cov_slope_hr}")
         LOGGER.info(f"---cut-off value slope vegetation---: {cov_slope_veg}")
@@ -93,9 +118,6 @@ class CHW:
         self.transect = transect
         # Notification message for that case
         self.notification = self.transect["properties"]["notification"]
-        # Initiate the DB class
-        self.db = DB(user, password, host, db)
-
         # Give default values to the information layers
         self.geological_layout = "Any"
         self.wave_exposure = "Any"
@@ -106,12 +128,20 @@ class CHW:
 
         self.dem_layer = dem_test_layer if testing else dem_layer
         # Filenames/TMP #TODO more the dem, dem_3857, glob
-        # unique temp directory for every run
-        self.tmp = create_temp_dir(service_path / "outputs")
-        self.dem = Path(self.tmp) / "dem.tif"
-        self.dem_small_island = Path(self.tmp) / "dem_small_island.tif"
-        self.dem_3857 = Path(self.tmp) / "dem_3857.tif"
-        self.globcover = Path(self.tmp) / "glocover.tif"
+        # The rasters are kept in memory, unless write_files is set for debugging.
+        # Then every run gets a unique temp directory.
+        if raster_settings["write_files"]:
+            self.tmp = create_temp_dir(service_path / "outputs")
+            self.dem = Path(self.tmp) / "dem.tif"
+            self.dem_small_island = Path(self.tmp) / "dem_small_island.tif"
+            self.dem_3857 = Path(self.tmp) / "dem_3857.tif"
+            self.globcover = Path(self.tmp) / "glocover.tif"
+        else:
+            self.tmp = None
+            self.dem = None
+            self.dem_small_island = None
+            self.dem_3857 = None
+            self.globcover = None
 
         self.transect_wkt = geojson_to_wkt(self.transect)
         LOGGER.info(f"---Input transect---: {self.transect_wkt}")
@@ -125,38 +155,15 @@ class CHW:
         # 10km and -180 from the coast: To check if intersects coastline (wave exposure)
         # 100km and -180 from the coast: To check if intersects coastline (wave exposure)
         # TODO rename the transect in a way to be clear if they are inland or to the sea
-        self.transect_5km = self.db.ST_line_extend(
-            wkt=self.transect_wkt,
-            dist=5000,
-            direction=180,
-        )
-        self.transect_4km = self.db.ST_line_extend(
-            wkt=self.transect_wkt,
-            dist=4000,
-            direction=-180,
-        )
-        self.transect_4km_inland = self.db.ST_line_extend(
-            wkt=self.transect_wkt,
-            dist=4000,
-            direction=180,
-        )
-        self.transect_6km = self.db.ST_line_extend(
-            wkt=self.transect_wkt,
-            dist=6000,
-            direction=-180,
-        )
-        self.transect_10km = self.db.ST_line_extend(
-            wkt=self.transect_wkt, dist=10000, direction=-180
-        )
-        self.transect_100km = self.db.ST_line_extend(
-            wkt=self.transect_wkt, dist=100000, direction=-180
-        )
-        self.transect_200m = self.db.ST_line_extend(
-            wkt=self.transect_wkt, dist=200, direction=-180
-        )
-        self.transect_100m = self.db.ST_line_extend(
-            wkt=self.transect_wkt, dist=100, direction=-180
-        )
+        extended = extend_transect(self.transect_wkt, TRANSECT_EXTENSIONS)
+        self.transect_5km = extended["5km"]
+        self.transect_4km = extended["4km"]
+        self.transect_4km_inland = extended["4km_inland"]
+        self.transect_6km = extended["6km"]
+        self.transect_10km = extended["10km"]
+        self.transect_100km = extended["100km"]
+        self.transect_200m = extended["200m"]
+        self.transect_100m = extended["100m"]
 
         # TODO add extra meters to the bbox to prevent cases that the bbox is parallel.
         # bboxes of the transect : To cut the DEM
@@ -165,38 +172,28 @@ class CHW:
         
         
         
-        # Get the slope over the 500m inland transect
-        try:
-            cut_wcs(
-                *self.bbox,
-                self.dem_layer,
-                owsurl,
-                self.dem,
-                username=username,
-                password=geoserver_password,
-            )
-            self.elevations, self.segments = get_elevation_profile(
-                dem_path=self.dem,
-                line=change_coords(self.transect_wkt),
-                line_length=change_coords(self.transect_wkt).length,
-                temp_dir=self.tmp,
-            )
-
-            # Mean slope
-            self.slope, self.max_slope = calc_slope(self.elevations, self.segments)
-
-            self.slope = round(self.slope, 1)
-        except:
-            raise Exception(
-                "There are no elevation data in the area, please try another location"
-            )
+        # The elevation profile and the groups of the probe are independent, so
+        # they are fetched concurrently, each group over its own pooled connection.
+        # The elevation of a small island needs the probe, so it runs right after.
+        tasks = {"elevation": (self.get_elevation_info, [])}
+        for i, columns in enumerate(PROBE_GROUPS):
+            tasks[f"probe_{i}"] = (partial(self.probe_columns, columns), [])
+        tasks["probe"] = (merge_probe, [f"probe_{i}" for i in range(len(PROBE_GROUPS))])
+        tasks["island_elevation"] = (self.get_island_elevation, ["probe"])
+        with span("chw.collect"):
+            facts = run_tasks(tasks, max_workers=executor_settings["max_workers"])
+
+        self.dem, self.elevations, self.segments, self.slope, self.max_slope = facts["elevation"]
+        self.probe = facts["probe"]
+        self.median_elevation = facts["island_elevation"]
+        # The connection for the classes and measures is borrowed only after the
+        # collect step. Holding it while the probe groups wait for connections of
+        # their own deadlocks the pool once maxconn classifications run at a time.
+        self.db = DB(user, password, host, db)
 
-        try:
-            self.geology = self.db.get_geology_value(self.transect_wkt)
-        except Exception:
-            self.geology = None
+        self.geology = self.probe.geology
         # Check if intersect with corals 4km in the sea. Important for define geological layout and coral vegetation
-        self.corals = self.db.intersect_with_corals(self.transect_6km) or self.db.intersect_with_corals(self.transect_4km_inland)
+        self.corals = self.probe.corals
         LOGGER.info(f"---Corals vegetation is---: {self.corals}")
         self.geology_material = (
             "unconsolidated"
@@ -206,6 +203,7 @@ class CHW:
         LOGGER.info(f"---geology material is---: {self.geology_material}")
 
     # 1st level check
+    @timed("chw.geological_layout")
     def get_info_geological_layout(self):
         """Priority check of geological layout.
         First corals, then special cases of flat hard rock or sloping hard rock in case that
@@ -214,10 +212,7 @@ class CHW:
         """
         # TODO check_river_mouth
         LOGGER.info(f"---slope, cov_slope_bd, geolory---: {self.slope},{cov_slope_bd},{self.geology}")
-        if (
-            self.db.intersect_with_small_estuaries(self.transect_wkt)
-            or self.db.intersect_with_small_estuaries(self.transect_100m)
-        ) and self.slope <= cov_slope_bd: 
+        if self.probe.small_estuary and self.slope <= cov_slope_bd: 
             self.geological_layout = "River mouth"
 
         elif self.check_coral_islands() is True:
@@ -230,16 +225,13 @@ class CHW:
             self.geological_layout = "Sloping hard rock"
     
         elif (
-            self.db.intersect_with_barriers_sandspits(self.transect_wkt) is True
+            self.probe.barrier_sandspit is True
             and self.geology_material == "unconsolidated"
             and self.slope <= cov_slope_bd):
             self.geological_layout = "Barrier"
 
         elif (
-            (
-                self.db.intersect_with_estuaries(self.transect_100m)
-                or self.db.intersect_with_estuaries(self.transect_wkt)
-            )
+            self.probe.estuary
             and self.geology_material == "unconsolidated"
             and self.slope <= cov_slope_bd):
             self.geological_layout = "Delta/ low estuary island"
@@ -251,6 +243,7 @@ class CHW:
         LOGGER.info(f"---GEOLOGICAL_LAYOUT---: {self.geological_layout}")
 
     # 2nd level check
+    @timed("chw.wave_exposure")
     def get_info_wave_exposure(self):
         """Retrieves the wave exposure values from the database.
 
@@ -260,9 +253,9 @@ class CHW:
         If moderately exposed it can drop to protected(<10 km closest coastline that protects it)
         """
         coastline_id = float(self.transect["properties"]["coastline_id"])
-        closest_coasts_10km = self.db.fetch_closest_coasts(self.transect_10km)
+        closest_coasts_10km = list(self.probe.closest_coasts_10km)
 
-        closest_coasts_100km = self.db.fetch_closest_coasts(self.transect_100km)
+        closest_coasts_100km = list(self.probe.closest_coasts_100km)
 
         # Check if coastline_id is in the list of closest coasts (fix accuracy error that way)
         if coastline_id not in closest_coasts_10km:
@@ -270,9 +263,9 @@ class CHW:
         if coastline_id not in closest_coasts_100km:
             closest_coasts_100km.append(coastline_id)
 
-        try:
-            self.wave_exposure = self.db.get_wave_exposure_value(self.transect_wkt)
-        except Exception:
+        if self.probe.wave_exposure is not None:
+            self.wave_exposure = self.probe.wave_exposure
+        else:
             self.wave_exposure = "moderately exposed"
 
         if self.wave_exposure == "moderately exposed":
@@ -288,14 +281,16 @@ class CHW:
         LOGGER.info(f"---WAVE EXPOSURE---: {self.wave_exposure}")
 
     # 3rd level check
+    @timed("chw.tidal_range")
     def get_info_tidal_range(self):
-        try:
-            self.tidal_range = self.db.get_tidal_range_values(self.transect_wkt)
-        except Exception:
+        if self.probe.tidal_range is not None:
+            self.tidal_range = self.probe.tidal_range
+        else:
             self.tidal_range = "micro"
         LOGGER.info(f"---TIDAL RANGE---: {self.tidal_range}")
 
     # 4th level check
+    @timed("chw.flora_fauna")
     def get_info_flora_fauna(self):
         """
         flora fauna can be:
@@ -304,8 +299,8 @@ class CHW:
 
 
         """
-        mangroves = self.db.intersect_with_mangroves(self.transect_wkt)
-        saltmarshes = self.db.intersect_with_saltmarshes(self.transect_wkt)
+        mangroves = self.probe.mangroves
+        saltmarshes = self.probe.saltmarshes
         LOGGER.info(f"---Saltmarshes, Mangroves---: {saltmarshes}, {mangroves}")
         # Special case of sloping soft rock
         if self.geological_layout == "Sloping soft rock":
@@ -358,48 +353,43 @@ class CHW:
         LOGGER.info(f"---FLORA FAUNA---: {self.flora_fauna}")
 
     # 5th level check
+    @timed("chw.sediment_balance")
     def get_info_sediment_balance(self):
         """For the cases of flat hard rock and sloping hard rock the sediment balance is estimated by the presence or not of a beach
         Sediment balance can be surplus when the shoreline change is medium or high and when the change rate is >0.5.
         Surplus only when seawards (see documentation)"""
         # TODO perhaps write it more clear.
         if self.geological_layout in {"Flat hard rock", "Sloping hard rock"}:
-            beach = False
-            try:
-                if (self.db.intersect_with_osm_beaches(self.transect_wkt)) or (
-                    self.db.intersect_with_osm_beaches(self.transect_200m)
-                ):
-                    beach = True
-                if beach is True:
-                    self.sediment_balance = "Beach"
-                elif beach is False:
-                    self.sediment_balance = "No Beach"
-            except Exception:
+            if self.probe.beach is True:
+                self.sediment_balance = "Beach"
+            else:
                 self.sediment_balance = "No Beach"
 
         else:
-            try:
-                if (
-                    self.db.get_shorelinechange_values(self.transect_wkt) != "Low"
-                    and self.db.get_sediment_changerate_values(self.transect_wkt) > 0.5
-                ):
-                    self.sediment_balance = "Surplus"
-            except Exception:
-                # NOTE According to documentation of CHW, if doubts regarding the sediment balance,
-                # then always choose balance/deficit as it is the default.
+            # NOTE According to documentation of CHW, if doubts regarding the sediment balance,
+            # then always choose balance/deficit as it is the default.
+            if (
+                self.probe.sediment_changerate is not None
+                and self.probe.shoreline_change != "Low"
+                and self.probe.sediment_changerate > 0.5
+            ):
+                self.sediment_balance = "Surplus"
+            else:
                 self.sediment_balance = "Balance/Deficit"
         LOGGER.info(f"---SEDIMENT BALANCE---: {self.sediment_balance}")
 
     # 6th level check
+    @timed("chw.storm_climate")
     def get_info_storm_climate(self):
-        """Get cyclone risk value from db"""
+        """Get cyclone risk value from the probe"""
 
-        try:
-            self.storm_climate = self.db.get_cyclone_risk(self.transect_wkt)
-        except Exception:
+        if self.probe.cyclone_risk is not None:
+            self.storm_climate = self.probe.cyclone_risk
+        else:
             self.storm_climate = "No"
         LOGGER.info(f"---STROM CLIMATE---: {self.storm_climate}")
 
+    @timed("chw.get_classes")
     def hazards_classification(self):
 
         try:
@@ -411,7 +401,7 @@ class CHW:
                 self.salt_water_intrusion,
                 self.erosion,
                 self.flooding,
-            ) = self.db.get_classes(
+            ) = get_decision_wheel(self.db).get_classes(
                 self.geological_layout,
                 self.wave_exposure,
                 self.tidal_range,
@@ -430,16 +420,11 @@ class CHW:
             f"-- Database result {self.ecosystem_disruption}, {self.gradual_inundation}, {self.gradual_inundation}, {self.erosion}, {self.flooding}"
         )
 
+    @timed("chw.get_measures")
     def provide_measures(self):
 
-        measures = {}
         try:
-            for row in self.db.get_measures(self.code):
-                measures.update(
-                    {
-                        row[0]: row[1],
-                    }
-                )
+            measures = get_measures_catalogue(self.db).get_measures(self.code)
 
             self.ecosystem_disruption_measures = measures["Ecosystem disruption"]
             self.gradual_inundation_measures = measures["Gradual inundation"]
@@ -453,10 +438,12 @@ class CHW:
             self.erosion_measures = ["No measures were found"]
             self.flooding_measures = ["No measures were found"]
 
+    @timed("chw.risk_info")
     def get_risk_info(self):
         try:
-            self.gar, self.population = self.db.get_gar_pop_values(self.transect_wkt)
-        except Exception:
+            self.gar = int(float(self.probe.gar))
+            self.population = int(float(self.probe.population))
+        except (TypeError, ValueError):
             self.gar, self.population = "No data", "No data"
 
     def check_geology_type(self) -> str:
@@ -496,6 +483,7 @@ class CHW:
             LOGGER.info(f"---Special case hard rock---: sloping hr")
             return "Sloping hard rock" 
 
+    @timed("chw.vegetation")
     def get_vegetation(self):
         """
         In that case vegetation values can be:
@@ -511,7 +499,7 @@ class CHW:
 
         LOGGER.info(f"---SLOPE 200 m inland--- bnd = 60: {slope}")
 
-        cut_wcs(
+        globcover = cut_wcs(
             *self.bbox,
             landuse_layer,
             owsurl,
@@ -519,7 +507,10 @@ class CHW:
             username=username,
             password=geoserver_password,
         )
-        values = read_raster_values(self.globcover)
+        try:
+            values = read_raster_values(globcover)
+        finally:
+            close_raster(globcover)
 
         snow_ice = np.count_nonzero(values == 220)
         bare_areas = np.count_nonzero(values == 200)
@@ -540,9 +531,7 @@ class CHW:
         """
         Procedure:
         if intersects with small_island (500m transect)
-            get land polygon geojson of the transect 500m
-            get bounds of it
-            cut wcs with the bounds of the land polygon
+            the median elevation of its land polygon (see get_island_elevation)
           
             
         In order to be classified as coral island all the following statements should be true:
@@ -553,23 +542,8 @@ class CHW:
             Boolean
         """
 
-        if self.db.intersect_with_small_island(self.transect_wkt):
-            land_polygon = self.db.get_land_polygon(self.transect_wkt)
-            small_island_bbox = get_bounds(land_polygon)
-            try:
-
-                cut_wcs(
-                    *small_island_bbox,
-                    self.dem_layer,
-                    owsurl,
-                    self.dem_small_island,
-                    username=username,
-                    password=geoserver_password,
-                )
-                self.median_elevation = calc_median_elevation(self.dem_small_island, land_polygon)
-                LOGGER.info(f"---MEDIAN ELEVATION OF ISLAND---: {self.median_elevation}")
-            except Exception:
-                self.median_elevation = 0
+        if self.probe.small_island and self.median_elevation is not None:
+            LOGGER.info(f"---MEDIAN ELEVATION OF ISLAND---: {self.median_elevation}")
             
             #if(self.corals is True and self.median_elevation < 8 and self.slope < 4): #TODO if we increase to 8 add an extra check of the slope 500 m line smaller than 2.2
             LOGGER.info(f"---MEDIAN ELEVATION OF ISLAND < {cov_elev_ci}---: {self.median_elevation}")
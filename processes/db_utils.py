@@ -26,25 +26,785 @@
 # Sign up to recieve regular updates of this function, and to contribute
 # your own tools.
 
-from .utils import read_config
+from .index_utils import get_coastline_index
+from .metrics_utils import count, register_gauges, span
+from .utils import read_config, read_section_config
 import psycopg2
-from typing import List
+import psycopg2.errors
+from psycopg2 import sql
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_UNKNOWN,
+    connection as Connection,
+)
+from psycopg2.pool import PoolError
+from shapely import wkb, wkt as shapely_wkt
+from typing import List, NamedTuple, Optional
 import geojson
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Defaults for the optional [Pool] section of configuration.txt
+POOL_DEFAULTS = {
+    "minconn": 1,
+    "maxconn": 10,
+    "timeout": 30.0,
+    "max_idle": 300.0,
+    "health_check_interval": 30.0,
+}
+
+
+class PoolTimeout(PoolError):
+    """Raised when no connection becomes available within the pool timeout"""
+
+
+class PreparedConnection(Connection):
+    """Connection that keeps track of its server-side prepared statements,
+    see DB.execute"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def wkb_param(wkt):
+    """Geometry parameter of a prepared statement, sent as WKB instead of WKT text
+
+    Args:
+        wkt: geometry as wkt, or None
+    Returns:
+        psycopg2 Binary, use with ST_GeomFromWKB
+    """
+    if wkt is None:
+        return None
+    return psycopg2.Binary(wkb.dumps(shapely_wkt.loads(wkt)))
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PostGIS connections.
+
+    Connections are opened lazily up to maxconn. When all of them are borrowed,
+    getconn blocks until one is returned or the timeout expires. Connections that
+    were idle longer than health_check_interval are pinged before they are handed
+    out, and idle connections above minconn are closed after max_idle seconds.
+    """
+
+    def __init__(
+        self,
+        minconn=1,
+        maxconn=10,
+        timeout=30.0,
+        max_idle=300.0,
+        health_check_interval=30.0,
+        **connect_kwargs,
+    ):
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: minconn={minconn}, maxconn={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self._connect_kwargs = connect_kwargs
+
+        self._condition = threading.Condition(threading.Lock())
+        self._idle = []  # (connection, returned at) pairs, most recent last
+        self._in_use = set()
+        self._size = 0
+        self._counters = {
+            "created": 0,
+            "discarded": 0,
+            "borrowed": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "failed_health_checks": 0,
+        }
+
+    def _connect(self):
+        connection = psycopg2.connect(**self._connect_kwargs)
+        with self._condition:
+            self._counters["created"] += 1
+        return connection
+
+    def _discard(self, connection):
+        """Closes a connection that is not in the pool anymore. Lock must be held."""
+        self._size -= 1
+        self._counters["discarded"] += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+        self._condition.notify()
+
+    @staticmethod
+    def _ping(connection) -> bool:
+        if connection.closed:
+            return False
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            connection.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _trim_idle(self):
+        """Closes connections idle longer than max_idle, keeping minconn. Lock must be held."""
+        now = time.monotonic()
+        while (
+            self._idle
+            and self._size > self.minconn
+            and now - self._idle[0][1] > self.max_idle
+        ):
+            connection, _ = self._idle.pop(0)
+            self._discard(connection)
+
+    def getconn(self, timeout=None):
+        """Borrows a connection, waiting at most timeout seconds (pool default if None)"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        connection = None
+        idle_since = None
+        with self._condition:
+            self._trim_idle()
+            waited = False
+            while True:
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {timeout} s "
+                        f"({self.maxconn} connections in use)"
+                    )
+                if not waited:
+                    self._counters["waits"] += 1
+                    waited = True
+                self._condition.wait(remaining)
+
+        if connection is not None and (
+            connection.closed
+            or time.monotonic() - idle_since > self.health_check_interval
+        ):
+            if not self._ping(connection):
+                LOGGER.info("Discarding broken database connection from the pool")
+                with self._condition:
+                    self._counters["failed_health_checks"] += 1
+                    self._discard(connection)
+                    self._size += 1  # the slot is reused for a new connection
+                connection = None
+
+        if connection is None:
+            try:
+                connection = self._connect()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+
+        with self._condition:
+            self._in_use.add(connection)
+            self._counters["borrowed"] += 1
+        return connection
+
+    def putconn(self, connection, close=False):
+        """Returns a borrowed connection. Open transactions are rolled back."""
+        with self._condition:
+            if connection not in self._in_use:
+                raise PoolError("Trying to return a connection that is not borrowed")
+            self._in_use.discard(connection)
+
+        if not close and not connection.closed:
+            status = connection.info.transaction_status
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except Exception:
+                    close = True
+
+        with self._condition:
+            if close or connection.closed:
+                self._discard(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+                self._condition.notify()
+
+    def check_health(self) -> dict:
+        """Pings all idle connections and drops the broken ones
+
+        Returns:
+            dict: number of healthy and dropped idle connections
+        """
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._in_use.update(connection for connection, _ in idle)
+        healthy = dropped = 0
+        for connection, _ in idle:
+            if self._ping(connection):
+                healthy += 1
+                self.putconn(connection)
+            else:
+                dropped += 1
+                with self._condition:
+                    self._counters["failed_health_checks"] += 1
+                self.putconn(connection, close=True)
+        return {"healthy": healthy, "dropped": dropped}
+
+    def stats(self) -> dict:
+        """Occupancy of the pool and its lifetime counters"""
+        with self._condition:
+            stats = {
+                "size": self._size,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "maxconn": self.maxconn,
+            }
+            stats.update(self._counters)
+        return stats
+
+    def closeall(self):
+        with self._condition:
+            while self._idle:
+                connection, _ = self._idle.pop()
+                self._discard(connection)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_connection_pool(user, password, host, db) -> ConnectionPool:
+    """Returns the process-wide connection pool for the given database.
+    The pool is sized by the [Pool] section of configuration.txt."""
+    key = (user, host, db)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ConnectionPool(
+                **read_section_config("Pool", POOL_DEFAULTS),
+                user=user,
+                password=password,
+                host=host,
+                database=db,
+                connection_factory=PreparedConnection,
+            )
+            _pools[key] = pool
+    return pool
+
+
+def get_pool_stats() -> dict:
+    """Stats of every connection pool in this process, keyed by host/database"""
+    with _pools_lock:
+        pools = dict(_pools)
+    return {f"{host}/{db}": pool.stats() for (_, host, db), pool in pools.items()}
+
+
+def _reset_pools_after_fork():
+    """Async requests run in forked processes, which must not share the sockets
+    of the parent. The inherited pools are dropped without closing them, as
+    closing would end the sessions of the parent too."""
+    global _pools_lock
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_pools_after_fork)
+register_gauges("db_pool", get_pool_stats)
+
+
+class TransectProbe(NamedTuple):
+    """Snapshot of every feature check of a transect, see DB.probe_transect"""
+
+    small_estuary: bool  # transect or 100 m in the sea intersects an estuary < 50 km2
+    estuary: bool  # transect or 100 m in the sea intersects an estuary > 50 km2
+    barrier_sandspit: bool
+    corals: bool  # 6 km in the sea (or 4 km inland) intersects corals
+    mangroves: bool
+    saltmarshes: bool
+    beach: bool  # transect or 200 m in the sea intersects an osm beach
+    small_island: bool
+    geology: Optional[str]
+    wave_exposure: Optional[str]
+    tidal_range: Optional[str]
+    shoreline_change: Optional[str]
+    sediment_changerate: Optional[float]
+    cyclone_risk: Optional[str]
+    gar: Optional[float]
+    population: Optional[float]
+    closest_coasts_10km: List[int]
+    closest_coasts_100km: List[int]
+
+
+# Defaults for the optional [Nearest] section of configuration.txt
+NEAREST_DEFAULTS = {
+    # knn: GiST KNN ordering (<->) of a few candidates, refined by exact distance
+    # dwithin: every row within the distance, sorted by exact distance
+    "mode": "knn",
+    # rows taken from the KNN ordering before the exact refinement
+    "candidates": 10,
+}
+nearest_settings = read_section_config("Nearest", NEAREST_DEFAULTS)
+
+
+def nearest_sql(
+    columns, table, geom, target, dist, where=None, mode=None, candidates=None
+) -> str:
+    """SQL of the row of table nearest to target within dist, see [Nearest]
+
+    Both modes give the same row: the KNN candidates are filtered with ST_DWithin
+    and ordered by ST_Distance like the dwithin query, and since PostGIS 2.2
+    <-> orders by the exact distance, so the nearest row is always a candidate.
+
+    Args:
+        columns: selected columns, e.g. "tot_val, tot_pob"
+        table: schema.table
+        geom: geometry column of the table
+        target: SQL expression of the geometry to search from
+        dist: SQL expression of the search distance, in units of the crs
+        where: optional extra condition on the rows
+        mode: knn or dwithin, defaults to the configured mode
+        candidates: number of KNN candidates, defaults to the configured number
+    """
+    mode = mode or nearest_settings["mode"]
+    candidates = candidates or nearest_settings["candidates"]
+    if mode == "knn":
+        return f"""SELECT {columns} FROM (
+                        SELECT {columns}, {geom} AS nearest_geom FROM {table}
+                        {f"WHERE {where}" if where else ""}
+                        ORDER BY {geom} <-> {target} LIMIT {int(candidates)}) AS candidates
+                    WHERE ST_DWithin(nearest_geom, {target}, {dist})
+                    ORDER BY ST_Distance(nearest_geom, {target}) LIMIT 1"""
+    if mode == "dwithin":
+        return f"""SELECT {columns} FROM {table}
+                    WHERE ST_DWithin({geom}, {target}, {dist})
+                        {f"AND {where}" if where else ""}
+                    ORDER BY ST_Distance({geom}, {target}) LIMIT 1"""
+    raise ValueError(f"Unknown nearest mode: {mode}")
+
+
+# The transects of a probe, columns refer to them as t.<name>
+PROBE_QUERY = """WITH t AS (
+                    SELECT ST_GeomFromWKB($1, $8) AS transect,
+                        ST_GeomFromWKB($2, $8) AS transect_100m,
+                        ST_GeomFromWKB($3, $8) AS transect_200m,
+                        ST_GeomFromWKB($4, $8) AS transect_6km,
+                        ST_GeomFromWKB($5, $8) AS transect_10km,
+                        ST_GeomFromWKB($6, $8) AS transect_100km,
+                        ST_GeomFromWKB($7, $8) AS transect_4km_inland,
+                        ST_Transform(ST_GeomFromWKB($1, $8), 3857) AS transect_3857
+                )
+                SELECT {columns}
+                FROM t;"""
+
+# The same for many transects in one statement: the transects are passed as arrays
+# and unnested into rows (a VALUES list that can be prepared once), i numbers them
+PROBE_BATCH_QUERY = """WITH t AS (
+                    SELECT v.i,
+                        ST_GeomFromWKB(v.transect, $9) AS transect,
+                        ST_GeomFromWKB(v.transect_100m, $9) AS transect_100m,
+                        ST_GeomFromWKB(v.transect_200m, $9) AS transect_200m,
+                        ST_GeomFromWKB(v.transect_6km, $9) AS transect_6km,
+                        ST_GeomFromWKB(v.transect_10km, $9) AS transect_10km,
+                        ST_GeomFromWKB(v.transect_100km, $9) AS transect_100km,
+                        ST_GeomFromWKB(v.transect_4km_inland, $9) AS transect_4km_inland,
+                        ST_Transform(ST_GeomFromWKB(v.transect, $9), 3857) AS transect_3857
+                    FROM unnest($1, $2, $3, $4, $5, $6, $7, $8) AS v(
+                        i, transect, transect_100m, transect_200m, transect_6km,
+                        transect_10km, transect_100km, transect_4km_inland)
+                )
+                SELECT t.i, {columns}
+                FROM t
+                ORDER BY t.i;"""
+
+
+def probe_columns(mode=None) -> dict:
+    """Builds the SQL expressions of the fields of TransectProbe
+
+    Args:
+        mode: nearest mode, see nearest_sql
+    """
+
+    def nearest(columns, table, geom, target, dist, where=None):
+        return "(" + nearest_sql(columns, table, geom, target, dist, where, mode) + ")"
+
+    return {
+        "small_estuary": """EXISTS(SELECT 1 FROM coast.estuaries
+                               WHERE ST_Intersects(geom, t.transect) and area_km2 < 50)
+                        OR EXISTS(SELECT 1 FROM coast.estuaries
+                                  WHERE ST_Intersects(geom, t.transect_100m) and area_km2 < 50)""",
+        "estuary": """EXISTS(SELECT 1 FROM coast.estuaries
+                               WHERE ST_Intersects(geom, t.transect) and area_km2 > 50)
+                        OR EXISTS(SELECT 1 FROM coast.estuaries
+                                  WHERE ST_Intersects(geom, t.transect_100m) and area_km2 > 50)""",
+        "barrier_sandspit": """EXISTS(SELECT 1 FROM coast.barriers_sandspits
+                               WHERE ST_Intersects(geom, t.transect))""",
+        "corals": """EXISTS(SELECT 1 FROM vegetation.corals
+                               WHERE ST_Intersects(geom, t.transect_6km))
+                        OR EXISTS(SELECT 1 FROM vegetation.corals
+                                  WHERE ST_Intersects(geom, t.transect_4km_inland))""",
+        "mangroves": """EXISTS(SELECT 1 FROM vegetation.mangroves
+                               WHERE ST_Intersects(geom, t.transect))""",
+        "saltmarshes": """EXISTS(SELECT 1 FROM vegetation.saltmarshes
+                               WHERE ST_Intersects(geom, t.transect))""",
+        "beach": """EXISTS(SELECT 1 FROM coast.osm_beach
+                               WHERE ST_Intersects(geom, t.transect))
+                        OR EXISTS(SELECT 1 FROM coast.osm_beach
+                                  WHERE ST_Intersects(geom, t.transect_200m))""",
+        "small_island": """EXISTS(SELECT 1 FROM coast.usgs_islands
+                               WHERE ST_Intersects(wkb_geometry, t.transect) and islandarea < 25)""",
+        "geology": f"""CASE
+                        WHEN EXISTS(SELECT 1 FROM geollayout.fluvisols
+                                    WHERE ST_Intersects(geom, t.transect))
+                        THEN 'fluvisol'
+                        ELSE {nearest("xx", "geollayout.glim", "shape", "t.transect_3857", 25000, "xx NOT IN ('wb', 'nd')")}
+                    END""",
+        "wave_exposure": nearest("ts_exposure", "ocean.wave_exposure", "geom", "t.transect", 1.5),
+        "tidal_range": nearest("exposure", "ocean.tidal_range", "geom", "t.transect", 1.5),
+        "shoreline_change": nearest("change", "coast.shorelinechange", "geom", "t.transect", 1),
+        "sediment_changerate": nearest("changerate", "coast.sediment", "geom", "t.transect", 1),
+        "cyclone_risk": nearest("bcyclone", "ocean.diva_points_with_cyclone_risk", "geom", "t.transect", 1),
+        "gar": nearest("tot_val", "gar.gar", "wkb_geometry", "t.transect", 1),
+        "population": nearest("tot_pob", "gar.gar", "wkb_geometry", "t.transect", 1),
+        "closest_coasts_10km": """ARRAY(SELECT gid FROM coast.osm_segment500m
+                              WHERE ST_Intersects(geom, t.transect_10km))""",
+        "closest_coasts_100km": """ARRAY(SELECT gid FROM coast.osm_segment500m
+                              WHERE ST_Intersects(geom, t.transect_100km))""",
+    }
+
+
+# SQL expression of every field of TransectProbe
+PROBE_COLUMNS = probe_columns()
+
+# Order of the rows of chw.decision_wheel, so the first matching row is always the
+# same one, in the database (DB.get_classes) and in memory (DecisionWheel)
+DECISION_WHEEL_ORDER = """code, geological_layout, wave_exposure, tidal_range, flora_fauna,
+                        sediment_balance, storm_climate"""
+
+# Version stamp of the data layers, bumped by the data loads (sql/data_version.sql)
+DATA_VERSION_QUERY = "SELECT version::text FROM chw.data_version;"
 
 
 class DB:
+    """Database helper. Borrows a connection from the process-wide pool and gives
+    it back on close_db_connection, at the end of a with block or when collected."""
+
     def __init__(self, user, password, host, db):
         self.user = user
         self.password = password
         self.host = host
         self.db = db
-        self.connection = psycopg2.connect(
-            user=self.user, password=self.password, host=self.host, database=self.db
-        )
+        self.connection = None
+        self.pool = get_connection_pool(user, password, host, db)
+        self.connection = self.pool.getconn()
 
     def close_db_connection(self):
-        self.connection.close()
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.pool.putconn(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_db_connection()
+
+    def __del__(self):
+        try:
+            self.close_db_connection()
+        except Exception:
+            pass
+
+    def execute(self, name, query, types, params):
+        """Executes a query as a server-side prepared statement. The statement is
+        prepared, so parsed and planned, once per connection and reused after that.
+
+        Args:
+            name: name of the statement, unique per query
+            query: SQL with the parameters as $1, $2, ...
+            types: SQL types of the parameters, geometries are bytea (see wkb_param)
+            params: values of the parameters
+
+        Returns:
+            cursor with the result, close it after fetching
+        """
+        statement = f"chw_{name}"
+        prepare = f"PREPARE {statement}"
+        execute = f"EXECUTE {statement}"
+        if params:
+            prepare += f" ({', '.join(types)})"
+            execute += f" ({', '.join(['%s'] * len(params))})"
+        prepare += f" AS {query}"
+        count("db.queries")
+        with span(f"db.{name}"):
+            cursor = self.connection.cursor()
+            if statement not in self.connection.prepared:
+                cursor.execute(prepare)
+                self.connection.prepared.add(statement)
+            try:
+                cursor.execute(execute, params)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # the session lost its statements (e.g. DISCARD ALL), prepare it again
+                self.connection.rollback()
+                cursor.execute(prepare)
+                cursor.execute(execute, params)
+        return cursor
+
+    def probe_transect(
+        self,
+        transect,
+        transect_100m,
+        transect_200m,
+        transect_6km,
+        transect_10km,
+        transect_100km,
+        transect_4km_inland=None,
+        crs=4326,
+    ) -> TransectProbe:
+        """Runs all the intersection checks and nearest value lookups of the CHW
+        level checks for a transect in one statement.
+
+        The subqueries are the same as the ones of the single-purpose methods
+        (intersect_with_*, get_*_value(s), fetch_closest_coasts, get_geology_value).
+        Lookups that find nothing return None instead of raising.
+
+        Args:
+            transect: 500 m transect, start point on the coast
+            transect_100m, transect_200m, transect_6km, transect_10km, transect_100km:
+                extensions of the transect in the sea
+            transect_4km_inland: optional extension inland, also checked for corals
+            crs: crs of the transects. Defaults to 4326.
+
+        Returns:
+            TransectProbe
+        """
+        return TransectProbe(
+            **self.probe_transect_columns(
+                TransectProbe._fields,
+                transect,
+                transect_100m,
+                transect_200m,
+                transect_6km,
+                transect_10km,
+                transect_100km,
+                transect_4km_inland=transect_4km_inland,
+                crs=crs,
+            )
+        )
+
+    def probe_transect_columns(
+        self,
+        columns,
+        transect,
+        transect_100m,
+        transect_200m,
+        transect_6km,
+        transect_10km,
+        transect_100km,
+        transect_4km_inland=None,
+        crs=4326,
+    ) -> dict:
+        """Same as probe_transect for a subset of the fields of TransectProbe,
+        so the probe can be split over several connections.
+
+        Returns:
+            dict column -> value
+        """
+        query = PROBE_QUERY.format(
+            columns=",\n".join(
+                f"{PROBE_COLUMNS[column]} AS {column}" for column in columns
+            )
+        )
+        transects = (
+            transect,
+            transect_100m,
+            transect_200m,
+            transect_6km,
+            transect_10km,
+            transect_100km,
+            transect_4km_inland,
+        )
+        # one prepared statement per group of columns
+        name = "probe_" + hashlib.md5(query.encode()).hexdigest()[:12]
+        with self.connection:
+            cursor = self.execute(
+                name,
+                query,
+                ("bytea",) * 7 + ("integer",),
+                tuple(wkb_param(wkt) for wkt in transects) + (crs,),
+            )
+            row = cursor.fetchone()
+            cursor.close()
+        return dict(zip(columns, row))
+
+    def probe_transects_columns(self, columns, transects, crs=4326) -> list:
+        """Set-based probe_transect_columns: probes many transects in one query
+
+        Args:
+            columns: fields of TransectProbe to fetch
+            transects: per transect a tuple of the transect, transect_100m,
+                transect_200m, transect_6km, transect_10km, transect_100km and
+                transect_4km_inland (may be None) as wkt
+        Returns:
+            list of dict column -> value, in the order of transects
+        """
+        query = PROBE_BATCH_QUERY.format(
+            columns=",\n".join(
+                f"{PROBE_COLUMNS[column]} AS {column}" for column in columns
+            )
+        )
+        arrays = [list(range(len(transects)))]
+        for k in range(7):
+            values = [wkb_param(transect[k]) for transect in transects]
+            # ARRAY[NULL, ...] would be text[], a NULL array unnests to NULLs too
+            arrays.append(values if any(v is not None for v in values) else None)
+        name = "probe_batch_" + hashlib.md5(query.encode()).hexdigest()[:12]
+        with self.connection:
+            cursor = self.execute(
+                name,
+                query,
+                ("integer[]",) + ("bytea[]",) * 7 + ("integer",),
+                tuple(arrays) + (crs,),
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+        return [dict(zip(columns, row[1:])) for row in rows]
+
+    def get_data_version(self) -> str:
+        """Version of the data layers: the stamp in chw.data_version that every
+        data load bumps (see sql/data_version.sql)
+
+        Returns:
+            the version as text
+        """
+        with self.connection:
+            cursor = self.execute("get_data_version", DATA_VERSION_QUERY, (), ())
+            row = cursor.fetchone()
+            cursor.close()
+        if row is None:
+            raise ValueError("chw.data_version is empty, see sql/data_version.sql")
+        return row[0]
+
+    def get_coastline_segment(self, gid) -> str:
+        """coast.osm_segment500m
+        Args:
+            gid: id of the segment
+
+        Returns:
+            the segment as wkt, None if it does not exist
+        """
+        query = "SELECT ST_AsText(geom) FROM coast.osm_segment500m WHERE gid = $1;"
+        with self.connection:
+            cursor = self.execute("get_coastline_segment", query, ("integer",), (gid,))
+            row = cursor.fetchone()
+            cursor.close()
+        return row[0] if row else None
+
+    def list_segments_to_precompute(self, data_version, bbox=None, retry_errors=False) -> List[int]:
+        """Segments of coast.osm_segment500m without a precomputed classification
+        for the given data version
+
+        Args:
+            data_version: see get_data_version
+            bbox: optional (xmin, ymin, xmax, ymax) in EPSG:4326
+            retry_errors: also return the segments that failed before
+
+        Returns:
+            list of gids
+        """
+        query = """SELECT s.gid FROM coast.osm_segment500m s
+                   LEFT JOIN chw.precomputed_classification p
+                   ON p.segment_gid = s.gid AND p.data_version = %(data_version)s
+                   WHERE (p.segment_gid IS NULL OR (%(retry_errors)s AND p.error IS NOT NULL))"""
+        params = {"data_version": data_version, "retry_errors": retry_errors}
+        if bbox is not None:
+            query += " AND s.geom && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326)"
+            params.update(zip(("xmin", "ymin", "xmax", "ymax"), bbox))
+        query += " ORDER BY s.gid;"
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(query, params)
+            gids = [row[0] for row in cursor.fetchall()]
+            cursor.close()
+        return gids
+
+    def get_precomputed_classification(self, gid, data_version) -> Optional[dict]:
+        """chw.precomputed_classification
+        Args:
+            gid: id of the coastline segment
+            data_version: see get_data_version
+
+        Returns:
+            dict with transect (wkt), notification, output and error,
+            None if the segment has no classification for this data version
+        """
+        query = """SELECT ST_AsText(transect), notification, output, error
+                   FROM chw.precomputed_classification
+                   WHERE segment_gid = $1 AND data_version = $2;"""
+        with self.connection:
+            cursor = self.execute(
+                "get_precomputed_classification",
+                query,
+                ("integer", "text"),
+                (gid, data_version),
+            )
+            row = cursor.fetchone()
+            cursor.close()
+        if row is None:
+            return None
+        return dict(zip(("transect", "notification", "output", "error"), row))
+
+    def save_precomputed_classification(
+        self, gid, transect, notification, data_version, output=None, error=None
+    ):
+        """Inserts or replaces the classification of a coastline segment in
+        chw.precomputed_classification
+
+        Args:
+            gid: id of the coastline segment
+            transect: canonical transect as wkt
+            notification: notification of the transect
+            data_version: see get_data_version
+            output: output of write_output, None if the classification failed
+            error: error message if the classification failed
+        """
+        query = """INSERT INTO chw.precomputed_classification
+                   (segment_gid, transect, notification, data_version, output, error)
+                   VALUES (%(gid)s, ST_GeomFromText(%(transect)s, 4326), %(notification)s,
+                           %(data_version)s, %(output)s, %(error)s)
+                   ON CONFLICT (segment_gid) DO UPDATE SET
+                   transect = EXCLUDED.transect,
+                   notification = EXCLUDED.notification,
+                   data_version = EXCLUDED.data_version,
+                   output = EXCLUDED.output,
+                   error = EXCLUDED.error,
+                   computed_at = now();"""
+        params = {
+            "gid": gid,
+            "transect": transect,
+            "notification": notification,
+            "data_version": data_version,
+            "output": None if output is None else json.dumps(output),
+            "error": error,
+        }
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(query, params)
+            cursor.close()
 
     def intersect_with_estuaries(self, wkt, crs=4326) -> bool:
         """coast.estuaries
@@ -57,14 +817,18 @@ class DB:
             bool: True if intersects, false if not
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM coast.estuaries
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs})) and area_km2 > 50
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2)) and area_km2 > 50
                 )"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_estuaries",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             estuaries = cursor.fetchone()[0]
             cursor.close()
 
@@ -81,15 +845,19 @@ class DB:
             bool: True if intersects, false if not
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM coast.estuaries
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs})) and area_km2 < 50
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2)) and area_km2 < 50
                 )"""
 
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_small_estuaries",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             estuaries = cursor.fetchone()[0]
             cursor.close()
         return estuaries
@@ -105,14 +873,18 @@ class DB:
             bool: True if intersects, false if not
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM vegetation.corals
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))
                 )"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_corals",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             corals = cursor.fetchone()[0]
             cursor.close()
         return corals
@@ -128,14 +900,18 @@ class DB:
             bool:
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM vegetation.mangroves
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))
                 )"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_mangroves",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             mangroves = cursor.fetchone()[0]
             cursor.close()
         return mangroves
@@ -152,14 +928,18 @@ class DB:
             Any:
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM vegetation.saltmarshes
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))
                 )"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_saltmarshes",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             saltmarshes = cursor.fetchone()[0]
             cursor.close()
         return saltmarshes
@@ -172,16 +952,20 @@ class DB:
             Protected
         """
 
-        query = f"""SELECT ts_exposure
-                    FROM ocean.wave_exposure 
-                    WHERE ST_DWithin(geom, 
-                        ST_GeomFromText(\'{wkt}\', {crs}), {dist}) 
-                    ORDER BY ST_Distance(geom, 
-                                        ST_GeomFromText(\'{wkt}\', {crs})) 
-                    LIMIT 1;"""
+        query = nearest_sql(
+            "ts_exposure",
+            "ocean.wave_exposure",
+            "geom",
+            "ST_GeomFromWKB($1, $2)",
+            "$3",
+        )
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_wave_exposure_value_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             wave_exposure = cursor.fetchone()[0]
             cursor.close()
         return wave_exposure
@@ -195,16 +979,20 @@ class DB:
 
         """
 
-        query = f"""SELECT exposure
-                    FROM ocean.tidal_range 
-                    WHERE ST_DWithin(geom, 
-                        ST_GeomFromText(\'{wkt}\', {crs}), {dist}) 
-                    ORDER BY ST_Distance(geom, 
-                                        ST_GeomFromText(\'{wkt}\', {crs})) 
-                    LIMIT 1;"""
+        query = nearest_sql(
+            "exposure",
+            "ocean.tidal_range",
+            "geom",
+            "ST_GeomFromWKB($1, $2)",
+            "$3",
+        )
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_tidal_range_values_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             tidal_range = cursor.fetchone()[0]
             cursor.close()
         return tidal_range
@@ -215,20 +1003,24 @@ class DB:
         float
         """
 
-        query = f"""SELECT changerate
-                    FROM coast.sediment 
-                    WHERE ST_DWithin(geom, 
-                        ST_GeomFromText(\'{wkt}\', {crs}), {dist}) 
-                    ORDER BY ST_Distance(geom, 
-                                        ST_GeomFromText(\'{wkt}\', {crs})) 
-                    LIMIT 1;"""
-        cursor = self.connection.cursor()
+        query = nearest_sql(
+            "changerate",
+            "coast.sediment",
+            "geom",
+            "ST_GeomFromWKB($1, $2)",
+            "$3",
+        )
         try:
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_sediment_changerate_values_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             change_rate = cursor.fetchone()[0]
+            cursor.close()
         except Exception:
             change_rate = None
-        cursor.close()
         return change_rate
 
     def get_shorelinechange_values(self, wkt, crs=4326, dist=1):
@@ -237,21 +1029,25 @@ class DB:
         float
         """
 
-        query = f"""SELECT change
-                    FROM coast.shorelinechange 
-                    WHERE ST_DWithin(geom, 
-                        ST_GeomFromText(\'{wkt}\', {crs}), {dist}) 
-                    ORDER BY ST_Distance(geom, 
-                                        ST_GeomFromText(\'{wkt}\', {crs})) 
-                    LIMIT 1;"""
+        query = nearest_sql(
+            "change",
+            "coast.shorelinechange",
+            "geom",
+            "ST_GeomFromWKB($1, $2)",
+            "$3",
+        )
 
-        cursor = self.connection.cursor()
         try:
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_shorelinechange_values_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             change = cursor.fetchone()[0]
+            cursor.close()
         except Exception:
             change = None
-        cursor.close()
         return change
 
     def get_cyclone_risk(self, wkt, crs=4326, dist=1):
@@ -261,16 +1057,20 @@ class DB:
         No
         """
 
-        query = f"""SELECT bcyclone
-                    FROM ocean.diva_points_with_cyclone_risk 
-                    WHERE ST_DWithin(geom, 
-                        ST_GeomFromText(\'{wkt}\', {crs}), {dist}) 
-                    ORDER BY ST_Distance(geom, 
-                                        ST_GeomFromText(\'{wkt}\', {crs})) 
-                    LIMIT 1;"""
+        query = nearest_sql(
+            "bcyclone",
+            "ocean.diva_points_with_cyclone_risk",
+            "geom",
+            "ST_GeomFromWKB($1, $2)",
+            "$3",
+        )
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_cyclone_risk_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             cyclone_risk = cursor.fetchone()[0]
             cursor.close()
         return cyclone_risk
@@ -286,13 +1086,24 @@ class DB:
         Returns:
             coast line ids
         """
+        index = get_coastline_index()
+        if index is not None:
+            try:
+                return index.fetch_closest_coasts(wkt, self.load_coastline_segments)
+            except Exception as e:
+                LOGGER.info(f"Coastline index failed, falling back to the database: {e}")
+
         # extend line for searching for closest coasts
-        query = f"""SELECT gid
+        query = """SELECT gid
                 FROM coast.osm_segment500m
-                WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))"""  # LINESTRING wkt
+                WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))"""  # LINESTRING wkt
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "fetch_closest_coasts",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             # coast_lines = cursor.fetchall()
             coast_lines = [r[0] for r in cursor.fetchall()]
             cursor.close()
@@ -307,36 +1118,116 @@ class DB:
         sediment_balance: str,
         storm_climate: str,
     ):
-        query = f"""SELECT code, ecosystem_disruption, gradual_inundation, salt_water_intrusion, erosion, flooding
+        """chw.decision_wheel, see catalogue_utils.DecisionWheel for the in-memory lookup
+
+        Returns:
+            code, ecosystem_disruption, gradual_inundation, salt_water_intrusion,
+            erosion, flooding or None if no class matches
+        """
+        query = """SELECT code, ecosystem_disruption, gradual_inundation, salt_water_intrusion, erosion, flooding
                     FROM chw.decision_wheel
-                    WHERE geological_layout = '{geological_layout}' and
-                        '{wave_exposure}' = ANY(wave_exposure) and
-                        '{tidal_range}' = ANY(tidal_range) and
-                        '{flora_fauna}' = ANY(flora_fauna) and
-                        '{sediment_balance}' = ANY(sediment_balance) and
-                        '{storm_climate}' = ANY(storm_climate);"""
+                    WHERE geological_layout = $1 and
+                        $2 = ANY(wave_exposure) and
+                        $3 = ANY(tidal_range) and
+                        $4 = ANY(flora_fauna) and
+                        $5 = ANY(sediment_balance) and
+                        $6 = ANY(storm_climate)
+                    ORDER BY {order}
+                    LIMIT 1;""".format(order=DECISION_WHEEL_ORDER)
+        params = (
+            geological_layout,
+            wave_exposure,
+            tidal_range,
+            flora_fauna,
+            sediment_balance,
+            storm_climate,
+        )
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute("get_classes", query, ("text",) * 6, params)
             classes = cursor.fetchone()
             cursor.close()
         return classes
 
+    def load_decision_wheel(self):
+        """All rows of chw.decision_wheel, in the order the lookup in get_classes
+        sees them (DECISION_WHEEL_ORDER)
+
+        Returns:
+            list of (code, geological_layout, wave_exposure, tidal_range, flora_fauna,
+            sediment_balance, storm_climate, ecosystem_disruption, gradual_inundation,
+            salt_water_intrusion, erosion, flooding)
+        """
+        query = """SELECT code, geological_layout, wave_exposure, tidal_range, flora_fauna,
+                        sediment_balance, storm_climate, ecosystem_disruption,
+                        gradual_inundation, salt_water_intrusion, erosion, flooding
+                    FROM chw.decision_wheel
+                    ORDER BY {order};""".format(order=DECISION_WHEEL_ORDER)
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
+    def get_tables_version(self, tables) -> str:
+        """Fingerprint of the content of small tables, to detect changes
+
+        Args:
+            tables: names as schema.table
+
+        Returns:
+            md5 hex digest
+        """
+        parts = [
+            sql.SQL(
+                "(SELECT coalesce(string_agg(t::text, ',' ORDER BY t::text), '') FROM {} t)"
+            ).format(sql.Identifier(*table.split(".")))
+            for table in tables
+        ]
+        query = sql.SQL("SELECT md5(concat_ws('|', {}));").format(sql.SQL(", ").join(parts))
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+            version = cursor.fetchone()[0]
+            cursor.close()
+        return version
+
     def get_measures(self, code):
-        query = f""" SELECT opt.hazard, array_agg(opt.managementoption) as measures 
+        """Management measures per hazard of a CHW code, see
+        catalogue_utils.MeasuresCatalogue for the in-memory lookup
+
+        Returns:
+            list of (hazard, list of measures)
+        """
+        query = """ SELECT opt.hazard, array_agg(opt.managementoption) as measures 
                     FROM 
                     (SELECT h.hid, h.hazard, ms.managementoption
                     FROM management.managementoptions mo JOIN management.hazards h on mo.hid = h.hid
                     JOIN management.measures ms on ms.mid = mo.mid
-                    WHERE code = '{code}') as opt
+                    WHERE code = $1) as opt
                     GROUP BY opt.hazard;"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute("get_measures", query, ("text",), (code,))
             measures = cursor.fetchall()
             cursor.close()
         return measures
 
+    def load_measures(self):
+        """The management measures of all CHW codes
+
+        Returns:
+            list of (code, hazard, measure)
+        """
+        query = """SELECT mo.code, h.hazard, ms.managementoption
+                    FROM management.managementoptions mo JOIN management.hazards h on mo.hid = h.hid
+                    JOIN management.measures ms on ms.mid = mo.mid;"""
+        with self.connection:
+            cursor = self.connection.cursor()
+            cursor.execute(query)
+            rows = cursor.fetchall()
+            cursor.close()
+        return rows
+
     def find_special_areas(self, wkt, crs=4326):
         """coast.osm_landpolygon
         Args:
@@ -347,18 +1238,22 @@ class DB:
         Returns:
             bool: True if point in a land polygon, false if not
         """
-        query = f"""
+        query = """
                     SELECT false, 'Please choose a point in sea'
                     FROM coast.osm_landpolygon
-                    WHERE ST_Contains(geom, ST_GeomFromText(\'{wkt}\', {crs}))
+                    WHERE ST_Contains(geom, ST_GeomFromWKB($1, $2))
                     UNION
                     SELECT proceed, notification
                     FROM coast.excludedregions
-                    WHERE st_contains(geom,st_transform(ST_GeomFromText(\'{wkt}\', {crs}),3857));"""
+                    WHERE st_contains(geom,st_transform(ST_GeomFromWKB($1, $2),3857));"""
         with self.connection:
             try:
-                cursor = self.connection.cursor()
-                cursor.execute(query)
+                cursor = self.execute(
+                    "find_special_areas",
+                    query,
+                    ("bytea", "integer"),
+                    (wkb_param(wkt), crs),
+                )
                 query_result = cursor.fetchone()
                 proceed = query_result[0]
                 notification = query_result[1]
@@ -380,7 +1275,7 @@ class DB:
         Returns:
             line: extended line. Start point coast, End point either sea or land.
         """
-        transect = f"ST_GeomFromText('{wkt}', {crs})"
+        transect = "ST_GeomFromWKB($1, $2)"
         P1 = f"ST_StartPoint({transect})"
         P2 = f"ST_EndPoint({transect})"
         if direction == -180:
@@ -388,13 +1283,16 @@ class DB:
         elif direction == 180:
             azimuth = f"ST_Azimuth({P1}::geometry,{P2}::geometry)"
 
-        extension_length = dist
-        projection = f"ST_Project({P1}, {extension_length}, {azimuth})"
+        projection = f"ST_Project({P1}::geography, $3, {azimuth})"
 
         query = f"SELECT ST_AsText(ST_MakeLine({P1}::geometry, {projection}::geometry))"
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                f"ST_line_extend_{'sea' if direction == -180 else 'land'}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             line = cursor.fetchone()[0]
             cursor.close()
         return line
@@ -414,32 +1312,73 @@ class DB:
            # long resulting to same id during extension)
         """
 
-        query = f"""SELECT ST_AsText(ST_ClosestPoint(closest_line.geom, ST_GeomFromText(\'{wkt}\', {crs}))), gid            
+        index = get_coastline_index()
+        if index is not None:
+            try:
+                closest = index.closest_point_of_coastline(
+                    wkt, self.load_coastline_segments
+                )
+                if closest is not None:
+                    return closest
+            except Exception as e:
+                LOGGER.info(f"Coastline index failed, falling back to the database: {e}")
+
+        query = """SELECT ST_AsText(ST_ClosestPoint(closest_line.geom, ST_GeomFromWKB($1, $2))), gid            
                     FROM (SELECT *
                     FROM coast.osm_segment500m
-                    WHERE ST_DWithin(geom, ST_GeomFromText(\'{wkt}\', {crs}), 1)
-                    ORDER BY ST_Distance(geom, ST_GeomFromText(\'{wkt}\', {crs})) LIMIT 1) AS closest_line;
+                    WHERE ST_DWithin(geom, ST_GeomFromWKB($1, $2), 1)
+                    ORDER BY ST_Distance(geom, ST_GeomFromWKB($1, $2)) LIMIT 1) AS closest_line;
                 """
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "closest_point_of_coastline",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             point, coastline_id = cursor.fetchall()[0]
             cursor.close()
         return point, coastline_id
 
+    def load_coastline_segments(self, xmin, ymin, xmax, ymax, crs=4326):
+        """coast.osm_segment500m
+        Loads the coastline segments whose envelope intersects the bbox,
+        used to fill the tiles of the in-memory coastline index.
+
+        Returns:
+            list of (gid, wkb)
+        """
+        query = """SELECT gid, ST_AsBinary(geom)
+                FROM coast.osm_segment500m
+                WHERE geom && ST_MakeEnvelope($1, $2, $3, $4, $5)"""
+        with self.connection:
+            cursor = self.execute(
+                "load_coastline_segments",
+                query,
+                ("float8", "float8", "float8", "float8", "integer"),
+                (xmin, ymin, xmax, ymax, crs),
+            )
+            segments = cursor.fetchall()
+            cursor.close()
+        return segments
+
     def create_transect_in_coast(self, point_on_sea, point_on_coast, dist, crs=4326):
 
-        P1 = f"ST_GeomFromText('{point_on_sea}', {crs})"
-        P2 = f"ST_GeomFromText('{point_on_coast}', {crs})"
+        P1 = "ST_GeomFromWKB($1, $3)"
+        P2 = "ST_GeomFromWKB($2, $3)"
 
         azimuth = f"ST_Azimuth({P1}::geometry,{P2}::geometry)"
 
-        projection = f"ST_Project({P2}, {dist}, {azimuth})"
+        projection = f"ST_Project({P2}::geography, $4, {azimuth})"
 
         query = f"SELECT ST_AsText(ST_MakeLine({P2}::geometry, {projection}::geometry))"
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "create_transect_in_coast",
+                query,
+                ("bytea", "bytea", "integer", "float8"),
+                (wkb_param(point_on_sea), wkb_param(point_on_coast), crs, dist),
+            )
             transect = cursor.fetchone()[0]
             cursor.close()
         return transect
@@ -450,16 +1389,20 @@ class DB:
             number
         """
 
-        query = f"""SELECT tot_val,tot_pob
-                    FROM gar.gar 
-                    WHERE ST_DWithin(wkb_geometry, 
-                        ST_GeomFromText(\'{wkt}\', {crs}), {dist}) 
-                    ORDER BY ST_Distance(wkb_geometry, 
-                                        ST_GeomFromText(\'{wkt}\', {crs})) 
-                    LIMIT 1;"""
+        query = nearest_sql(
+            "tot_val, tot_pob",
+            "gar.gar",
+            "wkb_geometry",
+            "ST_GeomFromWKB($1, $2)",
+            "$3",
+        )
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_gar_pop_values_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "float8"),
+                (wkb_param(wkt), crs, dist),
+            )
             tot = cursor.fetchone()
             gar = float(tot[0])
             pop = float(tot[1])
@@ -478,15 +1421,19 @@ class DB:
             Any:
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM coast.osm_beach
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))
                 )"""
         # With the with keyword, Python automatically releases the resources. It also provides error handling.
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_osm_beaches",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             beach = cursor.fetchone()[0]
             cursor.close()
         return beach
@@ -502,21 +1449,25 @@ class DB:
 
         """
 
-        query = f"""SELECT xx
-                    FROM geollayout.glim 
-                    WHERE ST_DWithin(shape, 
-                        ST_Transform(ST_GeomFromText(\'{wkt}\', {crs}), {db_crs}), {dist}) 
-                    ORDER BY ST_Distance(shape, 
-                                        ST_Transform(ST_GeomFromText(\'{wkt}\', {crs}), {db_crs})) 
-                    LIMIT 1;"""
-        cursor = self.connection.cursor()
+        query = nearest_sql(
+            "xx",
+            "geollayout.glim",
+            "shape",
+            "ST_Transform(ST_GeomFromWKB($1, $2), $3)",
+            "$4",
+        )
         try:
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_closest_geology_glim_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "integer", "float8"),
+                (wkb_param(wkt), crs, db_crs, dist),
+            )
             glim = cursor.fetchone()[0]
+            cursor.close()
 
         except Exception:
             glim = None
-        cursor.close()
         return glim
 
     def get_geol_glim_values(self, wkt, crs=4326, db_crs=3857) -> List[str]:
@@ -530,12 +1481,16 @@ class DB:
             db_crs:int
         """
 
-        query = f"""SELECT xx 
+        query = """SELECT xx 
                 FROM geollayout.glim
-                WHERE ST_Intersects(shape, ST_Transform(ST_GeomFromText(\'{wkt}\', {crs}), {db_crs}))
+                WHERE ST_Intersects(shape, ST_Transform(ST_GeomFromWKB($1, $2), $3))
                 """
-        cursor = self.connection.cursor()
-        cursor.execute(query)
+        cursor = self.execute(
+            "get_geol_glim_values",
+            query,
+            ("bytea", "integer", "integer"),
+            (wkb_param(wkt), crs, db_crs),
+        )
         geology_values = cursor.fetchall()
         cursor.close()
         return geology_values
@@ -549,26 +1504,31 @@ class DB:
         Get values in a buffer, sort them by distance
         and gets the closest one.
         """
+        glim = nearest_sql(
+            "xx",
+            "geollayout.glim",
+            "shape",
+            "ST_Transform(ST_GeomFromWKB($1, $2), $3)",
+            "$4",
+            "xx NOT IN ('wb', 'nd')",
+        )
         query = f"""
         SELECT
             CASE
                 WHEN ((SELECT count(*)
                         FROM geollayout.fluvisols
-                        WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))) != 0 )
+                        WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))) != 0 )
         THEN 'fluvisol'
-        ELSE (SELECT xx as glim
-              FROM geollayout.glim
-              WHERE ST_DWithin(shape, 
-                        ST_Transform(ST_GeomFromText(\'{wkt}\', {crs}), {db_crs}), {dist})
-                        AND xx NOT IN ('wb', 'nd')
-              ORDER BY ST_Distance(shape,
-                ST_Transform(ST_GeomFromText(\'{wkt}\', {crs}), {db_crs}))
-              LIMIT 1) 
+        ELSE ({glim})
         END
         """
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                f"get_geology_value_{nearest_settings['mode']}",
+                query,
+                ("bytea", "integer", "integer", "float8"),
+                (wkb_param(wkt), crs, db_crs, dist),
+            )
             geology = cursor.fetchone()[0]
             cursor.close()
 
@@ -585,14 +1545,18 @@ class DB:
             bool: True if intersects, false if not
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM coast.usgs_islands
-                    WHERE ST_Intersects(wkb_geometry, ST_GeomFromText(\'{wkt}\', {crs})) 
+                    WHERE ST_Intersects(wkb_geometry, ST_GeomFromWKB($1, $2)) 
                 )"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_island",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             island = cursor.fetchone()[0]
             cursor.close()
         return island
@@ -608,14 +1572,18 @@ class DB:
             bool: True if intersects, false if not
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1
                     FROM coast.usgs_islands as t
-                    WHERE ST_Intersects(wkb_geometry, ST_GeomFromText(\'{wkt}\', {crs})) and islandarea < 25)
+                    WHERE ST_Intersects(wkb_geometry, ST_GeomFromWKB($1, $2)) and islandarea < 25)
                 """
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_small_island",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             small_island = cursor.fetchone()[0]
             cursor.close()
         return small_island 
@@ -624,13 +1592,17 @@ class DB:
         """
         """
 
-        query = f"""SELECT ST_AsGeoJSON(t.*) 
+        query = """SELECT ST_AsGeoJSON(t.*) 
                     FROM coast.osm_landpolygon as t
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs}))
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2))
                 """
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "get_land_polygon",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             land_polygon = cursor.fetchone()[0]
             cursor.close()
         return geojson.loads(land_polygon)
@@ -645,14 +1617,18 @@ class DB:
             bool: True if intersects, false if not
         """
 
-        query = f"""SELECT EXISTS(
+        query = """SELECT EXISTS(
                     SELECT 1 
                     FROM coast.barriers_sandspits
-                    WHERE ST_Intersects(geom, ST_GeomFromText(\'{wkt}\', {crs})) 
+                    WHERE ST_Intersects(geom, ST_GeomFromWKB($1, $2)) 
                 )"""
         with self.connection:
-            cursor = self.connection.cursor()
-            cursor.execute(query)
+            cursor = self.execute(
+                "intersect_with_barriers_sandspits",
+                query,
+                ("bytea", "integer"),
+                (wkb_param(wkt), crs),
+            )
             barriers_sandspits = cursor.fetchone()[0]
             cursor.close()
         return barriers_sandspits
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# In-process spatial index of the coastline segments (coast.osm_segment500m).
+# Segments are loaded lazily per tile of the lon/lat grid, indexed with a shapely
+# STRtree and evicted least recently used when the memory budget is exceeded.
+# The database queries stay the fallback, see DB.closest_point_of_coastline.
+
+from collections import OrderedDict
+import logging
+import math
+import os
+import threading
+
+from shapely import wkb, wkt
+from shapely.geometry import box
+from shapely.ops import nearest_points
+from shapely.strtree import STRtree
+
+from .utils import read_section_config
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Defaults for the optional [CoastlineIndex] section of configuration.txt
+COASTLINE_INDEX_DEFAULTS = {
+    "enabled": False,
+    # size of the tiles in degrees
+    "tile_size": 1.0,
+    "memory_budget_mb": 256,
+}
+
+# Rough in-memory size of a shapely geometry relative to its WKB size
+GEOMETRY_OVERHEAD = 4
+
+
+class CoastlineTile:
+    """Coastline segments of one tile and their STRtree"""
+
+    def __init__(self, rows):
+        self.gids = []
+        self.geoms = []
+        self.nbytes = 0
+        for gid, geom_wkb in rows:
+            geom_wkb = bytes(geom_wkb)
+            self.gids.append(gid)
+            self.geoms.append(wkb.loads(geom_wkb))
+            self.nbytes += len(geom_wkb) * GEOMETRY_OVERHEAD
+        self.tree = STRtree(self.geoms) if self.geoms else None
+        # shapely < 2 returns geometries instead of indices from STRtree.query
+        self._positions = {id(geom): i for i, geom in enumerate(self.geoms)}
+
+    def query(self, geom):
+        """Returns (gid, geometry) of the segments whose envelope intersects geom"""
+        if self.tree is None:
+            return []
+        result = self.tree.query(geom)
+        positions = [
+            self._positions[id(item)] if hasattr(item, "geom_type") else int(item)
+            for item in result
+        ]
+        return [(self.gids[i], self.geoms[i]) for i in positions]
+
+
+class CoastlineIndex:
+    """Lazily tiled, LRU evicted in-memory index of the coastline segments.
+
+    The loader is given by the caller of every query, so tiles are loaded over the
+    connection that the caller already has. It is called as
+    loader(xmin, ymin, xmax, ymax) and returns (gid, wkb) rows of the segments whose
+    envelope intersects the bbox.
+    """
+
+    def __init__(self, tile_size=1.0, memory_budget_mb=256):
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._tiles = OrderedDict()
+        self._loading = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _tile_keys(self, xmin, ymin, xmax, ymax):
+        size = self.tile_size
+        for i in range(math.floor(xmin / size), math.floor(xmax / size) + 1):
+            for j in range(math.floor(ymin / size), math.floor(ymax / size) + 1):
+                yield i, j
+
+    def _get_tile(self, key, loader) -> CoastlineTile:
+        while True:
+            with self._lock:
+                tile = self._tiles.get(key)
+                if tile is not None:
+                    self._tiles.move_to_end(key)
+                    self.hits += 1
+                    return tile
+                event = self._loading.get(key)
+                if event is None:
+                    # this thread loads the tile
+                    event = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            event.wait()
+
+        try:
+            i, j = key
+            size = self.tile_size
+            tile = CoastlineTile(
+                loader(i * size, j * size, (i + 1) * size, (j + 1) * size)
+            )
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+        with self._lock:
+            self._tiles[key] = tile
+            self._nbytes += tile.nbytes
+            while self._nbytes > self.memory_budget and len(self._tiles) > 1:
+                _, evicted = self._tiles.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self.evictions += 1
+        return tile
+
+    def _candidates(self, geom, loader) -> dict:
+        """Segments (gid -> geometry) whose envelope intersects the envelope of geom"""
+        envelope = box(*geom.bounds)
+        candidates = {}
+        for key in self._tile_keys(*geom.bounds):
+            for gid, segment in self._get_tile(key, loader).query(envelope):
+                candidates[gid] = segment
+        return candidates
+
+    def closest_point_of_coastline(self, point_wkt, loader, dist=1):
+        """In-memory equivalent of DB.closest_point_of_coastline.
+        The search window grows from 1/20 of a tile until dist is reached.
+
+        Returns:
+            closest point as wkt and coastline id, or None if no segment is within dist
+        """
+        point = wkt.loads(point_wkt)
+        radius = min(self.tile_size / 20, dist)
+        while True:
+            window = point.buffer(radius).envelope
+            best = None
+            for gid, segment in self._candidates(window, loader).items():
+                distance = segment.distance(point)
+                if distance <= radius and (best is None or distance < best[0]):
+                    best = (distance, gid, segment)
+            if best is not None:
+                _, gid, segment = best
+                return nearest_points(segment, point)[0].wkt, gid
+            if radius >= dist:
+                return None
+            radius = min(radius * 4, dist)
+
+    def fetch_closest_coasts(self, line_wkt, loader):
+        """In-memory equivalent of DB.fetch_closest_coasts
+
+        Returns:
+            ids of the coastline segments that intersect the line
+        """
+        line = wkt.loads(line_wkt)
+        return [
+            gid
+            for gid, segment in self._candidates(line, loader).items()
+            if segment.intersects(line)
+        ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tiles": len(self._tiles),
+                "bytes": self._nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._nbytes = 0
+
+    def _reset_after_fork(self):
+        """The loads in flight of the parent never finish in a forked process, and
+        its lock may have been held by one of them. The loaded tiles are kept,
+        unless a thread of the parent was changing them."""
+        if self._lock.locked():
+            self._tiles.clear()
+            self._nbytes = 0
+        self._loading = {}
+        self._lock = threading.Lock()
+
+
+_coastline_index = None
+_coastline_index_lock = threading.Lock()
+
+
+def get_coastline_index():
+    """Returns the process-wide coastline index, or None if it is not enabled
+    in the [CoastlineIndex] section of configuration.txt"""
+    global _coastline_index
+    with _coastline_index_lock:
+        if _coastline_index is None:
+            settings = read_section_config("CoastlineIndex", COASTLINE_INDEX_DEFAULTS)
+            if settings["enabled"]:
+                _coastline_index = CoastlineIndex(
+                    tile_size=settings["tile_size"],
+                    memory_budget_mb=settings["memory_budget_mb"],
+                )
+            else:
+                _coastline_index = False
+    return _coastline_index or None
+
+
+def _reset_index_after_fork():
+    """A forked process may inherit the lock while a thread of the parent held it"""
+    global _coastline_index_lock
+    _coastline_index_lock = threading.Lock()
+    if _coastline_index:
+        _coastline_index._reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_index_after_fork)
@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Lightweight timing instrumentation of the CHW pipeline.
+# span("name") / @timed("name") measure the wall time of a stage and count("name")
+# adds to a counter (database queries, downloaded bytes). Everything is recorded
+# in the process-wide histograms and totals, and in the RequestMetrics of the
+# current request when one is collected (see collect). The collector lives in a
+# context variable, run_tasks copies it into its threads.
+# render_prometheus() exposes the histograms, counters and gauges in the Prometheus
+# text format. With several processes (forked async jobs, WSGI workers) every
+# process writes a snapshot to the [Metrics] multiprocess_dir after each request
+# and the snapshots of all processes are merged.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import fcntl
+import functools
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+import time
+import uuid
+
+from .utils import read_section_config
+
+LOGGER = logging.getLogger("PYWPS")
+
+# Defaults for the optional [Metrics] section of configuration.txt
+METRICS_DEFAULTS = {
+    # empty keeps the metrics of every process to itself
+    "multiprocess_dir": "",
+}
+
+# Upper bounds in milliseconds of the histogram buckets, the last one is +Inf
+HISTOGRAM_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_current = ContextVar("chw_request_metrics", default=None)
+
+
+class Histogram:
+    """Counts of durations per bucket, with their sum"""
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self) -> dict:
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class RequestMetrics:
+    """Stage timings and counters of one request"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_stage(self, name, elapsed_ms):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"count": 0, "total_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += elapsed_ms
+
+    def add_count(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "wall_ms": round((time.perf_counter() - self.start) * 1000, 3),
+                "stages": {
+                    name: {"count": stage["count"], "total_ms": round(stage["total_ms"], 3)}
+                    for name, stage in sorted(self.stages.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+
+_histograms = {}
+_totals = {}
+_lock = threading.Lock()
+# name -> (function returning {label: {field: value}}, per_process)
+_gauges = {}
+# identifies the snapshot of this process, a reused pid gets a new one
+_process_token = uuid.uuid4().hex[:8]
+_settings = None
+
+
+def record_stage(name, elapsed_ms):
+    """Records the duration of a stage in the histograms and the current request"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.observe(elapsed_ms)
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_stage(name, elapsed_ms)
+
+
+def count(name, value=1):
+    """Adds value to a counter, e.g. count("db.queries") or count("wcs.bytes", n)"""
+    with _lock:
+        _totals[name] = _totals.get(name, 0) + value
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_count(name, value)
+
+
+@contextmanager
+def span(name):
+    """Measures the wall time of the with block as stage name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, (time.perf_counter() - start) * 1000)
+
+
+def timed(name):
+    """Decorator that measures every call of the function as stage name"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def collect():
+    """Collects the metrics of the code in the with block, e.g. one request
+
+    Yields:
+        RequestMetrics
+    """
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+def get_histograms() -> dict:
+    """Snapshot of the process-wide stage histograms"""
+    with _lock:
+        return {name: histogram.as_dict() for name, histogram in _histograms.items()}
+
+
+def get_totals() -> dict:
+    """Snapshot of the process-wide counters"""
+    with _lock:
+        return dict(_totals)
+
+
+def count_error(exception):
+    """Counts a failed request by the class of its exception"""
+    count(f"errors.{type(exception).__name__}")
+
+
+def register_gauges(name, function, per_process=True):
+    """Registers a gauge family that is evaluated when the metrics are rendered
+
+    Args:
+        name: name of the family, e.g. "db_pool"
+        function: returns {label: {field: value}}
+        per_process: the values belong to this process and are kept in its
+            snapshot; False for values that are the same in every process
+    """
+    _gauges[name] = (function, per_process)
+
+
+def _evaluate_gauges(per_process) -> dict:
+    gauges = {}
+    for name, (function, local) in list(_gauges.items()):
+        if local != per_process:
+            continue
+        try:
+            gauges[name] = function()
+        except Exception:
+            LOGGER.exception(f"Evaluating the {name} gauges failed")
+    return gauges
+
+
+def instrumented(handler):
+    """Decorates the _handler of a PyWPS process to record the request latency as
+    stage request.<identifier> and write the snapshot of this process.
+
+    PyWPS runs every execute on a deep copy of the process; the decorated method
+    is bound to that copy like the handler itself, so it sees the workdir of the
+    copy."""
+
+    @functools.wraps(handler)
+    def wrapper(process, request, response):
+        try:
+            with span(f"request.{process.identifier}"):
+                return handler(process, request, response)
+        except Exception as e:
+            count_error(e)
+            raise
+        finally:
+            write_snapshot()
+
+    return wrapper
+
+
+def _multiprocess_dir():
+    global _settings
+    if _settings is None:
+        _settings = read_section_config("Metrics", METRICS_DEFAULTS)
+    return _settings["multiprocess_dir"]
+
+
+def snapshot() -> dict:
+    """Histograms, counters and per-process gauges of this process"""
+    return {
+        "pid": os.getpid(),
+        "histograms": get_histograms(),
+        "totals": get_totals(),
+        "gauges": _evaluate_gauges(per_process=True),
+    }
+
+
+def write_snapshot():
+    """Writes the snapshot of this process to the multiprocess_dir, if set"""
+    directory = _multiprocess_dir()
+    if not directory:
+        return
+    try:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"{os.getpid()}-{_process_token}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(snapshot()))
+        # never let a scrape read half a snapshot
+        os.replace(tmp, path)
+    except Exception:
+        LOGGER.exception("Writing the metrics snapshot failed")
+
+
+def _pid_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _compact_exited(directory):
+    """Folds the snapshots of exited processes into _exited.json, so the forked
+    async jobs do not leave a file each. The lock serializes the scrapes."""
+    with open(directory / ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        exited = []
+        for path in directory.glob("*-*.json"):
+            try:
+                pid = int(path.name.split("-")[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and not _pid_alive(pid):
+                exited.append(path)
+        if not exited:
+            return
+        archive_path = directory / "_exited.json"
+        snapshots = []
+        if archive_path.exists():
+            snapshots.append(json.loads(archive_path.read_text()))
+        for path in exited:
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                continue
+        merged = merge_snapshots(snapshots)
+        archive = {
+            "pid": 0,
+            "histograms": merged["histograms"],
+            "totals": merged["totals"],
+            "gauges": {},
+        }
+        tmp = archive_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(archive))
+        os.replace(tmp, archive_path)
+        for path in exited:
+            path.unlink()
+
+
+def _snapshots() -> list:
+    """The live snapshot of this process and the stored ones of the others"""
+    snapshots = [snapshot()]
+    directory = _multiprocess_dir()
+    if not directory or not Path(directory).is_dir():
+        return snapshots
+    directory = Path(directory)
+    try:
+        _compact_exited(directory)
+    except Exception:
+        LOGGER.exception("Compacting the metrics snapshots failed")
+    own = f"{os.getpid()}-{_process_token}.json"
+    for path in directory.glob("*.json"):
+        if path.name == own:
+            continue
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def merge_snapshots(snapshots) -> dict:
+    """Sums the histograms and counters of the snapshots. Counters of exited
+    processes stay in the sums; gauges are kept per live process only."""
+    histograms = {}
+    totals = {}
+    gauges = {}
+    for snap in snapshots:
+        for name, histogram in snap["histograms"].items():
+            merged = histograms.get(name)
+            if merged is None:
+                histograms[name] = {
+                    "buckets": list(histogram["buckets"]),
+                    "counts": list(histogram["counts"]),
+                    "count": histogram["count"],
+                    "sum": histogram["sum"],
+                }
+                continue
+            if merged["buckets"] != list(histogram["buckets"]):
+                continue
+            merged["counts"] = [a + b for a, b in zip(merged["counts"], histogram["counts"])]
+            merged["count"] += histogram["count"]
+            merged["sum"] += histogram["sum"]
+        for name, value in snap["totals"].items():
+            totals[name] = totals.get(name, 0) + value
+        if snap["gauges"] and (snap["pid"] == os.getpid() or _pid_alive(snap["pid"])):
+            for family, labels in snap["gauges"].items():
+                for label, fields in labels.items():
+                    gauges.setdefault(family, []).append((snap["pid"], label, fields))
+    return {"histograms": histograms, "totals": totals, "gauges": gauges}
+
+
+def _metric_name(name) -> str:
+    return "chw_" + "".join(c if c.isalnum() else "_" for c in name).strip("_")
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+def _histogram_lines(metric, label, value, histogram) -> list:
+    """Lines of one histogram, the durations are converted to seconds"""
+    lines = []
+    cumulative = 0
+    bounds = [bound / 1000 for bound in histogram["buckets"]] + ["+Inf"]
+    for bound, bucket_count in zip(bounds, histogram["counts"]):
+        cumulative += bucket_count
+        le = bound if bound == "+Inf" else repr(float(bound))
+        lines.append(f'{metric}_bucket{{{label}="{_label_value(value)}",le="{le}"}} {cumulative}')
+    lines.append(f'{metric}_sum{{{label}="{_label_value(value)}"}} {histogram["sum"] / 1000!r}')
+    lines.append(f'{metric}_count{{{label}="{_label_value(value)}"}} {histogram["count"]}')
+    return lines
+
+
+def render_prometheus() -> str:
+    """All metrics of all processes in the Prometheus text format"""
+    merged = merge_snapshots(_snapshots())
+    gauges = merged["gauges"]
+    for family, labels in _evaluate_gauges(per_process=False).items():
+        for label, fields in labels.items():
+            gauges.setdefault(family, []).append((None, label, fields))
+
+    lines = []
+    requests = {}
+    stages = {}
+    for name, histogram in sorted(merged["histograms"].items()):
+        if name.startswith("request."):
+            requests[name[len("request."):]] = histogram
+        else:
+            stages[name] = histogram
+    for metric, label, histograms, help_text in (
+        ("chw_request_duration_seconds", "process", requests, "Latency of the WPS requests per process"),
+        ("chw_stage_duration_seconds", "stage", stages, "Duration of the stages of the requests"),
+    ):
+        if not histograms:
+            continue
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} histogram")
+        for value, histogram in histograms.items():
+            lines.extend(_histogram_lines(metric, label, value, histogram))
+
+    errors = {}
+    counters = {}
+    for name, value in sorted(merged["totals"].items()):
+        if name.startswith("errors."):
+            errors[name[len("errors."):]] = value
+        else:
+            counters[name] = value
+    if errors:
+        lines.append("# HELP chw_errors_total Failed requests by exception class")
+        lines.append("# TYPE chw_errors_total counter")
+        for exception, value in errors.items():
+            lines.append(f'chw_errors_total{{exception="{_label_value(exception)}"}} {_format_value(value)}')
+    for name, value in counters.items():
+        metric = _metric_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {_format_value(value)}")
+
+    for family, samples in sorted(gauges.items()):
+        fields = sorted({field for _, _, values in samples for field in values})
+        for field in fields:
+            metric = _metric_name(f"{family}_{field}")
+            lines.append(f"# TYPE {metric} gauge")
+            for pid, label, values in samples:
+                value = values.get(field)
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                labels = f'{family}="{_label_value(label)}"'
+                if pid is not None:
+                    labels += f',pid="{pid}"'
+                lines.append(f"{metric}{{{labels}}} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _reset_after_fork():
+    """A forked process starts with empty metrics and its own snapshot, otherwise
+    the metrics of the parent would be counted twice when merged"""
+    global _lock, _process_token
+    _lock = threading.Lock()
+    _histograms.clear()
+    _totals.clear()
+    _process_token = uuid.uuid4().hex[:8]
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Offline precomputation of the CHW classification along the coastline.
+# For every segment of coast.osm_segment500m the canonical transect (see
+# vector_utils.canonical_transect) is classified and stored, with the data version,
+# in chw.precomputed_classification (sql/precomputed_classification.sql).
+# Every segment is committed on its own, so an interrupted run resumes where it
+# stopped; segments of an older data version are computed again.
+#
+# Usage: python -m processes.precompute --workers 8 [--bbox xmin ymin xmax ymax]
+
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+
+import geojson
+
+from .chw_utils import classify_transect
+from .db_utils import DB
+from .utils import read_config
+from .vector_utils import canonical_transect, wkt_geometry
+
+LOGGER = logging.getLogger("PYWPS")
+
+host, user, password, db, _, _, _, _, _, _, _ = read_config()
+
+
+def precompute_segment(gid, data_version, testing=False) -> dict:
+    """Classifies the canonical transect of a coastline segment and stores it
+
+    Args:
+        gid: id of the segment in coast.osm_segment500m
+        data_version: see DB.get_data_version
+        testing: use the DEM layer for testing
+    Returns:
+        dict with transect (wkt), notification, output and error,
+        like DB.get_precomputed_classification
+    """
+    with DB(user, password, host, db) as segment_db:
+        segment = segment_db.get_coastline_segment(gid)
+        if segment is None:
+            raise ValueError(f"Coastline segment {gid} does not exist")
+        point_on_sea, transect = canonical_transect(segment)
+        proceed, notification = segment_db.find_special_areas(point_on_sea)
+
+    output = None
+    error = None
+    if proceed is False:
+        error = notification
+    else:
+        feature = geojson.Feature(
+            geometry=wkt_geometry(transect),
+            properties={"coastline_id": gid, "notification": notification},
+        )
+        try:
+            output = classify_transect(feature, testing=testing)
+        except Exception as e:
+            error = f"{e}"
+
+    with DB(user, password, host, db) as segment_db:
+        segment_db.save_precomputed_classification(
+            gid, transect, notification, data_version, output=output, error=error
+        )
+    return {
+        "transect": transect,
+        "notification": notification,
+        "output": output,
+        "error": error,
+    }
+
+
+def _precompute_worker(args):
+    """Pool worker, never raises so one bad segment does not stop the run"""
+    gid, data_version, testing = args
+    try:
+        return gid, precompute_segment(gid, data_version, testing)["error"]
+    except Exception as e:
+        LOGGER.exception(f"Precomputing segment {gid} failed")
+        return gid, f"{e}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Precomputes the CHW classification of every coastline segment"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of processes"
+    )
+    parser.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("XMIN", "YMIN", "XMAX", "YMAX"),
+        help="only the segments in this bbox (EPSG:4326)",
+    )
+    parser.add_argument("--limit", type=int, help="at most this many segments")
+    parser.add_argument(
+        "--retry-errors", action="store_true", help="compute failed segments again"
+    )
+    parser.add_argument(
+        "--testing", action="store_true", help="use the DEM layer for testing"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    with DB(user, password, host, db) as main_db:
+        data_version = main_db.get_data_version()
+        gids = main_db.list_segments_to_precompute(
+            data_version, bbox=args.bbox, retry_errors=args.retry_errors
+        )
+    if args.limit is not None:
+        gids = gids[: args.limit]
+    LOGGER.info(f"Precomputing {len(gids)} segments, data version {data_version}")
+
+    start = time.monotonic()
+    failed = 0
+    tasks = [(gid, data_version, args.testing) for gid in gids]
+    with multiprocessing.Pool(args.workers) as pool:
+        for done, (gid, error) in enumerate(
+            pool.imap_unordered(_precompute_worker, tasks, chunksize=8), 1
+        ):
+            if error is not None:
+                failed += 1
+            if done % 100 == 0 or done == len(tasks):
+                elapsed = time.monotonic() - start
+                LOGGER.info(
+                    f"{done}/{len(tasks)} segments, {failed} failed, "
+                    f"{done / elapsed:.1f} segments/s"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -26,20 +26,47 @@
 # Sign up to recieve regular updates of this function, and to contribute
 # your own tools.
 
+from .metrics_utils import timed
+from .tile_utils import get_tile_cache
 from .wcs_utils import LS
 import logging
 import numpy as np
 
 
 import rasterio
+from rasterio.io import MemoryFile
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 from rasterio.mask import mask
-from scipy.stats import linregress
-from statistics import mean, median
+from rasterio.windows import Window
+from pyproj import Transformer
 from pathlib import Path
 import os
 
+# Defaults for the optional [Raster] section of configuration.txt
+RASTER_DEFAULTS = {
+    # write the downloaded and reprojected rasters to the outputs dir for debugging,
+    # otherwise they are kept in memory
+    "write_files": False,
+    # resampling of the DEM along the transect, nearest or bilinear
+    "resampling": "nearest",
+}
 
+
+def open_raster(raster):
+    """Opens a raster given as a path or as a MemoryFile"""
+    if isinstance(raster, MemoryFile):
+        return raster.open()
+    return rasterio.open(raster)
+
+
+def close_raster(raster):
+    """Frees a raster returned by cut_wcs or reproject_raster once it is read. A
+    MemoryFile holds a GDAL /vsimem buffer until it is closed; a file stays."""
+    if isinstance(raster, MemoryFile):
+        raster.close()
+
+
+@timed("raster.cut_wcs")
 def cut_wcs(
     xst,
     yst,
@@ -52,7 +79,7 @@ def cut_wcs(
     all_box=False,
     username=None,
     password=None,
-) -> str:
+):
     """Implements the GetCoverage request with a given bbox from the user
     Args:
         xst (float): xmin
@@ -61,17 +88,45 @@ def cut_wcs(
         yend (float): ymax
         layername (string): layername on geoserver
         owsurl (string): ows endpoint
-        outfname (string): fname to store retrieved raster
+        outfname (string): fname to store retrieved raster, None to keep it in memory
         crs (int, optional): Defaults to 4326.
         all_box (bool, optional): Defaults to False.
+
+    When the tile cache is enabled the raster is assembled from cached tiles
+    and only the missing tiles are requested from the server.
+
+    Returns:
+        outfname, or a MemoryFile with the raster if outfname is None, free it
+        with close_raster
     """
+    tile_cache = get_tile_cache()
+    if tile_cache is not None and crs == 4326:
+        try:
+            return tile_cache.cut(
+                xst,
+                yst,
+                xend,
+                yend,
+                layername,
+                owsurl,
+                outfname,
+                username=username,
+                password=password,
+            )
+        except Exception as e:
+            logging.info(f"Tile cache failed, requesting the coverage: {e}")
+
     linestr = "LINESTRING ({} {}, {} {})".format(xst, yst, xend, yend)
     ls = LS(linestr, crs, owsurl, layername, username, password)
     ls.line()
-    ls.getraster(outfname, all_box=all_box)
+    if outfname is None:
+        raster = MemoryFile(ls.getbytes())
+    else:
+        ls.getraster(outfname, all_box=all_box)
+        logging.info("Writing: {}".format(outfname))
+        raster = outfname
     ls = None
-    logging.info("Writing: {}".format(outfname))
-    return outfname
+    return raster
 
 
 def reproject_raster_gda_way(infname, outfname):
@@ -79,17 +134,22 @@ def reproject_raster_gda_way(infname, outfname):
     os.system(cmd)
 
 
+@timed("raster.reproject")
 def reproject_raster(infname, outfname, dst_crs="EPSG:3857"):
     """Tranforms a raster to another epsg, writes the new raster in the temp dir
 
     Args:
-        in_file (str, optional):  Defaults to "temp".
+        in_file (str, optional):  Defaults to "temp". Path or MemoryFile.
         dst_crs (str, optional):  Defaults to "EPSG:3857".
-        out_file (str, optional):  Defaults to "temp".
+        out_file (str, optional):  Defaults to "temp". None to keep it in memory.
+
+    Returns:
+        outfname, or a MemoryFile with the raster if outfname is None, free it
+        with close_raster
     """
     src_crs = {"init": "EPSG:4326"}
     dst_crs = {"init": "EPSG:3857"}
-    with rasterio.open(infname) as src:
+    with open_raster(infname) as src:
         transform, width, height = calculate_default_transform(
             src_crs, dst_crs, src.width, src.height, *src.bounds
         )
@@ -97,7 +157,13 @@ def reproject_raster(infname, outfname, dst_crs="EPSG:3857"):
         kwargs.update(
             {"crs": dst_crs, "transform": transform, "width": width, "height": height}
         )
-        with rasterio.open(outfname, "w", **kwargs) as dst:
+        if outfname is None:
+            raster = MemoryFile()
+            dst = raster.open(**kwargs)
+        else:
+            raster = outfname
+            dst = rasterio.open(raster, "w", **kwargs)
+        with dst:
             for i in range(1, src.count + 1):
                 reproject(
                     source=rasterio.band(src, i),
@@ -108,6 +174,7 @@ def reproject_raster(infname, outfname, dst_crs="EPSG:3857"):
                     dst_crs=dst_crs,
                     resampling=Resampling.nearest,
                 )
+    return raster
 
 
 # line in epsg: 3857 as shapely object
@@ -117,53 +184,153 @@ def reproject_raster(infname, outfname, dst_crs="EPSG:3857"):
 def line_segmentation(line, line_length, step):
     """Returns the transect in segments
 
+    Vectorized densification of the line: the points are interpolated on the
+    cumulative length of the vertices, so lines with several vertices work too.
+
     Args:
-        line :
-        line_length :
-        step :
+        line : shapely LineString
+        line_length : the line is segmented up to this length
+        step : distance between the points, can be a float
 
     Returns:
-       segments, points
+       segments (distances along the line), points (N x 2 array of x, y)
     """
-    segments = [segment for segment in range(0, int(line_length), step)]
+    if step <= 0:
+        raise ValueError(f"The step should be positive, not {step}")
+    segments = np.arange(0, int(line_length), step)
 
-    points = tuple(
-        map(
-            lambda segment: (line.interpolate(segment).x, line.interpolate(segment).y),
-            segments,
+    coords = np.asarray(line.coords, dtype=float)[:, :2]
+    vertex_distances = np.concatenate(
+        ([0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T)))
+    )
+    points = np.column_stack(
+        (
+            np.interp(segments, vertex_distances, coords[:, 0]),
+            np.interp(segments, vertex_distances, coords[:, 1]),
         )
     )
     return segments, points
 
 
-def get_elevation_profile(dem_path, line, line_length, temp_dir):
+def sample_raster(values, transform, xs, ys, nodata=None, resampling="nearest"):
+    """Vectorized lookup of raster values at points in the crs of the raster
+
+    Args:
+        values: 2D array of the band
+        transform: affine transform of the raster
+        xs, ys: coordinates of the points
+        nodata: nodata value of the band
+        resampling: "nearest" or "bilinear"
+
+    Returns:
+        array of values, NaN for nodata and points outside the raster
+    """
+    values = np.asarray(values, dtype=float)
+    if nodata is not None:
+        values = np.where(values == nodata, np.nan, values)
+    height, width = values.shape
+    cols, rows = ~transform * (np.asarray(xs, dtype=float), np.asarray(ys, dtype=float))
+
+    def lookup(r, c):
+        inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+        result = np.full(np.shape(r), np.nan)
+        result[inside] = values[r[inside], c[inside]]
+        return result
+
+    if resampling == "nearest":
+        return lookup(np.floor(rows).astype(int), np.floor(cols).astype(int))
+    elif resampling == "bilinear":
+        inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        # weights relative to the centers of the surrounding pixels, clamped to the
+        # centers of the edge pixels, so the outer half pixel gets the edge values
+        fr = np.clip(np.where(inside, rows - 0.5, 0), 0, height - 1)
+        fc = np.clip(np.where(inside, cols - 0.5, 0), 0, width - 1)
+        r0, c0 = np.floor(fr).astype(int), np.floor(fc).astype(int)
+        r1, c1 = np.minimum(r0 + 1, height - 1), np.minimum(c0 + 1, width - 1)
+        wr, wc = fr - r0, fc - c0
+        result = (
+            values[r0, c0] * (1 - wr) * (1 - wc)
+            + values[r0, c1] * (1 - wr) * wc
+            + values[r1, c0] * wr * (1 - wc)
+            + values[r1, c1] * wr * wc
+        )
+        return np.where(inside, result, np.nan)
+    raise ValueError(f"Unknown resampling method {resampling}")
+
+
+@timed("raster.elevation_profile")
+def get_elevation_profile(dem_path, line, line_length, resampling="nearest"):
     """Returns elevation values over the transect with a step eqaul to the resolution of the raster
 
+    The points of the transect are transformed to the crs of the DEM and sampled
+    from the native raster, instead of warping the whole raster to EPSG:3857.
+    The step is still a third of the pixel size the raster would have in EPSG:3857.
+
     Args:
-        dem_path: the path of the file
+        dem_path: the path of the file, or a MemoryFile
         line: transect at epsg:3857
         line_length: transect length
-        temp_dir: the unique temp directory to store it
-        step (int, optional):
+        resampling: "nearest" or "bilinear"
     
     Returns:
         elevations, segments
     """
 
-    # reproject raster Epsg:3857
-    dem_reproject_path = Path(temp_dir) / "dem_3857.tif"
-    
-    reproject_raster(dem_path, dem_reproject_path)
+    with open_raster(dem_path) as src:
+        src_crs = src.crs or "EPSG:4326"
+        transform, _, _ = calculate_default_transform(
+            src_crs, "EPSG:3857", src.width, src.height, *src.bounds
+        )
+        step = transform.a / 3 #calculate the step from the resolution of the raster
+        segments, points = line_segmentation(line, line_length, step)
+
+        to_dem_crs = Transformer.from_crs("EPSG:3857", src_crs, always_xy=True)
+        xs, ys = to_dem_crs.transform(points[:, 0], points[:, 1])
+        elevations = sample_raster(
+            src.read(1), src.transform, xs, ys, nodata=src.nodata, resampling=resampling
+        )
+        return list(elevations), segments
 
-    # sample the raster over the transect
-    with rasterio.open(dem_reproject_path) as dst:
-       
 
-        step = dst.res[0] / 3 #calculate the step from the resolution of the raster
-        segments, points = line_segmentation(line, line_length, int(step))
-        values = dst.sample(points, 1, True)
-        elevations = [value[0] for value in values]
-        return elevations, segments
+@timed("raster.elevation_profiles")
+def get_elevation_profiles(dem_path, lines, bboxes, resampling="nearest"):
+    """get_elevation_profile for many transects on one raster, e.g. the merged
+    coverage of a batch. The raster is read once.
+
+    Args:
+        dem_path: the path of the file, or a MemoryFile
+        lines: transects at epsg:3857, sampled over their whole length
+        bboxes: per transect the bbox cut_wcs would have been given for it alone.
+            The step depends on the extent of the raster, so it is taken from the
+            pixels of that bbox, see bbox_window.
+        resampling: "nearest" or "bilinear"
+
+    Returns:
+        list of (elevations, segments), in the order of lines
+    """
+    with open_raster(dem_path) as src:
+        src_crs = src.crs or "EPSG:4326"
+        values = src.read(1).astype(float)
+        if src.nodata is not None:
+            values[values == src.nodata] = np.nan
+        to_dem_crs = Transformer.from_crs("EPSG:3857", src_crs, always_xy=True)
+        profiles = []
+        for line, bbox in zip(lines, bboxes):
+            window = bbox_window(src, *bbox)
+            transform, _, _ = calculate_default_transform(
+                src_crs,
+                "EPSG:3857",
+                window.width,
+                window.height,
+                *src.window_bounds(window),
+            )
+            segments, points = line_segmentation(line, line.length, transform.a / 3)
+            xs, ys = to_dem_crs.transform(points[:, 0], points[:, 1])
+            elevations = sample_raster(
+                values, src.transform, xs, ys, resampling=resampling
+            )
+            profiles.append((list(elevations), segments))
+        return profiles
 
 
 def detect_pattern(searchval, array):
@@ -171,6 +338,146 @@ def detect_pattern(searchval, array):
     return pattern
 
 
+# Pairs of consecutive slope signs where a new monotonic run of the profile starts
+SLOPE_BREAKS = ([0, 1], [1, -1], [-1, 1], [-1, 0], [1, 0])
+
+
+def run_slopes(x, y, starts, ends):
+    """Least-squares slope of every run [start, end) of the points, the same as
+    linregress per run but closed-form on per-run sums (np.add.reduceat).
+
+    Args:
+        x, y: coordinates of the points
+        starts, ends: first and one past the last index of every run. Runs have at
+            least two points and may share their boundary point.
+
+    Returns:
+        array with the slope of every run
+    """
+    if len(starts) == 0:
+        return np.zeros(0)
+    bounds = np.column_stack((starts, ends)).ravel()
+
+    def run_sums(values):
+        # the even results are the sums over [start, end), pad so end can be len(values)
+        return np.add.reduceat(np.append(values, 0.0), bounds)[::2]
+
+    n = ends - starts
+    sx, sy = run_sums(x), run_sums(y)
+    sxx, sxy = run_sums(x * x), run_sums(x * y)
+    return (n * sxy - sx * sy) / (n * sxx - sx * sx)
+
+
+def batch_piecewise_slopes(elevations, segments, offsets):
+    """Piecewise slopes of many profiles at once, see piecewise_slopes.
+
+    The profiles are given in a ragged (CSR) layout: the elevations and segments of
+    profile i are elevations[offsets[i]:offsets[i + 1]].
+
+    Returns:
+        absolute slope in % of every run, and the profile index of every run.
+        Profiles without a change of slope have no runs.
+    """
+    y = np.nan_to_num(np.asarray(elevations, dtype=float))
+    x = np.asarray(segments, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    profile = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        msign = np.sign(np.diff(y) / np.diff(x))
+    # differences between two profiles never match a pattern
+    msign[profile[:-1] != profile[1:]] = 2
+
+    breaks = np.zeros(max(len(msign) - 1, 0), dtype=bool)
+    for searchval in SLOPE_BREAKS:
+        breaks |= detect_pattern(searchval, msign)
+    indeces = np.flatnonzero(breaks) + 2
+
+    # every profile with breaks runs from its start to the first break, between
+    # the breaks and from the last break to its end
+    with_breaks = np.unique(profile[indeces])
+    starts = np.sort(np.concatenate((offsets[with_breaks], indeces - 1)))
+    ends = np.sort(np.concatenate((indeces, offsets[with_breaks + 1])))
+    slopes = np.abs(run_slopes(x, y, starts, ends) * 100)
+    return slopes, profile[starts]
+
+
+def piecewise_slopes(elevations, segments):
+    """Splits the profile in monotonic runs at every change of slope (negative to
+    positive and reverse, and from or to flat) and returns the absolute slope of
+    every run in %. Consecutive runs share their boundary point.
+
+    NOTE: the nan values are replaced with 0, assuming that at the level of the sea
+    the height will be 0.
+
+    Raises:
+        ValueError: if the slope does not change along the profile
+    """
+    slopes, _ = batch_piecewise_slopes(elevations, segments, [0, len(elevations)])
+    if len(slopes) == 0:
+        raise ValueError("The slope does not change along the profile")
+    return slopes
+
+
+def profiles_from_padded(elevations, segments, lengths):
+    """Converts padded 2D arrays (one profile per row) to the ragged layout of
+    calc_slopes_batch
+
+    Returns:
+        elevations, segments, offsets
+    """
+    elevations = np.asarray(elevations)
+    segments = np.asarray(segments)
+    lengths = np.asarray(lengths, dtype=int)
+    keep = np.arange(elevations.shape[1]) < lengths[:, None]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    return elevations[keep], segments[keep], offsets
+
+
+def calc_slopes_batch(elevations, segments, offsets):
+    """Batched calc_slope and calc_slope_200m_inland for many profiles in one
+    vectorized pass.
+
+    Args:
+        elevations, segments: values of all profiles after each other
+        offsets: start of every profile and the total length, see profiles_from_padded
+
+    Returns:
+        mean slope, max slope and max slope 200 m inland per profile. Mean and max
+        are NaN for profiles without a change of slope, where calc_slope raises;
+        the 200 m inland slope is 0 then, like calc_slope_200m_inland.
+    """
+    elevations = np.asarray(elevations, dtype=float)
+    segments = np.asarray(segments, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    n_profiles = len(offsets) - 1
+
+    def reduce(slopes, profile):
+        count = np.bincount(profile, minlength=n_profiles)
+        total = np.bincount(profile, weights=slopes, minlength=n_profiles)
+        maximum = np.full(n_profiles, -np.inf)
+        np.maximum.at(maximum, profile, slopes)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_slope = np.where(count > 0, total / count, np.nan)
+        return mean_slope, np.where(count > 0, maximum, np.nan)
+
+    mean_slope, max_slope = reduce(
+        *batch_piecewise_slopes(elevations, segments, offsets)
+    )
+
+    # the first points up to 300 m of every profile
+    profile = np.repeat(np.arange(n_profiles), np.diff(offsets))
+    inland = segments < 300
+    inland_offsets = np.concatenate(
+        ([0], np.cumsum(np.bincount(profile[inland], minlength=n_profiles)))
+    )
+    _, max_slope_200m = reduce(
+        *batch_piecewise_slopes(elevations[inland], segments[inland], inland_offsets)
+    )
+    return mean_slope, max_slope, np.nan_to_num(max_slope_200m)
+
+
+@timed("raster.calc_slope")
 def calc_slope(
     elevations,
     segments,
@@ -190,60 +497,11 @@ def calc_slope(
         mean and max slope
     """
 
-    # Replace nan with 0
-    y = np.array(elevations)
-    y = np.nan_to_num(y) 
-
-    x = np.array(segments)
-
-    m = np.diff(y) / np.diff(x)
-
-    # detect change of slope (negative to positive and reverse)
-    msign = np.sign(m)
-    slope_patterns = np.array(
-        [
-            any(pattern)
-            for pattern in zip(
-                detect_pattern([0, 1], msign),
-                detect_pattern([1, -1], msign),
-                detect_pattern([-1, 1], msign),
-                detect_pattern([-1, 0], msign),
-                detect_pattern([1, 0], msign),
-            )
-        ]
-    )
-
-    indeces = np.where(slope_patterns == True)[0] + 2
-    slopes = []
-    indeces_start = indeces - 1
-    loops = len(indeces) + 1
-    indeces_end = indeces
-
-    for i in range(loops):
-        if i == 0:
-            elevations = y[: indeces_end[i]]
-            distances = x[: indeces_end[i]]
-            a = linregress(distances, elevations)
-            slopes.append(a.slope)
-        elif i == len(indeces):
-            elevations = y[indeces_start[i - 1] :]
-            distances = x[indeces_start[i - 1] :]
-            a = linregress(distances, elevations)
-            slopes.append(a.slope)
-        else:
-            elevations = y[indeces_start[i - 1] : indeces_end[i]]
-            distances = x[indeces_start[i - 1] : indeces_end[i]]
-            a = linregress(distances, elevations)
-            slopes.append(a.slope)
-
-    slopes = [abs(slope * 100) for slope in slopes]
-
-    mean_slope = mean(slopes)
-    max_slope = max(slopes)
-
-    return mean_slope, max_slope
+    slopes = piecewise_slopes(elevations, segments)
+    return float(np.mean(slopes)), float(np.max(slopes))
 
 
+@timed("raster.calc_slope_200m_inland")
 def calc_slope_200m_inland(
     elevations,
     segments,
@@ -259,59 +517,10 @@ def calc_slope_200m_inland(
     """
 
     try:
-        # Replace nan with 0
-        y = np.array(elevations)
-        y = np.nan_to_num(y)
-
-        x = np.array(segments)
-        inland_200 = (np.argwhere(x < 300).shape)[0]
-
-        x = x[:inland_200]
-        y = y[:inland_200]
-
-        # slope of every segment
-        m = np.diff(y) / np.diff(x)
-
-        # detect change of slope (negative to positive and reverse)
-        msign = np.sign(m)
-        slope_patterns = np.array(
-            [
-                any(pattern)
-                for pattern in zip(
-                    detect_pattern([0, 1], msign),
-                    detect_pattern([1, -1], msign),
-                    detect_pattern([-1, 1], msign),
-                    detect_pattern([-1, 0], msign),
-                    detect_pattern([1, 0], msign),
-                )
-            ]
-        )
-
-        indeces = np.where(slope_patterns == True)[0] + 2
-        slopes = []
-        indeces_start = indeces - 1
-        loops = len(indeces) + 1
-        indeces_end = indeces
-
-        for i in range(loops):
-            if i == 0:
-                elevations = y[: indeces_end[i]]
-                distances = x[: indeces_end[i]]
-                a = linregress(distances, elevations)
-                slopes.append(a.slope)
-            elif i == len(indeces):
-                elevations = y[indeces_start[i - 1] :]
-                distances = x[indeces_start[i - 1] :]
-                a = linregress(distances, elevations)
-                slopes.append(a.slope)
-            else:
-                elevations = y[indeces_start[i - 1] : indeces_end[i]]
-                distances = x[indeces_start[i - 1] : indeces_end[i]]
-                a = linregress(distances, elevations)
-                slopes.append(a.slope)
-
-        slopes = [abs(slope * 100) for slope in slopes]
-        max_slope = max(slopes)
+        x = np.asarray(segments)
+        inland_200 = np.count_nonzero(x < 300)
+        slopes = piecewise_slopes(np.asarray(elevations)[:inland_200], x[:inland_200])
+        max_slope = float(np.max(slopes))
     except Exception:
         logging.info("slope is 0 along the line")
         max_slope = 0.00
@@ -319,16 +528,47 @@ def calc_slope_200m_inland(
     return max_slope
 
 
+@timed("raster.read_values")
 def read_raster_values(file):
-    with rasterio.open(file) as dataset:
+    with open_raster(file) as dataset:
         values = dataset.read(1)
         return values
 
 
+def bbox_window(dataset, xst, yst, xend, yend):
+    """Window of the pixels that cut_wcs would return for the bbox, on a raster
+    on the grid of the coverage that covers the bbox
+
+    Returns:
+        rasterio Window
+    """
+    left, bottom = dataset.bounds.left, dataset.bounds.bottom
+    resx, resy = dataset.res
+    # the pixels LS.line selects: from the pixel of the lower left corner up
+    # to and including the pixel of the upper right corner
+    col0 = int((xst - left) // resx)
+    col1 = int((xend - left) // resx) + 1
+    row0 = dataset.height - (int((yend - bottom) // resy) + 1)
+    row1 = dataset.height - int((yst - bottom) // resy)
+    return Window(col0, row0, col1 - col0, row1 - row0)
+
+
+@timed("raster.read_values")
+def read_raster_values_in_bbox(file, xst, yst, xend, yend):
+    """read_raster_values of the pixels of a bbox, see bbox_window
+
+    Returns:
+        2D array of the values
+    """
+    with open_raster(file) as dataset:
+        return dataset.read(1, window=bbox_window(dataset, xst, yst, xend, yend))
+
+
+@timed("raster.median_elevation")
 def calc_median_elevation(dem, mask_layer):
-    dataset = rasterio.open(dem)
-    # mask raster based on mask geojson layer (land polygon) and set where nan to 
-    masked_values, out_transform = mask(dataset, [mask_layer["geometry"]], crop=True)
+    with open_raster(dem) as dataset:
+        # mask raster based on mask geojson layer (land polygon) and set where nan to 
+        masked_values, out_transform = mask(dataset, [mask_layer["geometry"]], crop=True)
     
     masked_values = np.ma.masked_where(masked_values == -9999, masked_values)
     
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# Persistent on-disk tile cache for the WCS coverages (DEM, landcover).
+# The coverage is divided in tiles of tile_size x tile_size native pixels, counted
+# from the lower left corner of the coverage like LS.line does. A requested bbox is
+# assembled from the cached tiles and only the missing tiles are fetched with a
+# GetCoverage request. Tiles are evicted least recently used above max_size_mb.
+
+import hashlib
+import logging
+import os
+from pathlib import Path
+import tempfile
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+
+from .metrics_utils import count, register_gauges, timed
+from .utils import read_section_config
+from .wcs_utils import WCS
+
+LOGGER = logging.getLogger("PYWPS")
+
+service_path = Path(__file__).resolve().parent
+
+# Defaults for the optional [TileCache] section of configuration.txt
+TILE_CACHE_DEFAULTS = {
+    "enabled": False,
+    # empty means processes/tilecache
+    "path": "",
+    "tile_size": 256,
+    "max_size_mb": 2048,
+}
+TILE_LOCK_STRIPES = 64
+
+
+class TileCache:
+    """Disk cache of coverage tiles, keyed by server, layer and tile index"""
+
+    def __init__(self, path, tile_size=256, max_size_mb=2048):
+        self.path = Path(path)
+        self.tile_size = tile_size
+        self.max_size = max_size_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        # fetches of the same tile are serialized; a fixed set of locks, picked by
+        # the hash of the tile, keeps the memory bounded
+        self._tile_locks = [threading.Lock() for _ in range(TILE_LOCK_STRIPES)]
+        self._size = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_fetched = 0
+
+    def _layer_dir(self, owsurl, layername) -> Path:
+        host = hashlib.sha1(owsurl.encode()).hexdigest()[:8]
+        return self.path / host / layername.replace(":", "__")
+
+    def _tile_lock(self, tile_path):
+        return self._tile_locks[hash(tile_path) % len(self._tile_locks)]
+
+    def _fetch_tile(self, wcs, tile_path, px0, py0, px1, py1):
+        """Downloads the native pixels [px0, px1) x [py0, py1) of the coverage"""
+        wcs.bbox = (
+            wcs.lx + px0 * wcs.resx,
+            wcs.ly + py0 * wcs.resy,
+            wcs.lx + px1 * wcs.resx,
+            wcs.ly + py1 * wcs.resy,
+        )
+        wcs.width = px1 - px0
+        wcs.height = py1 - py0
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        # write next to the tile and rename, so other processes never read half a
+        # tile. Not as .tif, which evict would count and could remove meanwhile.
+        fd, tmp_name = tempfile.mkstemp(suffix=".part", dir=tile_path.parent)
+        os.close(fd)
+        try:
+            if wcs.username and wcs.password:
+                wcs.getw_with_auth(tmp_name)
+            else:
+                wcs.getw(tmp_name)
+            os.replace(tmp_name, tile_path)
+        except Exception:
+            os.remove(tmp_name)
+            raise
+        size = tile_path.stat().st_size
+        with self._lock:
+            self.misses += 1
+            self.bytes_fetched += size
+            if self._size is not None:
+                self._size += size
+
+    def _get_tile(self, wcs, layer_dir, tx, ty) -> Path:
+        tile_path = layer_dir / f"{tx}_{ty}.tif"
+        with self._tile_lock(tile_path):
+            if tile_path.exists():
+                os.utime(tile_path)  # mark as recently used
+                with self._lock:
+                    self.hits += 1
+                count("tiles.hits")
+            else:
+                count("tiles.misses")
+                size = self.tile_size
+                self._fetch_tile(
+                    wcs,
+                    tile_path,
+                    tx * size,
+                    ty * size,
+                    min((tx + 1) * size, wcs.cx),
+                    min((ty + 1) * size, wcs.cy),
+                )
+        return tile_path
+
+    @timed("tiles.cut")
+    def cut(
+        self,
+        xst,
+        yst,
+        xend,
+        yend,
+        layername,
+        owsurl,
+        outfname,
+        username=None,
+        password=None,
+    ):
+        """Writes the native pixels that cover the bbox to outfname, like cut_wcs.
+        The bbox is in the native crs of the coverage. Without outfname the raster
+        is returned as a MemoryFile."""
+        wcs = WCS(owsurl, layername, username, password)
+        # same pixel window as LS.line, in pixels from the lower left corner
+        x1 = int((min(xst, xend) - wcs.lx) // wcs.resx)
+        y1 = int((min(yst, yend) - wcs.ly) // wcs.resy)
+        x2 = int((max(xst, xend) - wcs.lx) // wcs.resx) + 1
+        y2 = int((max(yst, yend) - wcs.ly) // wcs.resy) + 1
+
+        size = self.tile_size
+        layer_dir = self._layer_dir(owsurl, layername)
+        tiles = [
+            (tx, ty)
+            for tx in range(max(x1, 0) // size, (min(x2, wcs.cx) - 1) // size + 1)
+            for ty in range(max(y1, 0) // size, (min(y2, wcs.cy) - 1) // size + 1)
+        ]
+
+        profile = None
+        mosaic = None
+        for tx, ty in tiles:
+            px0, py0 = tx * size, ty * size
+            px1, py1 = min(px0 + size, wcs.cx), min(py0 + size, wcs.cy)
+            with rasterio.open(self._get_tile(wcs, layer_dir, tx, ty)) as src:
+                data = src.read()
+                if mosaic is None:
+                    profile = src.profile
+                    nodata = src.nodata if src.nodata is not None else 0
+                    mosaic = np.full(
+                        (src.count, y2 - y1, x2 - x1), nodata, dtype=data.dtype
+                    )
+            xa, xb = max(x1, px0), min(x2, px1)
+            ya, yb = max(y1, py0), min(y2, py1)
+            # rows run from the top, pixel indices from the bottom
+            mosaic[:, y2 - yb : y2 - ya, xa - x1 : xb - x1] = data[
+                :, py1 - yb : py1 - ya, xa - px0 : xb - px0
+            ]
+
+        if mosaic is None:
+            raise ValueError(f"The bbox is outside the coverage of {layername}")
+
+        profile.update(
+            driver="GTiff",
+            width=x2 - x1,
+            height=y2 - y1,
+            transform=Affine(
+                wcs.resx, 0, wcs.lx + x1 * wcs.resx, 0, -wcs.resy, wcs.ly + y2 * wcs.resy
+            ),
+        )
+        for option in ("blockxsize", "blockysize", "tiled"):
+            profile.pop(option, None)
+        if outfname is None:
+            raster = MemoryFile()
+            with raster.open(**profile) as dst:
+                dst.write(mosaic)
+        else:
+            with rasterio.open(outfname, "w", **profile) as dst:
+                dst.write(mosaic)
+            raster = outfname
+
+        self.evict()
+        return raster
+
+    def evict(self):
+        """Removes the least recently used tiles while the cache is above max_size"""
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+            tiles = []
+            for tile_path in self.path.rglob("*.tif"):
+                try:
+                    stat = tile_path.stat()
+                except OSError:
+                    continue
+                tiles.append((stat.st_mtime, stat.st_size, tile_path))
+            self._size = sum(size for _, size, _ in tiles)
+            tiles.sort()
+            while tiles and self._size > self.max_size:
+                _, size, tile_path = tiles.pop(0)
+                try:
+                    tile_path.unlink()
+                except OSError:
+                    continue
+                self._size -= size
+                LOGGER.info(f"Evicted tile {tile_path} from the tile cache")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_fetched": self.bytes_fetched,
+                "bytes": self._size,
+            }
+
+
+_tile_cache = None
+_tile_cache_lock = threading.Lock()
+
+
+def get_tile_cache():
+    """Returns the process-wide tile cache, or None if it is not enabled
+    in the [TileCache] section of configuration.txt"""
+    global _tile_cache
+    with _tile_cache_lock:
+        if _tile_cache is None:
+            settings = read_section_config("TileCache", TILE_CACHE_DEFAULTS)
+            if settings["enabled"]:
+                _tile_cache = TileCache(
+                    settings["path"] or service_path / "tilecache",
+                    tile_size=settings["tile_size"],
+                    max_size_mb=settings["max_size_mb"],
+                )
+                register_gauges("tile_cache", lambda: {"tiles": _tile_cache.stats()})
+            else:
+                _tile_cache = False
+    return _tile_cache or None
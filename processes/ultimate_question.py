@@ -2,6 +2,8 @@ from pywps.app import Process
 from pywps.inout.outputs import LiteralOutput
 from pywps.app.Common import Metadata
 
+from .metrics_utils import instrumented
+
 
 class UltimateQuestion(Process):
     def __init__(self):
@@ -28,6 +30,7 @@ class UltimateQuestion(Process):
             status_supported=False,
         )
 
+    @instrumented
     def _handler(self, request, response):
         response.outputs["answer"].data = "42"
         return response
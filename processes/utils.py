@@ -27,6 +27,9 @@
 # your own tools.
 
 import configparser
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+import os
 from pathlib import Path
 import tempfile
 import shutil
@@ -37,13 +40,23 @@ LOGGER = logging.getLogger("PYWPS")
 service_path = Path(__file__).resolve().parent
 
 
+def config_path(file_name="configuration.txt") -> Path:
+    """Path of a configuration file in the processes folder. The CHW_CONFIG
+    environment variable points configuration.txt elsewhere, e.g. to the one of
+    the local fixtures (see benchmarks/fixtures.py)."""
+    override = os.environ.get("CHW_CONFIG")
+    if override and file_name == "configuration.txt":
+        return Path(override)
+    return service_path / file_name
+
+
 def read_config(file_name="configuration.txt") -> tuple:
     """Reads the configuration file
     Returns:
         List with configuration
     """
 
-    cf_file = service_path / file_name
+    cf_file = config_path(file_name)
     cf = configparser.RawConfigParser()
     cf.read(cf_file)
     # POSTGIS
@@ -74,12 +87,102 @@ def read_config(file_name="configuration.txt") -> tuple:
     )
 
 
+def read_section_config(section, defaults, file_name="configuration.txt") -> dict:
+    """Reads an optional section of the configuration file
+
+    Every option that is missing from the section (or the whole section) falls back
+    to the value given in defaults. Values are converted to the type of their default.
+
+    Args:
+        section (str): name of the section, e.g. "Pool"
+        defaults (dict): option names and default values
+
+    Returns:
+        dict with the configured values
+    """
+
+    cf_file = config_path(file_name)
+    cf = configparser.RawConfigParser()
+    cf.read(cf_file)
+    settings = {}
+    for option, default in defaults.items():
+        if not cf.has_option(section, option):
+            settings[option] = default
+        elif isinstance(default, bool):
+            settings[option] = cf.getboolean(section, option)
+        elif isinstance(default, int):
+            settings[option] = cf.getint(section, option)
+        elif isinstance(default, float):
+            settings[option] = cf.getfloat(section, option)
+        else:
+            settings[option] = cf.get(section, option)
+    return settings
+
+
+def run_tasks(tasks, max_workers=None) -> dict:
+    """Runs independent tasks concurrently in a thread pool, respecting their dependencies.
+
+    A task starts as soon as all the tasks it depends on are finished. If a task
+    raises, the tasks that did not start yet are cancelled and the exception is raised.
+
+    Args:
+        tasks: dict name -> (function, names of the tasks it depends on). The function
+            is called with the results of its dependencies as keyword arguments.
+        max_workers: size of the thread pool
+
+    Returns:
+        dict name -> result of the task
+    """
+    for name, (_, dependencies) in tasks.items():
+        unknown = set(dependencies) - set(tasks)
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks {unknown}")
+
+    results = {}
+    running = {}
+    waiting = dict(tasks)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for name, (function, dependencies) in list(waiting.items()):
+                if all(dependency in results for dependency in dependencies):
+                    kwargs = {dependency: results[dependency] for dependency in dependencies}
+                    # a copy of the context per task, so the request metrics are kept
+                    context = contextvars.copy_context()
+                    running[executor.submit(context.run, function, **kwargs)] = name
+                    del waiting[name]
+            if not running:
+                raise ValueError(f"Tasks with circular dependencies: {list(waiting)}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for pending in running:
+                        pending.cancel()
+                    raise
+    return results
+
+
 def create_temp_dir(dir):
     # Temporary folder setup
     tmpdir = tempfile.mkdtemp(dir=dir)
     return tmpdir
 
 
+def directory_size(dir) -> int:
+    """Total size in bytes of the files below dir, 0 if it does not exist"""
+    size = 0
+    for path in Path(dir).rglob("*"):
+        try:
+            if path.is_file():
+                size += path.stat().st_size
+        except OSError:
+            # removed while walking
+            continue
+    return size
+
+
 def delete_tmp_dir(dir):
     try:
         shutil.rmtree(dir)
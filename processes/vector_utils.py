@@ -30,9 +30,16 @@
 from shapely.ops import transform
 import pyproj
 from pyproj import Proj
-from shapely.geometry import shape, box
+from shapely.geometry import shape, box, LineString, Point
 import geojson
 from shapely import wkt
+import numpy as np
+
+from .metrics_utils import timed
+
+# Geodesic calculations on the WGS84 ellipsoid, the spheroid PostGIS uses for
+# geography types in EPSG:4326.
+GEOD = pyproj.Geod(ellps="WGS84")
 
 
 def get_bounds(geom):
@@ -87,3 +94,189 @@ def change_coords(line, epsgin="EPSG:4326", epsgout="EPSG:3857"):
     ).transform
     g = transform(pyprojc_object, g)
     return g
+
+
+# Geodesic helpers. Local equivalents of the PostGIS functions that were used only
+# for geometry math (ST_Azimuth on geometries, ST_Project on geography). The forward
+# projection is solved on the WGS84 ellipsoid, so results agree with PostGIS within
+# 1e-8 degrees (about 1 mm) for distances up to 100 km. All helpers accept scalars
+# or NumPy arrays.
+
+
+def azimuth(x1, y1, x2, y2):
+    """Azimuth from point 1 to point 2 as ST_Azimuth computes it for geometries:
+    the planar angle in lon/lat space, clockwise from north.
+
+    Returns:
+        azimuth in degrees [0, 360), NaN for coinciding points
+    """
+    dx = np.subtract(x2, x1, dtype=float)
+    dy = np.subtract(y2, y1, dtype=float)
+    with np.errstate(invalid="ignore"):
+        az = np.degrees(np.arctan2(dx, dy)) % 360
+    return np.where((dx == 0) & (dy == 0), np.nan, az)
+
+
+def project(x, y, distance, az):
+    """Geodesic forward projection, the equivalent of ST_Project on geography
+
+    Args:
+        x, y: start longitude and latitude
+        distance: distance in meters
+        az: azimuth in degrees clockwise from north
+
+    Returns:
+        longitude, latitude of the end point
+    """
+    x, y, distance, az = np.broadcast_arrays(
+        *(np.asarray(v, dtype=float) for v in (x, y, distance, az))
+    )
+    if np.isnan(az).any():
+        raise ValueError("Cannot project a point without azimuth")
+    lon, lat, _ = GEOD.fwd(x.ravel(), y.ravel(), az.ravel(), distance.ravel())
+    return np.reshape(lon, x.shape), np.reshape(lat, x.shape)
+
+
+def line_azimuth(line, direction=180):
+    """Azimuth of a line, see azimuth
+
+    Args:
+        line: shapely LineString
+        direction: 180 from the start to the end point, -180 from the end to the start point
+
+    Returns:
+        azimuth in degrees
+    """
+    (x1, y1), (x2, y2) = line.coords[0][:2], line.coords[-1][:2]
+    if direction == 180:
+        az = azimuth(x1, y1, x2, y2)
+    elif direction == -180:
+        az = azimuth(x2, y2, x1, y1)
+    else:
+        raise ValueError(f"direction should be 180 or -180, not {direction}")
+    if np.isnan(az):
+        raise ValueError("Cannot calculate the azimuth of a line of zero length")
+    return float(az)
+
+
+def line_extend(transect_wkt, dist=0, direction=-180) -> str:
+    """Local equivalent of DB.ST_line_extend
+
+    Args:
+        transect_wkt: transect in EPSG:4326, start point on the coast
+        dist: distance in meters
+        direction: 180 to extend inland, -180 to extend in the sea
+
+    Returns:
+        line from the start point of the transect to its projection, as wkt
+    """
+    return extend_transect(transect_wkt, {"line": (dist, direction)})["line"]
+
+
+@timed("vector.extend_transect")
+def extend_transect(transect_wkt, extensions) -> dict:
+    """Builds all the extended lines of a transect in one vectorized step.
+
+    Every line starts at the start point of the transect (the coast) and ends at
+    the geodesic projection of that point over the given distance, in the
+    direction of the transect.
+
+    Args:
+        transect_wkt: transect in EPSG:4326, start point on the coast
+        extensions: dict name -> (distance in meters, direction), where direction is
+            180 to extend inland and -180 to extend in the sea
+
+    Returns:
+        dict name -> extended line as wkt
+    """
+    line = wkt.loads(transect_wkt)
+    x, y = line.coords[0][:2]
+    names = list(extensions)
+    azimuths = [line_azimuth(line, extensions[name][1]) for name in names]
+    distances = [extensions[name][0] for name in names]
+    lons, lats = project(x, y, distances, azimuths)
+    return {
+        name: LineString([(x, y), (lon, lat)]).wkt
+        for name, lon, lat in zip(names, lons, lats)
+    }
+
+
+def create_transect_in_coast(point_on_sea, point_on_coast, dist) -> str:
+    """Local equivalent of DB.create_transect_in_coast. Creates a transect that
+    starts at the coast and continues inland, in the direction from the point in
+    the sea to the point on the coast.
+
+    Args:
+        point_on_sea: point clicked by the user as wkt
+        point_on_coast: closest point of the coastline as wkt
+        dist: length of the transect in meters
+
+    Returns:
+        transect as wkt
+    """
+    x1, y1 = wkt.loads(point_on_sea).coords[0][:2]
+    x2, y2 = wkt.loads(point_on_coast).coords[0][:2]
+    lon, lat = project(x2, y2, dist, azimuth(x1, y1, x2, y2))
+    return LineString([(x2, y2), (float(lon), float(lat))]).wkt
+
+
+def canonical_transect(segment_wkt, dist=500, offset=100):
+    """Canonical transect of a coastline segment: perpendicular to the middle of
+    the segment, pointing inland. OSM coastlines have the land on their left side.
+
+    Args:
+        segment_wkt: coastline segment in EPSG:4326 as wkt
+        dist: length of the transect in meters
+        offset: distance in meters of the point in the sea from the coast
+
+    Returns:
+        point in the sea as wkt, transect as wkt
+    """
+    return perpendicular_transect(segment_wkt, 0.5, dist=dist, offset=offset)
+
+
+def perpendicular_transect(segment_wkt, fraction, dist=500, offset=100):
+    """Transect perpendicular to a coastline segment at a point of the segment,
+    pointing inland, see canonical_transect
+
+    Args:
+        segment_wkt: coastline segment in EPSG:4326 as wkt
+        fraction: position of the point along the segment, 0 (start) to 1 (end)
+        dist: length of the transect in meters
+        offset: distance in meters of the point in the sea from the coast
+
+    Returns:
+        point in the sea as wkt, transect as wkt
+    """
+    line = wkt.loads(segment_wkt)
+    if line.geom_type == "MultiLineString":
+        line = max(line.geoms, key=lambda part: part.length)
+    on_coast = line.interpolate(fraction, normalized=True)
+    before = line.interpolate(max(fraction - 0.05, 0), normalized=True)
+    after = line.interpolate(min(fraction + 0.05, 1), normalized=True)
+    az = azimuth(before.x, before.y, after.x, after.y)
+    sea_x, sea_y = project(on_coast.x, on_coast.y, offset, (az + 90) % 360)
+    point_on_sea = Point(float(sea_x), float(sea_y)).wkt
+    return point_on_sea, create_transect_in_coast(point_on_sea, on_coast.wkt, dist)
+
+
+def points_along_line(line_wkt, spacing) -> list:
+    """Points every spacing meters (geodesic) along a line, starting at its start
+
+    Args:
+        line_wkt: LineString in EPSG:4326 as wkt
+        spacing: distance between the points in meters
+
+    Returns:
+        list of points as wkt
+    """
+    if spacing <= 0:
+        raise ValueError(f"The spacing should be positive, not {spacing}")
+    coords = np.asarray(wkt.loads(line_wkt).coords, dtype=float)[:, :2]
+    _, _, lengths = GEOD.inv(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+    vertex_distances = np.concatenate(([0], np.cumsum(lengths)))
+    distances = np.arange(0, vertex_distances[-1] + 1e-9, spacing)
+    # linear in lon/lat between the vertices, which are close on a drawn coastline
+    xs = np.interp(distances, vertex_distances, coords[:, 0])
+    ys = np.interp(distances, vertex_distances, coords[:, 1])
+    return [Point(float(x), float(y)).wkt for x, y in zip(xs, ys)]
@@ -1,30 +1,184 @@
+from concurrent.futures import Future
+import os
+import threading
+import time
+from typing import NamedTuple
+
 import numpy as np
 from owslib.wcs import WebCoverageService
 from owslib.util import Authentication
 from shapely import wkt
 
+from .metrics_utils import count, span, timed
+from .utils import read_section_config
+
+# Defaults for the optional options of the [GeoServer] section of configuration.txt
+COVERAGE_REGISTRY_DEFAULTS = {
+    # seconds before the coverage metadata is requested again
+    "metadata_ttl": 3600.0,
+}
+
+
+class CoverageMetadata(NamedTuple):
+    """Grid of a coverage as described by DescribeCoverage"""
+
+    cx: int
+    cy: int
+    crs: str
+    bbox: tuple
+
+
+class CoverageRegistry:
+    """Process-level cache of the WebCoverageService objects and the metadata of
+    their coverages, so GetCapabilities/DescribeCoverage are requested once per
+    ttl instead of on every cut_wcs."""
+
+    def __init__(self, ttl=3600.0):
+        self.ttl = ttl
+        self._services = {}  # (host, username, password) -> (service, loaded at)
+        self._coverages = {}  # (host, username, password, layer) -> (metadata, loaded at)
+        self._loading = {}  # (store name, key) -> Future of the request in flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, loaded_at):
+        return time.monotonic() - loaded_at < self.ttl
+
+    def _load(self, name, key, load):
+        """Returns the cached value of key, or loads it. The lock only guards the
+        dicts: the request runs outside of it, and threads asking for the same
+        key meanwhile wait for that request instead of sending their own.
+
+        Returns:
+            value, True if it was not requested for this call
+        """
+        store = getattr(self, name)
+        with self._lock:
+            entry = store.get(key)
+            if entry is not None and self._fresh(entry[1]):
+                return entry[0], True
+            future = self._loading.get((name, key))
+            loading = future is None
+            if loading:
+                future = self._loading[(name, key)] = Future()
+        if not loading:
+            return future.result(), True
+        try:
+            value = load()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[(name, key)]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            store[key] = (value, time.monotonic())
+            del self._loading[(name, key)]
+        future.set_result(value)
+        return value, False
+
+    def _service(self, host, username, password):
+        def load():
+            with span("wcs.get_capabilities"):
+                if password and username:
+                    return WebCoverageService(
+                        host,
+                        version="1.0.0",
+                        auth=Authentication(username=username, password=password),
+                    )
+                return WebCoverageService(host, version="1.0.0")
+
+        service, _ = self._load("_services", (host, username, password), load)
+        return service
+
+    def get(self, host, layer, username, password):
+        """Returns the WebCoverageService and the CoverageMetadata of a layer"""
+        service = self._service(host, username, password)
+
+        def load():
+            with span("wcs.describe_coverage"):
+                coverage = service[layer]
+                cx, cy = map(int, coverage.grid.highlimits)
+            return CoverageMetadata(
+                cx=cx,
+                cy=cy,
+                crs=coverage.boundingboxes[0]["nativeSrs"],
+                bbox=tuple(coverage.boundingboxes[0]["bbox"]),
+            )
+
+        metadata, cached = self._load(
+            "_coverages", (host, username, password, layer), load
+        )
+        with self._lock:
+            if cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return service, metadata
+
+    def invalidate(self, host=None, layer=None):
+        """Drops the cached services and metadata, of one host and/or layer if given"""
+        with self._lock:
+            for key in list(self._coverages):
+                if (host is None or key[0] == host) and (layer is None or key[3] == layer):
+                    del self._coverages[key]
+            if layer is None:
+                for key in list(self._services):
+                    if host is None or key[0] == host:
+                        del self._services[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coverages": len(self._coverages),
+            }
+
+
+_coverage_registry = None
+_coverage_registry_lock = threading.Lock()
+
+
+def get_coverage_registry() -> CoverageRegistry:
+    """Returns the process-wide coverage registry"""
+    global _coverage_registry
+    with _coverage_registry_lock:
+        if _coverage_registry is None:
+            settings = read_section_config("GeoServer", COVERAGE_REGISTRY_DEFAULTS)
+            _coverage_registry = CoverageRegistry(ttl=settings["metadata_ttl"])
+    return _coverage_registry
+
+
+def _reset_registry_after_fork():
+    """A forked process may inherit the lock while a thread of the parent held it,
+    or requests in flight that never finish in the child. It starts with a new
+    registry instead."""
+    global _coverage_registry, _coverage_registry_lock
+    _coverage_registry = None
+    _coverage_registry_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_registry_after_fork)
+
+
 # TODO Check how can it be improved
 ## TO READ WCS outputs
 class WCS:
-    """WCS object to get metadata etc and to get grid."""
+    """WCS object to get metadata etc and to get grid.
+    The service and the grid metadata come from the process-wide coverage registry."""
 
     def __init__(self, host, layer, username, password):
+        self.host = host
         self.username = username
         self.password = password
         self.id = layer
-        self.wcs = (
-            WebCoverageService(
-                host,
-                version="1.0.0",
-                auth=Authentication(username=self.username, password=self.password),
-            )
-            if self.password and self.username
-            else WebCoverageService(host, version="1.0.0")
+        self.wcs, metadata = get_coverage_registry().get(
+            host, layer, username, password
         )
-        self.layer = self.wcs[self.id]
-        self.cx, self.cy = map(int, self.layer.grid.highlimits)
-        self.crs = self.layer.boundingboxes[0]["nativeSrs"]
-        self.bbox = self.layer.boundingboxes[0]["bbox"]
+        self.cx, self.cy = metadata.cx, metadata.cy
+        self.crs = metadata.crs
+        self.bbox = metadata.bbox
         self.lx, self.ly, self.hx, self.hy = map(float, self.bbox)
         self.resx, self.resy = (self.hx - self.lx) / self.cx, (
             self.hy - self.ly
@@ -32,36 +186,40 @@ class WCS:
         self.width = self.cx
         self.height = self.cy
 
+    @timed("wcs.get_coverage")
+    def getbytes(self) -> bytes:
+        """Downloads raster and returns the GEOTIFF as bytes, without writing it to disk."""
+        auth = {}
+        if self.username and self.password:
+            auth["auth"] = Authentication(username=self.username, password=self.password)
+        try:
+            gc = self.wcs.getCoverage(
+                identifier=self.id,
+                bbox=self.bbox,
+                format="GeoTIFF",
+                crs=self.crs,
+                width=self.width,
+                height=self.height,
+                **auth,
+            )
+        except Exception:
+            # the layer may have changed on the server, describe it again next time
+            get_coverage_registry().invalidate(self.host, self.id)
+            raise
+        data = gc.read()
+        count("wcs.requests")
+        count("wcs.bytes", len(data))
+        return data
+
     def getw(self, fn):
         """Downloads raster and returns filename of written GEOTIFF in the tmp dir."""
-        gc = self.wcs.getCoverage(
-            identifier=self.id,
-            bbox=self.bbox,
-            format="GeoTIFF",
-            crs=self.crs,
-            width=self.width,
-            height=self.height,
-        )
-        f = open(fn, "wb")
-        f.write(gc.read())
-        f.close()
+        with open(fn, "wb") as f:
+            f.write(self.getbytes())
         return fn
 
     def getw_with_auth(self, fn):
-        """Downloads raster and returns filename of written GEOTIFF in the tmp dir."""
-        gc = self.wcs.getCoverage(
-            identifier=self.id,
-            bbox=self.bbox,
-            format="GeoTIFF",
-            crs=self.crs,
-            width=self.width,
-            height=self.height,
-            auth=Authentication(username=self.username, password=self.password),
-        )
-        f = open(fn, "wb")
-        f.write(gc.read())
-        f.close()
-        return fn
+        """Same as getw, getbytes authenticates when the WCS has credentials."""
+        return self.getw(fn)
 
 
 ## TO handle transects
@@ -178,6 +336,10 @@ class LS:
             num=self.subdiv,
         )
 
+    def getbytes(self):
+        """Returns the downloaded geotiff from wcs as bytes."""
+        return self.gs.getbytes()
+
     def getraster(self, fname, all_box=False):
         """Returns values of line intersection on downlaoded geotiff from wcs."""
         if self.gs.username and self.gs.password:
@@ -43,12 +43,42 @@ from pywps.app.Common import Metadata
 
 
 import json
+import logging
 
 import geojson
 from pathlib import Path
 
-from .chw_utils import CHW
-from .utils import write_output, delete_tmp_dir
+from .cache_utils import get_result_cache
+from .chw_utils import classify_transect
+from .db_utils import DB
+from .metrics_utils import collect, count, count_error, instrumented
+from .utils import read_config, delete_tmp_dir
+from .vector_utils import geojson_to_wkt
+
+LOGGER = logging.getLogger("PYWPS")
+
+
+def result_cache_key(cache, transect):
+    """Key of the transect in the result cache, None if the cache cannot be used
+    now. A broken cache (e.g. no data version in the database) must not break the
+    classification, so the transect is classified without it then."""
+    try:
+        host, user, password, db, _, _, dem_layer, _, _, _, _ = read_config()
+        with DB(user, password, host, db) as version_db:
+            data_version = cache.data_version(version_db)
+        return cache.key(
+            geojson_to_wkt(transect),
+            # the wave exposure adds the coastline of the transect to the closest coasts
+            transect["properties"].get("coastline_id"),
+            dem_layer,
+            data_version,
+            # the notification of the transect ends up in the output
+            extra=transect["properties"].get("notification"),
+        )
+    except Exception:
+        LOGGER.exception("The result cache failed, classifying without it")
+        count("result_cache.errors")
+        return None
 
 
 
@@ -61,7 +91,14 @@ class WpsCoastalHazardWheel(Process):
                 title="transect",
                 supported_formats=[Format("application/json")],
                 abstract="Complex input abstract",
-            )
+            ),
+            LiteralInput(
+                identifier="debug",
+                title="Return the stage timings of the request in the output",
+                data_type="boolean",
+                min_occurs=0,
+                default=False,
+            ),
         ]
 
         # Output [in json format]
@@ -87,47 +124,54 @@ class WpsCoastalHazardWheel(Process):
             ],
             inputs=inputs,
             outputs=outputs,
-            store_supported=False,
-            status_supported=False,
+            store_supported=True,
+            status_supported=True,
         )
 
+    @instrumented
     def _handler(self, request, response):
         """Handler function of the WpsChw2"""
-        try:
-
-            line_str = request.inputs["transect"][0].data
-            line_geojson = geojson.loads(line_str)
-            # coastline_id = request.inputs["coastline_id"][0].data
-
-            chw = CHW(line_geojson)
-
-            # 1st level check
-            chw.get_info_geological_layout()
-            # 2nd level check
-            chw.get_info_wave_exposure()
-            # 3rd level check
-            chw.get_info_tidal_range()
-            # 4th level check
-            chw.get_info_flora_fauna()
-            # 5th level check
-            chw.get_info_sediment_balance()
-            # 6th level check
-            chw.get_info_storm_climate()
-
-            # classify hazards according to coastalhazardwheel decision tree
-            chw.hazards_classification()
-            # get measures
-            chw.provide_measures()
-            # get risk information for the transect
-            chw.get_risk_info()
-            # translate numbers 1,2,3,4 to low,
-            chw.translate_hazard_danger()  # TODO Remove this function and translate the numbers directly in the database
-
-            output = write_output(chw)
-            # TODO remove tmp folder.
-            # delete_tmp_dir(chw.tmp)
+        debug = "debug" in request.inputs and request.inputs["debug"][0].data
+        with collect() as metrics:
+            try:
+
+                line_str = request.inputs["transect"][0].data
+                line_geojson = geojson.loads(line_str)
+
+                # Serve a repeated request from the result cache
+                cached = None
+                key = None
+                cache = get_result_cache()
+                if cache is not None:
+                    key = result_cache_key(cache, line_geojson)
+                if key is not None:
+                    cached = cache.get(key)
+
+                if cached is not None:
+                    response.outputs["output_json"].data = cached
+                else:
+                    output = classify_transect(
+                        line_geojson, update_status=response.update_status
+                    )
+                    # TODO remove tmp folder.
+                    # delete_tmp_dir(chw.tmp)
+                    response.outputs["output_json"].data = json.dumps(output)
+                    # only successful classifications are cached
+                    if key is not None:
+                        cache.set(key, response.outputs["output_json"].data)
+
+            except Exception as e:
+                count_error(e)
+                res = {"errMsg": f"{e}"}
+                response.outputs["output_json"].data = json.dumps(res)
+
+        # the metrics describe this request only, they are never cached
+        if debug:
+            output = json.loads(response.outputs["output_json"].data)
+            if isinstance(output, list):
+                output.append({"title": "Metrics", "info": metrics.as_dict()})
+            else:
+                output["metrics"] = metrics.as_dict()
             response.outputs["output_json"].data = json.dumps(output)
 
-        except Exception as e:
-            res = {"errMsg": f"{e}"}
-            response.outputs["output_json"].data = json.dumps(res)
+        return response
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+#
+# Abstract: Classifies many transects at once, or a stretch of coastline with a
+#           transect every spacing meters, see batch_utils.
+# PyWPS
+
+# http://localhost:5000/wps?request=GetCapabilities&service=WPS&version=1.0.0
+# http://localhost:5000/wps?request=DescribeProcess&service=WPS&version=1.0.0&Identifier=chw_batch_classification
+
+from pywps import Process, Format
+from pywps.inout.inputs import ComplexInput, LiteralInput
+from pywps.inout.outputs import ComplexOutput
+from pywps.app.Common import Metadata
+
+import json
+from pathlib import Path
+
+import geojson
+
+from .batch_utils import (
+    batch_settings,
+    classify_batch,
+    complete_transects,
+    transects_along_coastline,
+)
+from .metrics_utils import count_error, instrumented
+from .vector_utils import geojson_to_wkt
+
+GEOJSON = Format("application/geo+json", extension=".geojson")
+NDJSON = Format("application/x-ndjson", extension=".ndjson")
+
+
+class WpsCoastalHazardWheelBatch(Process):
+    def __init__(self):
+        inputs = [
+            ComplexInput(
+                identifier="transects",
+                title="FeatureCollection of transects, drawn or created by chw_transect",
+                supported_formats=[Format("application/json")],
+                min_occurs=0,
+            ),
+            ComplexInput(
+                identifier="coastline",
+                title="LineString along the coast, classified every spacing meters",
+                supported_formats=[Format("application/json")],
+                min_occurs=0,
+            ),
+            LiteralInput(
+                identifier="spacing",
+                title="Distance in meters between the transects along the coastline",
+                data_type="float",
+                min_occurs=0,
+                default=500,
+            ),
+            LiteralInput(
+                identifier="output_format",
+                title="geojson (FeatureCollection) or ndjson (a Feature per line)",
+                data_type="string",
+                min_occurs=0,
+                default="geojson",
+                allowed_values=["geojson", "ndjson"],
+            ),
+        ]
+
+        outputs = [
+            ComplexOutput(
+                identifier="output",
+                title="Classified transects",
+                supported_formats=[GEOJSON, NDJSON],
+            )
+        ]
+
+        super(WpsCoastalHazardWheelBatch, self).__init__(
+            self._handler,
+            identifier="chw_batch_classification",
+            version="3.0",
+            title="Risk classification of many transects or a stretch of coastline.",
+            abstract="""Classifies a FeatureCollection of transects, or a transect every spacing meters along
+                        a coastline, with the Coastal Hazard Wheel. Close transects share their data. Every
+                        feature gets the output of chw_risk_classification, or an errMsg, in its properties.""",
+            profile="",
+            metadata=[
+                Metadata("WpsCoastalHazardWheelBatch"),
+                Metadata("WpsCoastalHazardWheelBatch/batch_classification"),
+            ],
+            inputs=inputs,
+            outputs=outputs,
+            store_supported=True,
+            status_supported=True,
+        )
+
+    @instrumented
+    def _handler(self, request, response):
+        """Handler function of the WpsCoastalHazardWheelBatch. The results are
+        written to the output file as they come, run the process asynchronously
+        (status=true) to follow the progress."""
+        ndjson = (
+            "output_format" in request.inputs
+            and request.inputs["output_format"][0].data == "ndjson"
+        )
+        path = Path(self.workdir) / ("output.ndjson" if ndjson else "output.geojson")
+        try:
+            if "transects" in request.inputs:
+                collection = geojson.loads(request.inputs["transects"][0].data)
+                features = collection["features"]
+                if len(features) > batch_settings["max_transects"]:
+                    raise ValueError(
+                        f"{len(features)} transects, at most "
+                        f"{batch_settings['max_transects']} are allowed"
+                    )
+                complete_transects(features)
+            elif "coastline" in request.inputs:
+                coastline = geojson.loads(request.inputs["coastline"][0].data)
+                spacing = (
+                    request.inputs["spacing"][0].data
+                    if "spacing" in request.inputs
+                    else 500
+                )
+                features = transects_along_coastline(geojson_to_wkt(coastline), spacing)
+            else:
+                raise ValueError("Give either transects or a coastline")
+
+            with open(path, "w") as output:
+                if not ndjson:
+                    output.write('{"type": "FeatureCollection", "features": [\n')
+
+                # the transects come in as soon as they are classified
+                written = []
+
+                def on_result(i, feature):
+                    if ndjson:
+                        output.write(json.dumps(feature) + "\n")
+                    else:
+                        output.write((",\n" if written else "") + json.dumps(feature))
+                    output.flush()
+                    written.append(i)
+                    response.update_status(
+                        f"Classified {len(written)} of {len(features)} transects",
+                        int(100 * len(written) / len(features)),
+                    )
+
+                classify_batch(features, on_result=on_result)
+                if not ndjson:
+                    output.write("\n]}\n")
+
+        except Exception as e:
+            count_error(e)
+            with open(path, "w") as output:
+                output.write(json.dumps({"errMsg": f"{e}"}))
+
+        response.outputs["output"].data_format = NDJSON if ndjson else GEOJSON
+        response.outputs["output"].file = str(path)
+        return response
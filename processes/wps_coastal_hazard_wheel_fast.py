@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright notice
+#   --------------------------------------------------------------------
+#   Copyright (C) 2020 Deltares
+#       Gerrit Hendriksen, Ioanna Micha
+#       gerrit.hendriksen@deltares.nl, ioanna.micha@deltares.nl
+#
+#   This library is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This library is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this library.  If not, see <http://www.gnu.org/licenses/>.
+#   --------------------------------------------------------------------
+#
+# This tool is part of <a href="http://www.OpenEarth.eu">OpenEarthTools</a>.
+# OpenEarthTools is an online collaboration to share and manage data and
+# programming tools in an open source, version controlled environment.
+# Sign up to recieve regular updates of this function, and to contribute
+# your own tools.
+
+# $Abstract: Classifies the coast closest to a point in the sea from the
+#            precomputed classification of the coastline segments$
+#
+# PyWPS
+
+# http://localhost:5000/wps?request=DescribeProcess&service=WPS&version=1.0.0&Identifier=chw_fast_classification
+#
+
+from pywps import Process, Format
+from pywps.inout.inputs import ComplexInput
+from pywps.inout.outputs import ComplexOutput
+from pywps.app.Common import Metadata
+
+import json
+import geojson
+
+from .metrics_utils import count_error, instrumented
+from .utils import read_config
+from .db_utils import DB
+from .precompute import precompute_segment
+from .vector_utils import geojson_to_wkt, wkt_geometry
+
+
+class WpsCoastalHazardWheelFast(Process):
+    def __init__(self):
+        # Input [in json format ]
+        inputs = [
+            ComplexInput(
+                identifier="sea_point",
+                title="sea_point",
+                supported_formats=[Format("application/json")],
+                abstract="Point in the sea, close to the coast",
+            )
+        ]
+
+        # Output [in json format]
+        outputs = [
+            ComplexOutput(
+                identifier="output_json",
+                title="Output of the CoastaHazardWheel",
+                supported_formats=[Format("application/json")],
+            ),
+            ComplexOutput(
+                identifier="transect_json",
+                title="Transect of the classified coastline segment",
+                supported_formats=[Format("application/json")],
+            ),
+        ]
+
+        super(WpsCoastalHazardWheelFast, self).__init__(
+            self._handler,
+            identifier="chw_fast_classification",
+            version="1.0",
+            title="Risk classification of the closest coastline segment.",
+            abstract="""Looks up the precomputed CHW classification of the coastline segment closest to a point in the sea.
+            Segments without a classification for the current data are classified on demand and stored.""",
+            profile="",
+            metadata=[
+                Metadata("WpsCoastalHazardWheelFast"),
+                Metadata("chw_fast_classification"),
+            ],
+            inputs=inputs,
+            outputs=outputs,
+            store_supported=False,
+            status_supported=False,
+        )
+
+    @instrumented
+    def _handler(self, request, response):
+        """Handler function of the WpsCoastalHazardWheelFast"""
+
+        try:
+            host, user, password, db, _, _, _, _, _, _, _ = read_config()
+            with DB(user, password, host, db) as db:
+                sea_point_as_str = request.inputs["sea_point"][0].data
+                sea_point_as_geojson = geojson.loads(sea_point_as_str)
+                sea_point_as_wkt = geojson_to_wkt(sea_point_as_geojson)
+                # Checks if the point is inside a land polygon, if yes then it returns a message
+                proceed, notification = db.find_special_areas(sea_point_as_wkt)
+                if proceed is False:
+                    raise ValueError(notification)
+
+                _, coastline_id = db.closest_point_of_coastline(sea_point_as_wkt)
+                data_version = db.get_data_version()
+                result = db.get_precomputed_classification(coastline_id, data_version)
+
+            # a miss is computed on demand, so the next click is a hit
+            if result is None:
+                result = precompute_segment(coastline_id, data_version)
+            if result["error"] is not None:
+                raise ValueError(result["error"])
+
+            geom = wkt_geometry(result["transect"])
+            response.outputs["output_json"].data = json.dumps(result["output"])
+            response.outputs["transect_json"].data = json.dumps(
+                {
+                    "transect_coordinates": geom["coordinates"],
+                    "coastline_id": coastline_id,
+                    "notification": result["notification"],
+                }
+            )
+
+        except Exception as e:
+            count_error(e)
+            res = {"errMsg": f"{e}"}
+            response.outputs["output_json"].data = json.dumps(res)
+            response.outputs["transect_json"].data = json.dumps(res)
+
+        return response
@@ -48,6 +48,7 @@ import geojson
 from pathlib import Path
 
 from .chw_utils import CHW
+from .metrics_utils import count_error, instrumented
 from .utils import write_output, delete_tmp_dir
 import time
 
@@ -91,6 +92,7 @@ class WpsCoastalHazardWheelTest(Process):
             status_supported=False,
         )
 
+    @instrumented
     def _handler(self, request, response):
         """Handler function of the WpsChw2"""
         try:
@@ -124,9 +126,12 @@ class WpsCoastalHazardWheelTest(Process):
             chw.translate_hazard_danger()  # TODO Remove this function and translate the numbers directly in the database
 
             output = write_output(chw)
+            # give the connection back to the pool
+            chw.db.close_db_connection()
             # TODO remove tmp folder.
             # delete_tmp_dir(chw.tmp)
             response.outputs["output_json"].data = json.dumps(output)
         except Exception as e:
+            count_error(e)
             res = {"errMsg": f"{e}"}
             response.outputs["output_json"].data = json.dumps(res)
@@ -42,9 +42,10 @@ from pywps.app.Common import Metadata
 import json
 import geojson
 
+from .metrics_utils import count_error, instrumented
 from .utils import read_config
 from .db_utils import DB
-from .vector_utils import geojson_to_wkt, wkt_geometry
+from .vector_utils import create_transect_in_coast, geojson_to_wkt, wkt_geometry
 
 
 class WpsCreateTransect(Process):
@@ -86,41 +87,44 @@ class WpsCreateTransect(Process):
             status_supported=False,
         )
 
+    @instrumented
     def _handler(self, request, response):
         """Handler function of the WpsCreateTransect"""
 
         try:
             host, user, password, db, _, _, _, _, _, _, _ = read_config()
-            db = DB(user, password, host, db)
+            with DB(user, password, host, db) as db:
 
-            # Read input
-            sea_point_as_str = request.inputs["sea_point"][0].data
-            # load geojson
-            sea_point_as_geojson = geojson.loads(sea_point_as_str)
-            sea_point_as_wkt = geojson_to_wkt(sea_point_as_geojson)
-            # Checks if the point is inside a land polygon, if yes then it returns a message
-            proceed, notification = db.find_special_areas(sea_point_as_wkt)
+                # Read input
+                sea_point_as_str = request.inputs["sea_point"][0].data
+                # load geojson
+                sea_point_as_geojson = geojson.loads(sea_point_as_str)
+                sea_point_as_wkt = geojson_to_wkt(sea_point_as_geojson)
+                # Checks if the point is inside a land polygon, if yes then it returns a message
+                proceed, notification = db.find_special_areas(sea_point_as_wkt)
 
-            if proceed is False:
-                output = {"errMsg": notification}
-                response.outputs["output_json"].data = json.dumps(output)
-            else:
-                coastline_point, coastline_id = db.closest_point_of_coastline(
-                    sea_point_as_wkt
-                )
-                transect = db.create_transect_in_coast(
-                    sea_point_as_wkt, coastline_point, 500
-                )
-                # prepare the output. Send the transect as a geosjon.
-                geom = wkt_geometry(transect)
-                output = {
-                    "transect_coordinates": geom["coordinates"],
-                    "coastline_id": coastline_id,
-                    "notification": notification,
-                }
-                response.outputs["output_json"].data = json.dumps(output)
+                if proceed is False:
+                    output = {"errMsg": notification}
+                    response.outputs["output_json"].data = json.dumps(output)
+                else:
+                    coastline_point, coastline_id = db.closest_point_of_coastline(
+                        sea_point_as_wkt
+                    )
+                    # geometry math only, no database round-trip
+                    transect = create_transect_in_coast(
+                        sea_point_as_wkt, coastline_point, 500
+                    )
+                    # prepare the output. Send the transect as a geosjon.
+                    geom = wkt_geometry(transect)
+                    output = {
+                        "transect_coordinates": geom["coordinates"],
+                        "coastline_id": coastline_id,
+                        "notification": notification,
+                    }
+                    response.outputs["output_json"].data = json.dumps(output)
 
-        except Exception:
+        except Exception as e:
+            count_error(e)
             msg = "Please click closer to the coast"
             res = {"errMsg": msg}
             response.outputs["output_json"].data = json.dumps(res)
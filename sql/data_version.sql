@@ -0,0 +1,23 @@
+-- Version stamp of the data layers (see DB.get_data_version). The precomputed
+-- classifications and the result cache of chw_risk_classification are only used
+-- while the version they were computed with is current.
+-- Every load or edit of the data layers ends with
+--     SELECT chw.bump_data_version('what was loaded');
+-- Maintenance (VACUUM, ANALYZE, restarts, replicas) leaves the version as it is.
+
+CREATE TABLE IF NOT EXISTS chw.data_version (
+    -- a single row
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    version integer NOT NULL DEFAULT 1,
+    loaded_at timestamp with time zone NOT NULL DEFAULT now(),
+    note text
+);
+
+INSERT INTO chw.data_version DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION chw.bump_data_version(note text DEFAULT NULL)
+RETURNS integer AS $$
+    UPDATE chw.data_version
+    SET version = version + 1, loaded_at = now(), note = $1
+    RETURNING version;
+$$ LANGUAGE sql;
@@ -0,0 +1,26 @@
+-- GiST indexes for the nearest-value lookups (see nearest_sql in processes/db_utils.py).
+-- They serve both the KNN ordering (<->) and the ST_DWithin filter.
+-- Run with psql -f; CONCURRENTLY keeps the tables available while building.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS wave_exposure_geom_gist
+    ON ocean.wave_exposure USING gist (geom);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS tidal_range_geom_gist
+    ON ocean.tidal_range USING gist (geom);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS diva_points_with_cyclone_risk_geom_gist
+    ON ocean.diva_points_with_cyclone_risk USING gist (geom);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS shorelinechange_geom_gist
+    ON coast.shorelinechange USING gist (geom);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS sediment_geom_gist
+    ON coast.sediment USING gist (geom);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS gar_wkb_geometry_gist
+    ON gar.gar USING gist (wkb_geometry);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS glim_shape_gist
+    ON geollayout.glim USING gist (shape);
+
+ANALYZE ocean.wave_exposure;
+ANALYZE ocean.tidal_range;
+ANALYZE ocean.diva_points_with_cyclone_risk;
+ANALYZE coast.shorelinechange;
+ANALYZE coast.sediment;
+ANALYZE gar.gar;
+ANALYZE geollayout.glim;
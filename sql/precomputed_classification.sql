@@ -0,0 +1,17 @@
+-- Precomputed CHW classification per coastline segment (coast.osm_segment500m).
+-- Filled by `python -m processes.precompute` and by the on-demand computations of
+-- the chw_fast_classification process. A row is only used while its data_version
+-- equals the current data version (see DB.get_data_version).
+
+CREATE TABLE IF NOT EXISTS chw.precomputed_classification (
+    segment_gid integer PRIMARY KEY,
+    transect geometry(LineString, 4326),
+    notification text,
+    data_version text NOT NULL,
+    output jsonb,
+    error text,
+    computed_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS precomputed_classification_data_version_idx
+    ON chw.precomputed_classification (data_version);
@@ -0,0 +1,23 @@
+# The processes package lives in the root of the repository, which pytest does
+# not put on the path by itself.
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def postgis():
+    """DB of configuration.txt, the tests that use it are skipped without one"""
+    from processes.db_utils import DB
+    from processes.utils import read_config
+
+    try:
+        host, user, password, db, *_ = read_config()
+        database = DB(user, password, host, db)
+    except Exception as e:
+        pytest.skip(f"No PostGIS database configured: {e}")
+    yield database
+    database.close_db_connection()
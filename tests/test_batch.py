@@ -0,0 +1,178 @@
+# Batch classification of processes/batch_utils.py: the grouping of the transects
+# and the set-based probe of a group
+
+import importlib
+import json
+from pathlib import Path
+
+import geojson
+import numpy as np
+import pytest
+from shapely.geometry import LineString
+
+from processes.db_utils import TransectProbe
+from processes.vector_utils import extend_transect, get_bounds
+
+PROFILES = json.loads((Path(__file__).parent / "data" / "dem_profiles.json").read_text())
+PROFILE = (
+    [np.nan if v is None else v for v in PROFILES["beach_dune"]["elevations"]],
+    PROFILES["beach_dune"]["segments"],
+)
+
+# the extensions in the sea that the probe takes, in its order
+SEA_EXTENSIONS = {
+    "100m": (100, -180),
+    "200m": (200, -180),
+    "6km": (6000, -180),
+    "10km": (10000, -180),
+    "100km": (100000, -180),
+}
+
+# batch_utils and chw_utils read configuration.txt when they are imported
+CONFIGURATION = """[PostGIS]
+host = localhost
+user = chw
+pass = chw
+db = chw
+port = 5432
+
+[GeoServer]
+ows_url = http://localhost/geoserver/ows
+dem = dem
+landuse = landuse
+username =
+password =
+dem_test = dem_test
+"""
+
+
+@pytest.fixture(scope="module")
+def batch_utils(tmp_path_factory):
+    configuration = tmp_path_factory.mktemp("config") / "configuration.txt"
+    configuration.write_text(CONFIGURATION)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv("CHW_CONFIG", str(configuration))
+        return importlib.import_module("processes.batch_utils")
+
+
+def coast(count, spacing=0.01, seed=3):
+    """Transects along a wiggly coastline heading north east"""
+    rng = np.random.default_rng(seed)
+    features = []
+    for k in range(count):
+        x, y = 4.0 + k * spacing, 52.0 + k * spacing / 2 + rng.uniform(-0.002, 0.002)
+        features.append(
+            geojson.Feature(
+                geometry=geojson.LineString([(x, y), (x + 0.004, y - 0.003)]),
+                properties={"coastline_id": k, "notification": None},
+            )
+        )
+    return features
+
+
+@pytest.mark.parametrize("group_size", [0.05, 0.2, 0.5, 10])
+def test_groups_partition_the_transects(batch_utils, group_size):
+    features = coast(120)
+    groups = batch_utils.group_transects(features, group_size)
+    assert [i for _, indices in groups for i in indices] == list(range(len(features)))
+    for bbox, indices in groups:
+        bounds = [get_bounds(features[i]) for i in indices]
+        assert bbox == (
+            min(b[0] for b in bounds),
+            min(b[1] for b in bounds),
+            max(b[2] for b in bounds),
+            max(b[3] for b in bounds),
+        )
+        assert bbox[2] - bbox[0] <= group_size and bbox[3] - bbox[1] <= group_size
+    if group_size == 10:
+        assert len(groups) == 1
+
+
+def test_a_gap_in_the_coast_starts_a_new_group(batch_utils):
+    far = geojson.Feature(
+        geometry=geojson.LineString([(120.0, -8.0), (120.004, -8.003)]), properties={}
+    )
+    groups = batch_utils.group_transects(coast(3) + [far] + coast(2), 0.5)
+    assert [indices for _, indices in groups] == [[0, 1, 2], [3], [4, 5]]
+
+
+def fake_facts(columns, transects):
+    """Facts that depend on every transect passed to the probe"""
+    return {column: hash((column,) + tuple(transects)) for column in columns}
+
+
+class FakeDB:
+    """Probes with fake_facts, per transect like CHW and set-based like the batch"""
+
+    def __init__(self, *args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def probe_transect_columns(
+        self, columns, *transects, transect_4km_inland=None, crs=4326
+    ):
+        return fake_facts(columns, transects + (transect_4km_inland,))
+
+    def probe_transects_columns(self, columns, transects, crs=4326):
+        return [fake_facts(columns, transect) for transect in transects]
+
+
+def single_transect_probe(chw_utils, feature):
+    """The probe as CHW collects it for one transect"""
+
+    class Transect(chw_utils.TransectFacts):
+        pass
+
+    transect = Transect()
+    transect.transect_wkt = chw_utils.geojson_to_wkt(feature)
+    extended = extend_transect(transect.transect_wkt, chw_utils.TRANSECT_EXTENSIONS)
+    for name in ("100m", "200m", "6km", "10km", "100km"):
+        setattr(transect, f"transect_{name}", extended[name])
+    groups = {
+        f"probe_{i}": transect.probe_columns(columns)
+        for i, columns in enumerate(chw_utils.PROBE_GROUPS)
+    }
+    return chw_utils.merge_probe(**groups)
+
+
+def test_group_probe_matches_the_single_transect_probe(batch_utils, monkeypatch):
+    chw_utils = importlib.import_module("processes.chw_utils")
+    monkeypatch.setattr(batch_utils, "DB", FakeDB)
+    monkeypatch.setattr(chw_utils, "DB", FakeDB)
+    monkeypatch.setattr(batch_utils, "cut_wcs", lambda *args, **kwargs: None)
+    monkeypatch.setattr(batch_utils, "close_raster", lambda raster: None)
+    monkeypatch.setattr(
+        batch_utils,
+        "get_elevation_profiles",
+        lambda dem, lines, bboxes, resampling: [PROFILE for _ in lines],
+    )
+
+    features = coast(12)
+    for bbox, indices in batch_utils.group_transects(features, 0.05):
+        group = [features[i] for i in indices]
+        collected = batch_utils.collect_group(group, bbox)
+        assert len(collected) == len(group)
+        for feature, facts in zip(group, collected):
+            assert isinstance(facts["probe"], TransectProbe)
+            assert facts["probe"] == single_transect_probe(chw_utils, feature)
+
+
+def test_set_based_probe_matches_the_single_transect_probe(postgis):
+    recorded = json.loads((Path(__file__).parent / "data" / "transects.json").read_text())
+    probe_transects = []
+    for transect in recorded["extend_transect"].values():
+        transect_wkt = LineString(transect["transect"]).wkt
+        lines = extend_transect(transect_wkt, SEA_EXTENSIONS)
+        probe_transects.append(
+            (transect_wkt, *(lines[name] for name in SEA_EXTENSIONS), None)
+        )
+    columns = TransectProbe._fields
+    expected = [
+        postgis.probe_transect_columns(columns, *transect) for transect in probe_transects
+    ]
+    assert postgis.probe_transects_columns(columns, probe_transects) == expected
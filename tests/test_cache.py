@@ -0,0 +1,167 @@
+# Result cache of chw_risk_classification: key composition, backends and expiry
+
+import geojson
+import pytest
+
+from processes import cache_utils
+from processes.cache_utils import (
+    MemoryBackend,
+    ResultCache,
+    SQLiteBackend,
+    normalize_wkt,
+)
+
+TRANSECT = "LINESTRING (4.123456789 52.987654321, 4.1301 52.9912)"
+
+
+class FakeDB:
+    def __init__(self, version="1"):
+        self.version = version
+        self.calls = 0
+
+    def get_data_version(self):
+        self.calls += 1
+        return self.version
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """time.time of the backends, moved on by hand"""
+    now = [1000.0]
+    monkeypatch.setattr(cache_utils.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend(max_entries=3)
+    return SQLiteBackend(tmp_path / "results.sqlite3", max_entries=3)
+
+
+def test_normalize_wkt_rounds_the_coordinates():
+    assert normalize_wkt(TRANSECT, 4) == "LINESTRING (4.1235 52.9877, 4.1301 52.9912)"
+    assert normalize_wkt("POINT (-0.0000001 1)", 6) == "POINT (0 1)"
+
+
+def test_nearby_transects_share_a_key():
+    cache = ResultCache(MemoryBackend(), precision=4)
+    nearby = "LINESTRING (4.12346 52.98766, 4.13012 52.99118)"
+    assert cache.key(TRANSECT, 7, "dem", "1") == cache.key(nearby, 7, "dem", "1")
+
+
+@pytest.mark.parametrize(
+    "changed",
+    [
+        ("LINESTRING (4.2 52.9, 4.21 52.91)", 7, "dem", "1", None),
+        (TRANSECT, 8, "dem", "1", None),
+        (TRANSECT, None, "dem", "1", None),
+        (TRANSECT, 7, "dem_test", "1", None),
+        (TRANSECT, 7, "dem", "2", None),
+        (TRANSECT, 7, "dem", "1", "Please note"),
+    ],
+)
+def test_every_part_of_the_key_counts(changed):
+    cache = ResultCache(MemoryBackend())
+    transect, coastline_id, dem_layer, data_version, extra = changed
+    assert cache.key(TRANSECT, 7, "dem", "1") != cache.key(
+        transect, coastline_id, dem_layer, data_version, extra=extra
+    )
+
+
+def test_backend_get_and_set(backend, clock):
+    assert backend.get("a") is None
+    backend.set("a", '{"code": 1}', ttl=60)
+    assert backend.get("a") == '{"code": 1}'
+    backend.set("a", '{"code": 2}', ttl=60)
+    assert backend.get("a") == '{"code": 2}'
+    assert len(backend) == 1
+    backend.clear()
+    assert backend.get("a") is None
+
+
+def test_backend_expires_entries(backend, clock):
+    backend.set("a", "1", ttl=60)
+    clock[0] += 59
+    assert backend.get("a") == "1"
+    clock[0] += 2
+    assert backend.get("a") is None
+
+
+def test_backend_drops_the_least_recently_used(backend, clock):
+    for key in "abc":
+        backend.set(key, key, ttl=60)
+        clock[0] += 1
+    # reading a marks it as used, so b is the least recently used one
+    assert backend.get("a") == "a"
+    clock[0] += 1
+    backend.set("d", "d", ttl=60)
+    assert backend.get("b") is None
+    assert [backend.get(key) for key in "acd"] == ["a", "c", "d"]
+
+
+def test_sqlite_backend_is_shared(tmp_path, clock):
+    SQLiteBackend(tmp_path / "results.sqlite3").set("a", "1", ttl=60)
+    assert SQLiteBackend(tmp_path / "results.sqlite3").get("a") == "1"
+
+
+def test_result_cache_counts_hits_and_misses():
+    cache = ResultCache(MemoryBackend())
+    assert cache.get("a") is None
+    cache.set("a", "1")
+    assert cache.get("a") == "1"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_result_cache_survives_a_broken_backend():
+    class BrokenBackend(MemoryBackend):
+        def get(self, key):
+            raise OSError("disk full")
+
+        def set(self, key, value, ttl):
+            raise OSError("disk full")
+
+    cache = ResultCache(BrokenBackend())
+    cache.set("a", "1")
+    assert cache.get("a") is None
+
+
+def test_data_version_is_reused_within_the_check_interval(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(cache_utils.time, "monotonic", lambda: now[0])
+    cache = ResultCache(MemoryBackend(), data_version="v2", version_check_interval=60)
+    db = FakeDB("7")
+    assert cache.data_version(db) == "v2:7"
+    db.version = "8"
+    now[0] += 30
+    assert cache.data_version(db) == "v2:7"
+    now[0] += 31
+    assert cache.data_version(db) == "v2:8"
+    assert db.calls == 2
+
+
+def test_classification_goes_on_without_a_data_version(monkeypatch):
+    pytest.importorskip("pywps")
+    from processes import wps_coastal_hazard_wheel
+
+    class MissingVersionDB(FakeDB):
+        def __init__(self, *args):
+            super().__init__()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def get_data_version(self):
+            raise RuntimeError('relation "chw.data_version" does not exist')
+
+    monkeypatch.setattr(wps_coastal_hazard_wheel, "DB", MissingVersionDB)
+    monkeypatch.setattr(wps_coastal_hazard_wheel, "read_config", lambda: ("",) * 11)
+    transect = geojson.Feature(
+        geometry=geojson.LineString([(4.1, 52.9), (4.11, 52.91)]),
+        properties={"coastline_id": 1, "notification": None},
+    )
+    cache = ResultCache(MemoryBackend())
+    assert wps_coastal_hazard_wheel.result_cache_key(cache, transect) is None
@@ -0,0 +1,121 @@
+# In-memory catalogues of processes/catalogue_utils.py: the decision wheel lookup
+# and the reload of a catalogue when its tables change
+
+import logging
+import threading
+
+from processes.catalogue_utils import Catalogue, DecisionWheel
+
+# rows as DB.load_decision_wheel returns them: code, geological_layout, the levels
+# of the other five columns as lists, then the hazards
+ROWS = [
+    (
+        "1",
+        "Sedimentary plain",
+        ["Exposed", "Moderately exposed"],
+        ["Micro"],
+        ["Any"],
+        ["Balance/Deficit", "Surplus"],
+        ["Any"],
+        "low", "low", "low", "moderate", "high",
+    ),
+    (
+        "2",
+        "Sedimentary plain",
+        ["Exposed"],
+        ["Micro", "Meso"],
+        ["Any"],
+        ["Balance/Deficit"],
+        ["Any"],
+        "high", "high", "high", "high", "high",
+    ),
+    ("3", "Barrier", ["Protected"], None, ["Any"], ["Any"], ["Any"], *["low"] * 5),
+]
+
+
+def test_every_combination_of_the_levels_is_indexed():
+    wheel = DecisionWheel(ROWS[:1])
+    assert len(wheel) == 4
+    for wave_exposure in ("Exposed", "Moderately exposed"):
+        for sediment_balance in ("Balance/Deficit", "Surplus"):
+            assert wheel.get_classes(
+                "Sedimentary plain", wave_exposure, "Micro", "Any", sediment_balance, "Any"
+            ) == ("1", "low", "low", "low", "moderate", "high")
+    assert (
+        wheel.get_classes("Sedimentary plain", "Protected", "Micro", "Any", "Surplus", "Any")
+        is None
+    )
+
+
+def test_a_row_without_levels_matches_nothing():
+    # like the SQL, where = ANY of a NULL array is never true
+    wheel = DecisionWheel(ROWS[2:])
+    assert len(wheel) == 0
+
+
+def test_the_first_matching_row_wins(caplog):
+    with caplog.at_level(logging.WARNING, logger="PYWPS"):
+        wheel = DecisionWheel(ROWS)
+    levels = ("Sedimentary plain", "Exposed", "Micro", "Any", "Balance/Deficit", "Any")
+    assert wheel.get_classes(*levels)[0] == "1"
+    # the levels only the second row has are still indexed
+    assert (
+        wheel.get_classes("Sedimentary plain", "Exposed", "Meso", "Any", "Balance/Deficit", "Any")[0]
+        == "2"
+    )
+    warnings = [r.getMessage() for r in caplog.records if r.levelno == logging.WARNING]
+    assert warnings == [f"chw.decision_wheel classifies {levels} as both 1 and 2, 1 is used"]
+
+
+def test_identical_rows_do_not_warn(caplog):
+    with caplog.at_level(logging.WARNING, logger="PYWPS"):
+        DecisionWheel(ROWS[:1] * 2)
+    assert not caplog.records
+
+
+class FakeDB:
+    def __init__(self, version="1"):
+        self.version = version
+        self.loads = 0
+        self.loading = None
+        self.started = threading.Event()
+
+    def get_tables_version(self, tables):
+        return self.version
+
+    def load_decision_wheel(self):
+        self.loads += 1
+        self.started.set()
+        if self.loading is not None:
+            self.loading.wait(5)
+        return ROWS[:1]
+
+
+def test_catalogue_is_reloaded_when_the_version_changes():
+    catalogue = Catalogue(DecisionWheel, check_interval=0)
+    db = FakeDB("1")
+    first = catalogue.get(db)
+    assert catalogue.get(db) is first and db.loads == 1
+    db.version = "2"
+    second = catalogue.get(db)
+    assert second is not first and second.version == "2" and db.loads == 2
+
+
+def test_catalogue_is_served_while_it_reloads():
+    catalogue = Catalogue(DecisionWheel, check_interval=0)
+    db = FakeDB("1")
+    first = catalogue.get(db)
+
+    db.version = "2"
+    db.loading = threading.Event()
+    reload = threading.Thread(target=catalogue.get, args=(db,))
+    db.started.clear()
+    reload.start()
+    try:
+        assert db.started.wait(5)
+        # the reload holds no lock, so the other requests keep the current catalogue
+        assert catalogue.get(FakeDB("1")) is first
+    finally:
+        db.loading.set()
+        reload.join(5)
+    assert catalogue.get(db).version == "2"
@@ -0,0 +1,34 @@
+# instrumented runs the handler of the copy PyWPS executes, not the original process
+
+import copy
+
+from processes.metrics_utils import collect, instrumented
+
+
+class FakeProcess:
+    """Like pywps.Process: the handler is the bound method, every execute runs on a
+    deep copy that gets its own workdir"""
+
+    identifier = "fake"
+
+    def __init__(self):
+        self.handler = self._handler
+        self.workdir = None
+
+    @instrumented
+    def _handler(self, request, response):
+        return self.workdir
+
+
+def test_handler_runs_on_the_copy():
+    process = FakeProcess()
+    execute = copy.deepcopy(process)
+    execute.workdir = "/tmp/pywps_process_1"
+    assert execute.handler(None, None) == "/tmp/pywps_process_1"
+    assert process.handler(None, None) is None
+
+
+def test_request_latency_is_recorded():
+    with collect() as metrics:
+        FakeProcess().handler(None, None)
+    assert "request.fake" in metrics.as_dict()["stages"]
@@ -0,0 +1,187 @@
+# Raster helpers of processes/raster_utils.py on small synthetic rasters
+
+import numpy as np
+import pytest
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+from processes import raster_utils, wcs_utils
+from processes.raster_utils import (
+    close_raster,
+    cut_wcs,
+    get_elevation_profile,
+    get_elevation_profiles,
+    read_raster_values,
+    read_raster_values_in_bbox,
+    sample_raster,
+)
+from processes.vector_utils import change_coords, get_bounds
+from processes.wcs_utils import CoverageMetadata
+
+# 3 x 4 pixels of 1 x 1 with the upper left corner at (10, 20)
+VALUES = np.arange(12, dtype=float).reshape(3, 4)
+TRANSFORM = from_origin(10, 20, 1, 1)
+
+
+def sample(xs, ys, resampling="bilinear", values=VALUES, nodata=None):
+    return sample_raster(values, TRANSFORM, xs, ys, nodata=nodata, resampling=resampling)
+
+
+def test_nearest_takes_the_pixel_of_the_point():
+    result = sample([10.1, 13.9, 12.5], [19.9, 17.1, 18.5], resampling="nearest")
+    np.testing.assert_array_equal(result, [0, 11, 6])
+
+
+def test_bilinear_interpolates_between_the_pixel_centers():
+    # halfway between the centers of the pixels 0, 1, 4 and 5
+    assert sample([11.0], [19.0])[0] == pytest.approx(2.5)
+    # at a pixel center
+    assert sample([12.5], [18.5])[0] == pytest.approx(6)
+
+
+@pytest.mark.parametrize(
+    "x, y, expected",
+    [
+        (10.1, 19.9, 0),  # outer half pixel of a corner
+        (10.1, 19.0, 2),  # left edge, halfway between the rows 0 and 1
+        (11.0, 17.1, 8.5),  # bottom edge, halfway between the columns 0 and 1
+        (13.9, 17.1, 11),  # opposite corner
+    ],
+)
+def test_bilinear_clamps_to_the_edge_pixels(x, y, expected):
+    assert sample([x], [y])[0] == pytest.approx(expected)
+
+
+def test_points_outside_the_raster_are_nan():
+    for resampling in ("nearest", "bilinear"):
+        result = sample([9.9, 14.1, 11, 11], [19, 19, 20.1, 16.9], resampling)
+        assert np.isnan(result).all()
+
+
+def test_nodata_is_nan():
+    values = VALUES.copy()
+    values[0, 0] = -9999
+    assert np.isnan(sample([10.1], [19.9], values=values, nodata=-9999)[0])
+    assert np.isnan(sample([10.1], [19.9], "nearest", values=values, nodata=-9999)[0])
+
+
+def test_a_single_row_raster():
+    values = np.array([[1.0, 3.0]])
+    result = sample([10.2, 11.0, 11.8], [19.9, 19.5, 19.1], values=values)
+    np.testing.assert_allclose(result, [1, 2, 3])
+
+
+# A coverage of 3 arc seconds, served like GeoServer serves a GetCoverage on its grid
+RES = 1 / 1200
+LX, LY, CX, CY = 3.0, 50.0, 3600, 2400
+HX, HY = LX + CX * RES, LY + CY * RES
+
+
+class FakeCoverage:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeService:
+    def __init__(self, values):
+        self.values = values
+
+    def getCoverage(self, identifier, bbox, format, crs, width, height, **auth):
+        col0 = int(round((bbox[0] - LX) / RES))
+        row0 = int(round((HY - bbox[3]) / RES))
+        data = self.values[row0 : row0 + height, col0 : col0 + width]
+        transform = from_origin(
+            bbox[0], bbox[3], (bbox[2] - bbox[0]) / width, (bbox[3] - bbox[1]) / height
+        )
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff",
+                width=width,
+                height=height,
+                count=1,
+                dtype=data.dtype,
+                crs="EPSG:4326",
+                transform=transform,
+                nodata=-9999,
+            ) as dataset:
+                dataset.write(data, 1)
+            return FakeCoverage(memfile.read())
+
+
+@pytest.fixture
+def coverage(monkeypatch):
+    """cut_wcs on the synthetic coverage, without the tile cache"""
+    rng = np.random.default_rng(7)
+    rows, cols = np.mgrid[0:CY, 0:CX]
+    values = 20 * np.sin(rows / 90) * np.cos(cols / 70) + rng.normal(0, 0.5, (CY, CX))
+    values[values < -15] = -9999
+    service = FakeService(values.astype("float32"))
+
+    class FakeRegistry:
+        def get(self, host, layer, username, password):
+            return service, CoverageMetadata(CX, CY, "EPSG:4326", (LX, LY, HX, HY))
+
+    monkeypatch.setattr(wcs_utils, "get_coverage_registry", FakeRegistry)
+    monkeypatch.setattr(raster_utils, "get_tile_cache", lambda: None)
+
+
+def groups(count=20, size=5):
+    """Transects as wkt, per group with the bbox of the group as batch_utils
+    fetches it"""
+    rng = np.random.default_rng(11)
+    for _ in range(count):
+        x0, y0 = rng.uniform(3.1, 5.4), rng.uniform(50.1, 51.6)
+        transects = []
+        for _ in range(size):
+            x, y = x0 + rng.uniform(0, 0.4), y0 + rng.uniform(0, 0.4)
+            dx, dy = rng.uniform(-0.006, 0.006, 2)
+            transects.append(f"LINESTRING ({x} {y}, {x + dx} {y + dy})")
+        bboxes = [get_bounds(transect) for transect in transects]
+        bbox = (
+            min(b[0] for b in bboxes),
+            min(b[1] for b in bboxes),
+            max(b[2] for b in bboxes),
+            max(b[3] for b in bboxes),
+        )
+        yield transects, bboxes, bbox
+
+
+def test_bbox_window_matches_the_single_transect_read(coverage):
+    for transects, bboxes, bbox in groups():
+        merged = cut_wcs(*bbox, "dem", "ows", None)
+        try:
+            for transect_bbox in bboxes:
+                single = cut_wcs(*transect_bbox, "dem", "ows", None)
+                try:
+                    np.testing.assert_array_equal(
+                        read_raster_values_in_bbox(merged, *transect_bbox),
+                        read_raster_values(single),
+                    )
+                finally:
+                    close_raster(single)
+        finally:
+            close_raster(merged)
+
+
+@pytest.mark.parametrize("resampling", ["nearest", "bilinear"])
+def test_merged_profiles_match_the_single_transect_profiles(coverage, resampling):
+    for transects, bboxes, bbox in groups(count=5):
+        lines = [change_coords(transect) for transect in transects]
+        merged = cut_wcs(*bbox, "dem", "ows", None)
+        try:
+            profiles = get_elevation_profiles(merged, lines, bboxes, resampling)
+        finally:
+            close_raster(merged)
+        for line, transect_bbox, (elevations, segments) in zip(lines, bboxes, profiles):
+            single = cut_wcs(*transect_bbox, "dem", "ows", None)
+            try:
+                expected = get_elevation_profile(single, line, line.length, resampling)
+            finally:
+                close_raster(single)
+            # the step comes from the transform of another extent, equal up to
+            # rounding of the floats
+            np.testing.assert_allclose(segments, expected[1], rtol=1e-9)
+            np.testing.assert_allclose(elevations, expected[0], rtol=0, atol=1e-6)
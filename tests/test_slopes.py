@@ -0,0 +1,170 @@
+# Compares the closed-form piecewise slopes of processes/raster_utils.py with the
+# linregress loop they replaced, on DEM profiles as get_elevation_profile returns
+# them (nearest sampling at a third of a pixel, NaN for nodata, 10 m steps).
+#
+#   python -m pytest tests
+
+import json
+from pathlib import Path
+from statistics import mean
+
+import numpy as np
+import pytest
+from scipy.stats import linregress
+
+from processes.raster_utils import (
+    calc_slope,
+    calc_slope_200m_inland,
+    calc_slopes_batch,
+    detect_pattern,
+    piecewise_slopes,
+)
+
+PROFILES = json.loads((Path(__file__).parent / "data" / "dem_profiles.json").read_text())
+BREAKING = [name for name in PROFILES if name != "no_break"]
+TOLERANCE = 1e-8
+
+
+def profile(name):
+    elevations = [np.nan if v is None else v for v in PROFILES[name]["elevations"]]
+    return elevations, PROFILES[name]["segments"]
+
+
+def reference_slopes(elevations, segments):
+    """The slopes of every run as calc_slope computed them before the closed form"""
+    y = np.nan_to_num(np.array(elevations))
+    x = np.array(segments)
+
+    m = np.diff(y) / np.diff(x)
+    msign = np.sign(m)
+    slope_patterns = np.array(
+        [
+            any(pattern)
+            for pattern in zip(
+                detect_pattern([0, 1], msign),
+                detect_pattern([1, -1], msign),
+                detect_pattern([-1, 1], msign),
+                detect_pattern([-1, 0], msign),
+                detect_pattern([1, 0], msign),
+            )
+        ]
+    )
+
+    indeces = np.where(slope_patterns == True)[0] + 2
+    slopes = []
+    indeces_start = indeces - 1
+    loops = len(indeces) + 1
+    indeces_end = indeces
+
+    for i in range(loops):
+        if i == 0:
+            a = linregress(x[: indeces_end[i]], y[: indeces_end[i]])
+        elif i == len(indeces):
+            a = linregress(x[indeces_start[i - 1] :], y[indeces_start[i - 1] :])
+        else:
+            a = linregress(
+                x[indeces_start[i - 1] : indeces_end[i]],
+                y[indeces_start[i - 1] : indeces_end[i]],
+            )
+        slopes.append(a.slope)
+
+    return [abs(slope * 100) for slope in slopes]
+
+
+def reference_calc_slope(elevations, segments):
+    slopes = reference_slopes(elevations, segments)
+    return mean(slopes), max(slopes)
+
+
+def reference_calc_slope_200m_inland(elevations, segments):
+    try:
+        x = np.array(segments)
+        inland_200 = (np.argwhere(x < 300).shape)[0]
+        return max(reference_slopes(elevations[:inland_200], x[:inland_200]))
+    except Exception:
+        return 0.00
+
+
+@pytest.mark.parametrize("name", BREAKING)
+def test_piecewise_slopes_match_linregress(name):
+    elevations, segments = profile(name)
+    assert piecewise_slopes(elevations, segments) == pytest.approx(
+        reference_slopes(elevations, segments), rel=0, abs=TOLERANCE
+    )
+
+
+@pytest.mark.parametrize("name", BREAKING)
+def test_calc_slope_matches_linregress(name):
+    elevations, segments = profile(name)
+    mean_slope, max_slope = calc_slope(elevations, segments)
+    reference_mean, reference_max = reference_calc_slope(elevations, segments)
+    assert mean_slope == pytest.approx(reference_mean, rel=0, abs=TOLERANCE)
+    assert max_slope == pytest.approx(reference_max, rel=0, abs=TOLERANCE)
+
+
+@pytest.mark.parametrize("name", list(PROFILES))
+def test_calc_slope_200m_inland_matches_linregress(name):
+    elevations, segments = profile(name)
+    assert calc_slope_200m_inland(elevations, segments) == pytest.approx(
+        reference_calc_slope_200m_inland(elevations, segments), rel=0, abs=TOLERANCE
+    )
+
+
+def test_calc_slopes_batch_matches_linregress():
+    names = list(PROFILES)
+    profiles = [profile(name) for name in names]
+    offsets = np.concatenate(([0], np.cumsum([len(e) for e, _ in profiles])))
+    mean_slopes, max_slopes, max_slopes_200m = calc_slopes_batch(
+        np.concatenate([e for e, _ in profiles]),
+        np.concatenate([s for _, s in profiles]),
+        offsets,
+    )
+    for k, (name, (elevations, segments)) in enumerate(zip(names, profiles)):
+        if name == "no_break":
+            assert np.isnan(mean_slopes[k]) and np.isnan(max_slopes[k])
+        else:
+            reference_mean, reference_max = reference_calc_slope(elevations, segments)
+            assert mean_slopes[k] == pytest.approx(reference_mean, rel=0, abs=TOLERANCE)
+            assert max_slopes[k] == pytest.approx(reference_max, rel=0, abs=TOLERANCE)
+        assert max_slopes_200m[k] == pytest.approx(
+            reference_calc_slope_200m_inland(elevations, segments), rel=0, abs=TOLERANCE
+        )
+
+
+def test_calc_slopes_batch_matches_calc_slope():
+    # the profiles in another order than the file, and cut short to other lengths
+    names = sorted(PROFILES, reverse=True)
+    profiles = [profile(name) for name in names]
+    for name in BREAKING:
+        elevations, segments = profile(name)
+        names.append(name)
+        profiles.append((elevations[:37], segments[:37]))
+    offsets = np.concatenate(([0], np.cumsum([len(e) for e, _ in profiles])))
+    mean_slopes, max_slopes, max_slopes_200m = calc_slopes_batch(
+        np.concatenate([e for e, _ in profiles]),
+        np.concatenate([s for _, s in profiles]),
+        offsets,
+    )
+    for k, (name, (elevations, segments)) in enumerate(zip(names, profiles)):
+        if name == "no_break":
+            # where calc_slope raises, see test_no_change_of_slope_raises
+            assert np.isnan(mean_slopes[k]) and np.isnan(max_slopes[k])
+        else:
+            mean_slope, max_slope = calc_slope(elevations, segments)
+            assert mean_slopes[k] == pytest.approx(mean_slope, rel=0, abs=TOLERANCE)
+            assert max_slopes[k] == pytest.approx(max_slope, rel=0, abs=TOLERANCE)
+        assert max_slopes_200m[k] == pytest.approx(
+            calc_slope_200m_inland(elevations, segments), rel=0, abs=TOLERANCE
+        )
+
+
+def test_no_change_of_slope_raises():
+    elevations, segments = profile("no_break")
+    # the linregress loop failed on such a profile too
+    with pytest.raises(IndexError):
+        reference_calc_slope(elevations, segments)
+    with pytest.raises(ValueError):
+        piecewise_slopes(elevations, segments)
+    with pytest.raises(ValueError):
+        calc_slope(elevations, segments)
+    assert calc_slope_200m_inland(elevations, segments) == 0.0
@@ -0,0 +1,98 @@
+# Transects built by processes/vector_utils.py compared with recorded transects.
+#
+# tests/data/transects.json holds a few transects (the one of chw_execute.xml among
+# them) with the end points the SQL of DB.ST_line_extend and
+# DB.create_transect_in_coast gives for them: ST_Azimuth on the geometries, then
+# ST_Project on geography, here evaluated with Vincenty's direct formula on WGS84.
+# When configuration.txt points to a PostGIS database, the local transects are
+# compared with that SQL as well.
+
+import json
+from pathlib import Path
+
+import pytest
+from shapely import wkt
+from shapely.geometry import LineString, Point
+
+from processes.vector_utils import (
+    canonical_transect,
+    create_transect_in_coast,
+    extend_transect,
+)
+
+RECORDED = json.loads((Path(__file__).parent / "data" / "transects.json").read_text())
+TOLERANCE = 1e-8
+
+# TRANSECT_EXTENSIONS of chw_utils_test_environment, which has all the ones of chw_utils
+EXTENSIONS = {
+    "5km": (5000, 180),
+    "4km": (4000, -180),
+    "4km_inland": (4000, 180),
+    "6km": (6000, -180),
+    "10km": (10000, -180),
+    "100km": (100000, -180),
+    "200m": (200, -180),
+    "100m": (100, -180),
+}
+
+
+def assert_line(line_wkt, start, end):
+    line = wkt.loads(line_wkt)
+    assert len(line.coords) == 2
+    assert line.coords[0] == pytest.approx(tuple(start), rel=0, abs=TOLERANCE)
+    assert line.coords[1] == pytest.approx(tuple(end), rel=0, abs=TOLERANCE)
+
+
+@pytest.mark.parametrize("name", list(RECORDED["extend_transect"]))
+def test_extend_transect_matches_the_recorded_lines(name):
+    recorded = RECORDED["extend_transect"][name]
+    start = recorded["transect"][0]
+    extended = extend_transect(LineString(recorded["transect"]).wkt, EXTENSIONS)
+    assert set(extended) == set(recorded["ends"])
+    for extension, end in recorded["ends"].items():
+        assert_line(extended[extension], start, end)
+
+
+@pytest.mark.parametrize("name", list(RECORDED["create_transect_in_coast"]))
+def test_create_transect_in_coast_matches_the_recorded_transect(name):
+    recorded = RECORDED["create_transect_in_coast"][name]
+    transect = create_transect_in_coast(
+        Point(recorded["point_on_sea"]).wkt, Point(recorded["point_on_coast"]).wkt, 500
+    )
+    assert_line(transect, recorded["point_on_coast"], recorded["end"])
+
+
+@pytest.mark.parametrize("name", list(RECORDED["canonical_transect"]))
+def test_canonical_transect_matches_the_recorded_transect(name):
+    recorded = RECORDED["canonical_transect"][name]
+    segment = LineString(recorded["segment"])
+    point_on_sea, transect = canonical_transect(segment.wkt)
+    middle = segment.interpolate(0.5, normalized=True)
+    assert wkt.loads(point_on_sea).coords[0] == pytest.approx(
+        tuple(recorded["point_on_sea"]), rel=0, abs=TOLERANCE
+    )
+    assert_line(transect, (middle.x, middle.y), recorded["end"])
+
+
+@pytest.mark.parametrize("name", list(RECORDED["extend_transect"]))
+def test_extend_transect_matches_postgis(postgis, name):
+    transect = LineString(RECORDED["extend_transect"][name]["transect"]).wkt
+    extended = extend_transect(transect, EXTENSIONS)
+    for extension, (dist, direction) in EXTENSIONS.items():
+        end = wkt.loads(postgis.ST_line_extend(transect, dist, direction=direction)).coords[1]
+        assert_line(extended[extension], wkt.loads(transect).coords[0], end)
+
+
+@pytest.mark.parametrize("name", list(RECORDED["create_transect_in_coast"]))
+def test_create_transect_in_coast_matches_postgis(postgis, name):
+    recorded = RECORDED["create_transect_in_coast"][name]
+    point_on_sea = Point(recorded["point_on_sea"]).wkt
+    point_on_coast = Point(recorded["point_on_coast"]).wkt
+    end = wkt.loads(
+        postgis.create_transect_in_coast(point_on_sea, point_on_coast, 500)
+    ).coords[1]
+    assert_line(
+        create_transect_in_coast(point_on_sea, point_on_coast, 500),
+        recorded["point_on_coast"],
+        end,
+    )
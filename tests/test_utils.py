@@ -0,0 +1,88 @@
+# run_tasks of processes/utils.py: dependencies, errors and the context of the tasks
+
+import contextvars
+import threading
+
+import pytest
+
+from processes.utils import run_tasks
+
+REQUEST = contextvars.ContextVar("request", default=None)
+
+
+def test_results_of_the_dependencies_are_passed_on():
+    order = []
+
+    def task(name, value):
+        def run(**kwargs):
+            order.append(name)
+            return value + sum(kwargs.values())
+
+        return run
+
+    results = run_tasks(
+        {
+            "c": (task("c", 100), ["a", "b"]),
+            "a": (task("a", 1), []),
+            "b": (task("b", 10), ["a"]),
+        },
+        max_workers=4,
+    )
+    assert results == {"a": 1, "b": 11, "c": 112}
+    assert order == ["a", "b", "c"]
+
+
+def test_independent_tasks_run_concurrently():
+    # both tasks only pass the barrier when they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+    results = run_tasks(
+        {
+            "a": (lambda: barrier.wait() is not None, []),
+            "b": (lambda: barrier.wait() is not None, []),
+        },
+        max_workers=2,
+    )
+    assert results == {"a": True, "b": True}
+
+
+def test_an_error_is_raised_and_stops_the_dependent_tasks():
+    started = []
+
+    def fail():
+        raise KeyError("probe")
+
+    with pytest.raises(KeyError, match="probe"):
+        run_tasks(
+            {
+                "fail": (fail, []),
+                "after": (lambda fail: started.append("after"), ["fail"]),
+            },
+            max_workers=2,
+        )
+    assert started == []
+
+
+def test_unknown_and_circular_dependencies_are_rejected():
+    with pytest.raises(ValueError, match="unknown"):
+        run_tasks({"a": (lambda b: b, ["b"])})
+    with pytest.raises(ValueError, match="circular"):
+        run_tasks({"a": (lambda b: b, ["b"]), "b": (lambda a: a, ["a"])})
+
+
+def test_tasks_run_in_a_copy_of_the_context():
+    def read():
+        return REQUEST.get()
+
+    def overwrite():
+        REQUEST.set("changed by a task")
+        return REQUEST.get()
+
+    token = REQUEST.set("request 1")
+    try:
+        results = run_tasks(
+            {"read": (read, []), "overwrite": (overwrite, [])}, max_workers=2
+        )
+        assert results == {"read": "request 1", "overwrite": "changed by a task"}
+        assert REQUEST.get() == "request 1"
+    finally:
+        REQUEST.reset(token)
@@ -0,0 +1,146 @@
+# Geodesic helpers of processes/vector_utils.py against fixed reference values.
+#
+# The projections were computed with Vincenty's direct formula on WGS84, the
+# algorithm of the spheroid projection of PostGIS, and are given to 1e-10 degrees.
+# ST_Azimuth on geometries is the planar angle in lon/lat space, so its values
+# follow from the coordinates.
+
+import numpy as np
+import pytest
+from shapely import wkt
+
+from processes.vector_utils import (
+    GEOD,
+    azimuth,
+    canonical_transect,
+    line_azimuth,
+    line_extend,
+    perpendicular_transect,
+    project,
+)
+
+TOLERANCE = 1e-8
+
+# (lon, lat, distance, azimuth) -> (lon, lat)
+PROJECTIONS = {
+    "north sea coast": ((4.5, 52.4, 5000, 270), (4.4265399790, 52.3999771779)),
+    "100km in the sea": ((4.5, 52.4, 100000, 300.5), (3.2210115139, 52.8492334666)),
+    "southern hemisphere": ((-70.6, -33.0, 10000, 180), (-70.6, -33.0901670492)),
+    "equator": ((0.0, 0.0, 500, 0), (0.0, 0.0045218474)),
+    "antimeridian eastwards": ((179.99, -16.5, 10000, 90), (-179.9163356115, -16.4999790223)),
+    "antimeridian westwards": ((-179.995, 65.0, 6000, 270), (179.8778155938, 64.9999458670)),
+    "svalbard": ((15.0, 78.2, 100000, 45), (18.2658859682, 78.8156426258)),
+    "greenland": ((-40.0, 84.5, 200, 0), (-40.0, 84.5017907730)),
+    "over the pole": ((20.0, 89.9, 100000, 10), (-171.2483290006, 89.2029876774)),
+}
+
+
+@pytest.mark.parametrize("start, end", PROJECTIONS.values(), ids=list(PROJECTIONS))
+def test_project_matches_the_reference(start, end):
+    lon, lat = project(*start)
+    assert float(lon) == pytest.approx(end[0], rel=0, abs=TOLERANCE)
+    assert float(lat) == pytest.approx(end[1], rel=0, abs=TOLERANCE)
+
+
+def test_project_is_vectorized():
+    starts = np.array([start for start, _ in PROJECTIONS.values()])
+    ends = np.array([end for _, end in PROJECTIONS.values()])
+    lons, lats = project(*starts.T)
+    np.testing.assert_allclose(lons, ends[:, 0], rtol=0, atol=TOLERANCE)
+    np.testing.assert_allclose(lats, ends[:, 1], rtol=0, atol=TOLERANCE)
+
+
+def test_project_needs_an_azimuth():
+    with pytest.raises(ValueError):
+        project(4.5, 52.4, 100, np.nan)
+
+
+@pytest.mark.parametrize(
+    "points, expected",
+    [
+        ((0, 0, 0, 1), 0),
+        ((0, 0, 1, 1), 45),
+        ((0, 0, 1, 0), 90),
+        ((0, 0, 0, -1), 180),
+        ((0, 0, -1, 0), 270),
+        ((4.5, 52.4, 4.4, 52.5), 315),
+        # planar like ST_Azimuth on geometries, so across the antimeridian it
+        # points the long way round
+        ((179.99, 0, -179.99, 0), 270),
+        ((15.0, 78.2, 15.0, 89.0), 0),
+    ],
+)
+def test_azimuth_is_planar(points, expected):
+    assert float(azimuth(*points)) == pytest.approx(expected, rel=0, abs=1e-12)
+
+
+def test_azimuth_of_coinciding_points_is_nan():
+    assert np.isnan(azimuth(4.5, 52.4, 4.5, 52.4))
+    with pytest.raises(ValueError):
+        line_azimuth(wkt.loads("LINESTRING (4.5 52.4, 4.5 52.4)"))
+
+
+def test_line_extend_in_both_directions():
+    transect = "LINESTRING (4.5 52.4, 4.51 52.4)"
+    inland = wkt.loads(line_extend(transect, 5000, 180))
+    sea = wkt.loads(line_extend(transect, 5000, -180))
+    assert inland.coords[0] == sea.coords[0] == (4.5, 52.4)
+    reference = PROJECTIONS["north sea coast"][1]
+    assert sea.coords[1] == pytest.approx(reference, rel=0, abs=TOLERANCE)
+    _, _, length = GEOD.inv(4.5, 52.4, *inland.coords[1])
+    assert length == pytest.approx(5000, abs=1e-6)
+    assert inland.coords[1][0] > 4.5
+
+
+def side(segment, start, point):
+    """1 if point is on the left of the segment as seen from start, -1 on the right"""
+    (x1, y1), (x2, y2) = segment.coords[0], segment.coords[-1]
+    return np.sign((x2 - x1) * (point[1] - start[1]) - (y2 - y1) * (point[0] - start[0]))
+
+
+@pytest.mark.parametrize(
+    "segment",
+    [
+        "LINESTRING (0 0, 0.01 0)",
+        "LINESTRING (0.01 0, 0 0)",
+        "LINESTRING (4.7 52.4, 4.5 52.0)",
+        "LINESTRING (-70.6 -33.0, -70.61 -33.1)",
+        "LINESTRING (15 78.2, 15 78.3)",
+        "LINESTRING (-40 84.5, -39.9 84.51)",
+    ],
+)
+def test_canonical_transect_points_inland(segment):
+    point_on_sea, transect = canonical_transect(segment, dist=500, offset=100)
+    segment = wkt.loads(segment)
+    sea = wkt.loads(point_on_sea)
+    start, end = wkt.loads(transect).coords
+    middle = segment.interpolate(0.5, normalized=True)
+    assert start == pytest.approx((middle.x, middle.y), abs=1e-12)
+    _, _, offset = GEOD.inv(start[0], start[1], sea.x, sea.y)
+    _, _, length = GEOD.inv(*start, *end)
+    assert offset == pytest.approx(100, abs=1e-6)
+    assert length == pytest.approx(500, abs=1e-6)
+    # OSM coastlines have the land on their left side, so the sea is at az + 90
+    # on the right, and the transect goes from it to the left
+    assert side(segment, start, (sea.x, sea.y)) == -1
+    assert side(segment, start, end) == 1
+
+
+def test_canonical_transect_of_an_east_running_coast():
+    point_on_sea, transect = canonical_transect("LINESTRING (0 0, 0.01 0)")
+    reference = PROJECTIONS["equator"][1]
+    assert wkt.loads(transect).coords[1] == pytest.approx(
+        (0.005, reference[1]), rel=0, abs=TOLERANCE
+    )
+    sea = wkt.loads(point_on_sea)
+    assert (sea.x, sea.y) == pytest.approx((0.005, -reference[1] / 5), rel=0, abs=TOLERANCE)
+
+
+def test_perpendicular_transect_along_the_segment():
+    segment = "LINESTRING (0 0, 0.01 0)"
+    for fraction in (0, 0.25, 1):
+        point_on_sea, transect = perpendicular_transect(segment, fraction)
+        start, end = wkt.loads(transect).coords
+        assert start == pytest.approx((0.01 * fraction, 0), abs=1e-12)
+        assert end == pytest.approx((0.01 * fraction, 0.0045218474), abs=TOLERANCE)
+        assert wkt.loads(point_on_sea).y < 0